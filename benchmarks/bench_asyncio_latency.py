@@ -0,0 +1,100 @@
+"""
+The event loop latency under a logging burst, with the handlers called in the loop and behind CPXAsyncioHandler.
+
+A ticker task sleeps 1ms again and again and measures how late it wakes up, while a burst task logs the
+records, 10 records between two yields. The sink is a rotating file handler and a handler sleeping 1ms
+for every 50 records, like the round trip of a database. When the handlers are called in the loop, the lag
+grows with the sink I/O, and behind CPXAsyncioHandler it stays near the lag without any handler.
+
+    python benchmarks/bench_asyncio_latency.py [records]
+"""
+import asyncio
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from logging import handlers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pcpxlog.cpxAsyncio import CPXAsyncioHandler
+
+
+class RoundTripHandler(logging.Handler):
+    """
+    Sleep 1ms for every 50 records, like saving the records into a database in batches.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.count = 0
+
+    def emit(self, record):
+        self.format(record)
+        self.count += 1
+        if self.count % 50 == 0:
+            time.sleep(0.001)
+
+
+async def ticker(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append((time.perf_counter() - start - 0.001) * 1000)
+
+
+async def burst(logger, number):
+    for index in range(number):
+        logger.info("the request %d has been processed", index)
+        if index % 10 == 0:
+            await asyncio.sleep(0)
+
+
+async def measure(logger, number, asyncio_handler=None):
+    lags, stop = list(), asyncio.Event()
+    ticker_task = asyncio.ensure_future(ticker(lags, stop))
+    await asyncio.sleep(0.01)
+    lags.clear()
+    start = time.perf_counter()
+    await burst(logger, number)
+    burst_time = time.perf_counter() - start
+    stop.set()
+    await ticker_task
+    if asyncio_handler:
+        await asyncio_handler.aclose()
+    lags.sort()
+    return dict(burst_ms=burst_time * 1000, lag_p50_ms=statistics.median(lags),
+                lag_p99_ms=lags[int(len(lags) * 0.99)], lag_max_ms=lags[-1])
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    log_dir = tempfile.mkdtemp(prefix="cpxBenchAsyncio")
+    try:
+        for mode in ("no handler", "in loop", "CPXAsyncioHandler"):
+            sinks = [handlers.RotatingFileHandler(os.path.join(log_dir, mode), maxBytes=100 * 1024 * 1024,
+                                                  backupCount=1), RoundTripHandler()]
+            logger = logging.getLogger("bench-" + mode)
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+            asyncio_handler = None
+            if mode == "no handler":
+                logger.addHandler(logging.NullHandler())
+            elif mode == "in loop":
+                for sink in sinks:
+                    logger.addHandler(sink)
+            else:
+                asyncio_handler = CPXAsyncioHandler(*sinks)
+                logger.addHandler(asyncio_handler)
+            result = asyncio.run(measure(logger, number, asyncio_handler))
+            print("%-18s burst %8.1fms  loop lag p50 %6.3fms  p99 %6.3fms  max %6.3fms" % (
+                mode, result["burst_ms"], result["lag_p50_ms"], result["lag_p99_ms"], result["lag_max_ms"]))
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Micro benchmark for the bson encoding cost of every log data saved by RotatingMongodbHandler.
+
+'twice' is the old path: encode the dict to count its size, then pymongo encodes it again when inserting.
+'once' is the new path: encode the dict to a RawBSONDocument, then the size and the inserting use its bytes.
+
+    python benchmarks/bench_bson_encode.py [number]
+"""
+import sys
+import timeit
+import traceback
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+
+def create_log_data(with_traceback):
+    """
+    Create a log data dict like the one made by RotatingMongodbHandler.parse_log
+    """
+    log_data = dict(_id=bson.ObjectId(), levelname="ERROR", asctime="2019-05-20 10:00:00,000",
+                    name="CPXLogger", pathname="/srv/app/views.py", lineno=128,
+                    message="Something wrong when processing the request")
+    if with_traceback:
+        # two functions call each other, so the traceback lines are not folded as repeated
+        def ping(depth):
+            if depth == 0:
+                raise ValueError("x" * 200)
+            pong(depth - 1)
+
+        def pong(depth):
+            ping(depth)
+
+        try:
+            ping(40)
+        except ValueError:
+            log_data["exc_text"] = traceback.format_exc()
+            log_data["stack_info"] = "".join(traceback.format_stack())
+    return log_data
+
+
+def encode_twice(log_data):
+    data_size = len(bson.BSON.encode(log_data))
+    return data_size, bson.BSON.encode(log_data)
+
+
+def encode_once(log_data):
+    raw_log_data = RawBSONDocument(bson.BSON.encode(log_data))
+    data_size = len(raw_log_data.raw)
+    # pymongo only copies the bytes of a RawBSONDocument when inserting
+    return data_size, bson.BSON.encode(raw_log_data)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    for title, with_traceback in (("small", False), ("traceback", True)):
+        log_data = create_log_data(with_traceback)
+        size = len(bson.BSON.encode(log_data))
+        twice = min(timeit.repeat(lambda: encode_twice(log_data), number=number, repeat=3)) / number
+        once = min(timeit.repeat(lambda: encode_once(log_data), number=number, repeat=3)) / number
+        print("%-10s %7d bytes  twice: %6.2f us  once: %6.2f us  saved: %6.2f us (%.0f%%)" % (
+            title, size, twice * 1e6, once * 1e6, (twice - once) * 1e6, (twice - once) / twice * 100))
+
+
+if __name__ == '__main__':
+    main()
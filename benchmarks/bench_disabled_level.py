@@ -0,0 +1,69 @@
+"""
+The cost of a disabled 'logger.debug' calling, when every handler is INFO or higher.
+
+'before' is the logger of the old CPXLogger, its level is DEBUG from the Basic config, so a LogRecord is
+created and dropped by every handler. 'CPXLogger' is the logger created now, its level is the min level of
+the handlers, so the calling returns before creating the LogRecord. The 'eager' message is built by the
+caller every time, and the 'LazyMessage' one is built only when a handler wants the record.
+
+    python benchmarks/bench_disabled_level.py [callings]
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pcpxlog import CPXLogger, LazyMessage
+
+FORMAT = "[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d :%(message)s"
+STATE = {"user_%d" % index: {"id": index, "roles": ["reader", "writer"]} for index in range(20)}
+
+
+def measure(name, number, func):
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    cost = (time.perf_counter() - start) / number * 1e9
+    print("%-34s %8.1fns per calling" % (name, cost))
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    log_dir = tempfile.mkdtemp(prefix="cpxBenchLevel")
+    try:
+        CPXLogger.config_from_dict({
+            "Basic": {"LEVEL": "DEBUG", "FORMAT": FORMAT},
+            "Console": {"LEVEL": "INFO", "FORMAT": FORMAT},
+            "File": {"TYPE": "Ordinary", "FILE_PATH": os.path.join(log_dir, "log"), "LEVEL": "INFO",
+                     "FORMAT": FORMAT},
+        })
+        logger = CPXLogger.create_logger()
+        # the console handler writes nothing here, only its level matters
+        for handler in logging.getLogger().handlers:
+            handler.setStream(open(os.devnull, "w"))
+
+        before = logging.getLogger("bench-before")
+        before.propagate = False
+        before.setLevel(logging.DEBUG)
+        for handler in CPXLogger.handlers:
+            before.addHandler(handler)
+
+        for name, bench_logger in (("before", before), ("CPXLogger", logger)):
+            measure(name + " debug(eager)", number,
+                    lambda: bench_logger.debug("the state: %s", json.dumps(STATE)))
+            measure(name + " debug(LazyMessage)", number,
+                    lambda: bench_logger.debug("the state: %s", LazyMessage(json.dumps, STATE)))
+            measure(name + " debug(plain)", number,
+                    lambda: bench_logger.debug("the request has been processed"))
+    finally:
+        logging.shutdown()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Micro benchmark for the file handlers, the records/sec of 'handle' with the same record.
+
+'FileHandler' flushes for every record, 'RotatingFileHandler' also calls 'seek' and 'tell' for every record,
+'BufferedRotatingFileHandler' writes the buffered lines in one calling. The 'message' format shows the cost
+of the file I/O, and the 'default' format shows it with the cost of formatting 'asctime' and the others.
+
+On a laptop with python 3.11, 'Buffered' is about 1.3x 'FileHandler' with the 'default' format and 1.6x with
+the 'message' format, and 3x-5x 'RotatingFileHandler'. The formatting of a record, about 0.7us with the
+'message' format, stays in the calling thread, and 'FileHandler' costs only about 2us, so the buffer alone can
+not make it several times faster. Writing in a thread does not help either, the formatting there holds the GIL.
+
+    python benchmarks/bench_file_sink.py [number]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from logging import handlers
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pcpxlog.cpxFile import BufferedRotatingFileHandler
+
+FORMATS = {
+    "default": "[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d :%(message)s",
+    "message": "%(message)s",
+}
+MAX_BYTES = 100 * 1024 * 1024
+
+HANDLER_FACTORIES = {
+    "FileHandler": lambda path: logging.FileHandler(path),
+    "RotatingFileHandler": lambda path: handlers.RotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=3),
+    "Buffered": lambda path: BufferedRotatingFileHandler(path),
+    "BufferedRotating": lambda path: BufferedRotatingFileHandler(path, maxBytes=MAX_BYTES, backupCount=3),
+}
+
+
+def records_per_second(handler, format_str, number):
+    handler.setFormatter(logging.Formatter(format_str))
+    record = logging.LogRecord("bench", logging.INFO, "/srv/app/views.py", 128, "Something wrong when %s",
+                               ("processing the request",), None)
+    start = time.perf_counter()
+    for _ in range(number):
+        handler.handle(record)
+    handler.close()
+    return number / (time.perf_counter() - start)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    log_dir = tempfile.mkdtemp(prefix="cpxBenchFile")
+    try:
+        for format_name, format_str in FORMATS.items():
+            results = dict()
+            for name, create_handler in HANDLER_FACTORIES.items():
+                results[name] = records_per_second(create_handler(os.path.join(log_dir, name + format_name)),
+                                                   format_str, number)
+            for name, speed in results.items():
+                print("%-8s %-20s %10.0f records/sec  %5.1fx FileHandler" % (
+                    format_name, name, speed, speed / results["FileHandler"]))
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
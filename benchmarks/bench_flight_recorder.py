@@ -0,0 +1,79 @@
+"""
+The cost of a 'logger.debug' calling, with the DEBUG records written into the file, and kept by the flight
+recorder which writes them only when an error comes.
+
+'file DEBUG' writes every DEBUG record into a rotating file, 'recorder' keeps them in the ring of the
+FlightRecorderHandler and the file only gets INFO or higher. 'no-op DEBUG' has a NullHandler of DEBUG instead
+of the recorder, it is the cost of creating the LogRecord, so the ring costs the difference of them. 'file INFO'
+is the DEBUG level disabled. At the end, 10000 DEBUG records and one error record are logged, the error dumps
+the ring into the file.
+
+    python benchmarks/bench_flight_recorder.py [callings]
+"""
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pcpxlog import CPXLogger
+
+FORMAT = "[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d :%(message)s"
+
+
+def create_config(log_dir, mode):
+    config = {
+        "Basic": {"LEVEL": "CRITICAL", "FORMAT": FORMAT},
+        "File": {"TYPE": "Rotating", "FILE_PATH": os.path.join(log_dir, mode.replace(" ", "_")),
+                 "MAX_BYTES": 100 * 1024 * 1024, "BACKUP_COUNT": 1, "FORMAT": FORMAT,
+                 "LEVEL": "DEBUG" if mode == "file DEBUG" else "INFO"},
+    }
+    if mode == "recorder":
+        config["Recorder"] = {"LEVEL": "DEBUG", "FORMAT": FORMAT, "CAPACITY": 1000, "COOLDOWN": 0,
+                              "TARGETS": ["File"]}
+    return config
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    dump_every = 10000
+    log_dir = tempfile.mkdtemp(prefix="cpxBenchRecorder")
+    try:
+        for mode in ("file DEBUG", "recorder", "no-op DEBUG", "file INFO"):
+            CPXLogger.config_from_dict(create_config(log_dir, mode))
+            logger = CPXLogger.create_logger("bench")
+            logger.propagate = False
+            # the NullHandler of the last mode is not removed by CPXLogger
+            for handler in list(logger.handlers):
+                if isinstance(handler, logging.NullHandler):
+                    logger.removeHandler(handler)
+            if mode == "no-op DEBUG":
+                logger.addHandler(logging.NullHandler())
+                logger.setLevel(logging.DEBUG)
+
+            start = time.perf_counter()
+            for index in range(number):
+                logger.debug("the request %d has been processed", index)
+            debug_cost = (time.perf_counter() - start) / number * 1e9
+
+            start = time.perf_counter()
+            for index in range(dump_every):
+                logger.debug("the request %d has been processed", index)
+            logger.error("the request failed")
+            dump_cost = (time.perf_counter() - start) * 1e3
+
+            for handler in CPXLogger.handlers:
+                handler.flush()
+            size = os.path.getsize(os.path.join(log_dir, mode.replace(" ", "_")))
+            print("%-12s debug %7.1fns per calling  %d debug + 1 error %7.1fms  file %6.1fMB" % (
+                mode, debug_cost, dump_every, dump_cost, size / 1024 / 1024))
+    finally:
+        logging.shutdown()
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Startup benchmark for pcpxlog.
+
+It measures the 'import pcpxlog' cost by 'python -X importtime', and the cost of one configure-and-first-log
+cycle for every backend combination. Every measurement runs in a new interpreter, so the import caches
+of the former one do not help.
+
+The Mongodb handler works in batch mode and connects lazily, so the first log only puts the log data into
+the queue and no mongodb server is needed.
+
+    python benchmarks/bench_startup.py [repeat]
+"""
+import itertools
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CONFIG_SECTIONS = {
+    "File": {"LEVEL": "DEBUG", "FORMAT": "%(message)s", "TYPE": "Ordinary", "FILE_PATH": None},
+    "Mongodb": {"LEVEL": "DEBUG", "FORMAT": "%(message)s", "BATCH": True, "SERVER_SELECTION_TIMEOUT_MS": 100},
+}
+
+CYCLE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+from pcpxlog import CPXLogger
+CPXLogger.config_from_dict(json.loads(sys.argv[1]))
+logger = CPXLogger.create_logger("bench")
+logger.info("the first log")
+print(time.perf_counter() - start)
+"""
+
+
+def run_python(*args):
+    env = dict(os.environ, PYTHONPATH=PROJECT_DIR)
+    return subprocess.run([sys.executable] + list(args), env=env, capture_output=True, text=True, check=True)
+
+
+def import_time_us():
+    """
+    Get the cumulative import time of the 'pcpxlog' package from the '-X importtime' report.
+    """
+    ret = run_python("-X", "importtime", "-c", "import pcpxlog")
+    for line in ret.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        parts = [part.strip() for part in line.split("|")]
+        if len(parts) == 3 and parts[2] == "pcpxlog":
+            return int(parts[1])
+
+
+def cycle_time_ms(sections, log_dir):
+    config = {"Basic": {"LEVEL": "DEBUG"}}
+    for section in sections:
+        config[section] = dict(CONFIG_SECTIONS[section])
+    if "File" in config:
+        config["File"]["FILE_PATH"] = os.path.join(log_dir, "log")
+    ret = run_python("-c", CYCLE_SCRIPT, json.dumps(config))
+    return float(ret.stdout.strip().splitlines()[-1]) * 1000
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    import_times = [import_time_us() for _ in range(repeat)]
+    print("import pcpxlog: %.1f ms" % (statistics.median(import_times) / 1000))
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        for count in range(len(CONFIG_SECTIONS) + 1):
+            for sections in itertools.combinations(CONFIG_SECTIONS, count):
+                times = [cycle_time_ms(sections, log_dir) for _ in range(repeat)]
+                title = "+".join(("Console",) + sections)
+                print("configure and first log, %-22s %.1f ms" % (title + ":", statistics.median(times)))
+
+
+if __name__ == '__main__':
+    main()
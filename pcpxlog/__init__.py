@@ -4,8 +4,17 @@ Author: Kerbalwzy@gmail.com
 """
 
 from pcpxlog.cpxLogger import CPXLogger
-from pcpxlog.cpxHandlers import RotatingMongodbHandler
+from pcpxlog.cpxUtils import LazyMessage
 
 __all__ = [
-    CPXLogger, RotatingMongodbHandler
+    "CPXLogger", "RotatingMongodbHandler", "LazyMessage"
 ]
+
+
+def __getattr__(name):
+    # Import the backend handler classes only when they are used, the backends import their drivers.
+    from pcpxlog.cpxLoader import ConfigLoader
+
+    if name in ConfigLoader.handler_types:
+        return ConfigLoader.resolve_handler_type(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
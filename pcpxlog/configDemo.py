@@ -4,7 +4,8 @@
 ConfigDictDemo = {
     'Basic': {
         'FORMAT': '[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d :%(message)s',
-        'LEVEL': 'DEBUG'
+        'LEVEL': 'DEBUG',
+        'ASYNC': False
     },
     'Console': {
         'FORMAT': '[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d :%(message)s',
@@ -17,7 +18,9 @@ ConfigDictDemo = {
         'MAX_BYTES': 1024,
         'TYPE': 'Rotating'
     },
-    'Mongodb': {}
+    'Mongodb': {},
+    'Redis': {'STREAM': 'CPXLog', 'MAXLEN': 1000000},
+    'Sql': {'DRIVER': 'sqlite3', 'DATABASE': './logs/CPXLog.db'}
 }
 """
 
@@ -35,21 +38,96 @@ class CPXLogConfigDemo:
         """
         LEVEL = "INFO"
         FORMAT = "[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d :%(message)s"
+        # ASYNC: put all the File and Mongodb handlers behind one queue, the log calling will not wait for I/O.
+        # ASYNC_OVERFLOW has three choice when the queue is full, 'Block', 'DropNewest' or 'DropLowest'.
+        ASYNC = False
+        ASYNC_QUEUE_SIZE = 10000
+        ASYNC_OVERFLOW = "Block"
+        # ASYNCIO: for the services running in an event loop, put all the handlers behind one asyncio queue, a writer
+        # task hands the records to them in batches of ASYNCIO_BATCH_SIZE by ASYNCIO_WORKERS threads. The new records
+        # are dropped when the queue is full. Call 'await CPXLogger.aflush()' and 'await CPXLogger.aclose()' when
+        # the service shuts down.
+        ASYNCIO = False
+        ASYNCIO_QUEUE_SIZE = 10000
+        ASYNCIO_BATCH_SIZE = 500
+        ASYNCIO_WORKERS = 1
+        # STATS: every handler counts its records for CPXLogger.stats(), and times one of STATS_SAMPLE_RATE records.
+        # If STATS_INTERVAL is not 0, the stats is dumped into STATS_FILE, or the STATS_LOGGER logger if no file.
+        STATS_SAMPLE_RATE = 16
+        STATS_INTERVAL = 0
+        STATS_FILE = None
+        STATS_LOGGER = "CPXLogger.stats"
+        # FILTERS: drop the records before formatting them, when the same warning is emitted thousands of times a
+        # second. SAMPLE_RATES keeps the records of a level by the probability, like {"DEBUG": 0.01}. RATE_LIMIT
+        # and RATE_BURST are the records per second and the max records at once of a token bucket. DEDUPE_WINDOW
+        # collapses the records of the same (pathname, lineno, msg) in the seconds into one, and when the seconds
+        # end, a summary record with ' [repeated N times]' after the message is logged for the dropped ones, N is
+        # its 'repeated' attribute too, so '%(repeated)s' can be used in FORMAT or EXTRA_FIELDS.
+        # Set them here for every handler, or in a handler config only for it. The 'LOGGER_' ones work for the
+        # logger, so the records are dropped before the ASYNC queue.
+        SAMPLE_RATES = None
+        RATE_LIMIT = 0
+        RATE_BURST = 0
+        DEDUPE_WINDOW = 0
+        LOGGER_SAMPLE_RATES = None
+        LOGGER_RATE_LIMIT = 0
+        LOGGER_RATE_BURST = 0
+        LOGGER_DEDUPE_WINDOW = 0
+        # AGGREGATE: for gunicorn and the other prefork servers, only one collector process creates the File,
+        # Mongodb and other handlers, the worker processes send the records to it through the unix socket
+        # AGGREGATE_SOCKET in batches. The collector is started by the workers, and exits after no worker
+        # connects it for AGGREGATE_IDLE_EXIT seconds. The records are written to stderr when it is dead.
+        AGGREGATE = False
+        AGGREGATE_SOCKET = "./logs/cpxlog.sock"
+        AGGREGATE_BATCH_SIZE = 500
+        AGGREGATE_LINGER_MS = 100
+        AGGREGATE_IDLE_EXIT = 60
 
     class Console(Basic):
         # Console: setting for output log information on terminate.
         LEVEL = "DEBUG"
 
+    # class Recorder(Basic):
+    #     """
+    #     Recorder: the flight recorder keeps the last CAPACITY records of every logger from the LEVEL in memory,
+    #     only the fields in FORMAT. When a record of TRIGGER_LEVEL or higher comes, the records kept are written
+    #     into the handlers of the TARGETS config sections, the ones lower than their levels, at most once every
+    #     COOLDOWN seconds for a logger. So the DEBUG context of the errors is saved without saving all of it.
+    #     """
+    #     LEVEL = "DEBUG"
+    #     CAPACITY = 1000
+    #     TRIGGER_LEVEL = "ERROR"
+    #     COOLDOWN = 60
+    #     TARGETS = ["File", "Mongodb"]
+
     class File(Basic):
         """
-        File: Settings for write log information in file. The 'TYPE' has two choice, 'Ordinary' or 'Rotating'.
+        File: Settings for write log information in file. The 'TYPE' has three choice, 'Ordinary', 'Rotating' or
+        'Buffered'.
         'Ordinary' meanings to use 'FileHandler' from logging module, and only need to set 'FILE_PATH'.
         'Rotating' meanings to use 'RotatingFileHandler' from logging.handlers module, and need set more.
+        'Buffered' meanings to use 'BufferedRotatingFileHandler' from this project, it writes the log lines in
+        batches without flushing every line, about 1.3x the records/sec of 'Ordinary' and 3x of 'Rotating', and
+        rotates like 'Rotating' if MAX_BYTES and BACKUP_COUNT are set.
+        'Timed' meanings to rotate the file by time, every INTERVAL of WHEN ('H', 'D', 'MIDNIGHT'...).
+        'Binary' meanings to write bson records and a time index file '<FILE_PATH>.idx' every INDEX_INTERVAL records,
+        it buffers and rotates like 'Buffered', and 'cpxBinaryToText' converts the file to text lines.
         """
         TYPE = "Rotating"
         FILE_PATH = "./logs/log"
         MAX_BYTES = 1024
         BACKUP_COUNT = 3
+        # COMPRESSION: None, 'gzip' or 'zstd' ('pip3 install pcpxlog[zstd]'), the rotated files are compressed
+        # by a background thread, and BACKUP_COUNT counts the compressed files
+        COMPRESSION = None
+        # only for 'Timed'
+        WHEN = "MIDNIGHT"
+        INTERVAL = 1
+        # only for 'Buffered': write the buffer when it has BUFFER_BYTES bytes, every FLUSH_INTERVAL seconds,
+        # or when a record of FLUSH_LEVEL or higher comes
+        BUFFER_BYTES = 64 * 1024
+        FLUSH_INTERVAL = 1.0
+        FLUSH_LEVEL = "ERROR"
 
     class Mongodb(Basic):
         """
@@ -61,8 +139,97 @@ class CPXLogConfigDemo:
         PORT = 27017
         USER = None
         PASSWORD = None
+        # URI takes the place of HOST, PORT, USER and PASSWORD when it is set
+        URI = None
+        # the handlers with the same uri and options share one client and its connection pool,
+        # and it connects to mongodb server when the first log data is saving
+        MAX_POOL_SIZE = 100
+        CONNECT_TIMEOUT_MS = 5000
+        SERVER_SELECTION_TIMEOUT_MS = 5000
+        SOCKET_TIMEOUT_MS = None
+        # the circuit breaker is open after BREAKER_THRESHOLD saving failures one after another, then the log data
+        # is kept in the SPOOL_PATH file (every process should use its own file), and replayed when mongodb is
+        # reachable again, REPLAY_BATCH_SIZE log data every REPLAY_INTERVAL_MS.
+        BREAKER_THRESHOLD = 3
+        BREAKER_COOLDOWN = 10
+        SPOOL_PATH = None
+        SPOOL_MAX_BYTES = 64 * 1024 * 1024
+        REPLAY_BATCH_SIZE = 500
+        REPLAY_INTERVAL_MS = 100
         # DB is the database name
         DB = "CPXLog"
         # COLL_NAME is the basic name for collections
         COLL_NAME = "logs"
         # the COLL_SIZE and COLL_COUNT is recommended to use default values
+
+        # STORAGE has three choice. 'Rotating' creates a new collection when the current one is full,
+        # 'Capped' uses one capped collection sized COLL_SIZE * COLL_COUNT,
+        # 'Timed' uses one collection every BUCKET ('Hour' or 'Day') and keeps the latest COLL_COUNT of them.
+        STORAGE = "Rotating"
+        BUCKET = "Day"
+        SWEEP_INTERVAL = 60
+
+        # BATCH: save log data by a background thread in batches, the 'emit' will not wait for mongodb
+        BATCH = False
+        # a batch will be saved when it has BATCH_SIZE log data, or BATCH_BYTES bytes, or waited LINGER_MS
+        BATCH_SIZE = 500
+        BATCH_BYTES = 1024 * 1024
+        LINGER_MS = 200
+        # QUEUE_FULL_POLICY has two choice, 'Block' for waiting the writer, 'Drop' for discarding the new log data
+        QUEUE_CAPACITY = 10000
+        QUEUE_FULL_POLICY = "Block"
+
+        # EXTRA_FIELDS: the names of custom attributes passed by 'extra=', which should be saved with the fields in FORMAT
+        EXTRA_FIELDS = []
+        # INDEX_FIELDS: the fields indexed with '_id' in every log collection, so 'cpxLogReader' queries filtered by them are fast
+        INDEX_FIELDS = ["levelname", "name"]
+        # INTERN_TRACEBACKS: save every distinct traceback once in the '<COLL_NAME>_tracebacks' collection, the log
+        # data only keeps its hash. COMPRESS_THRESHOLD: compress the messages of this count of bytes or more by zlib,
+        # 0 for never. Both of them let the same COLL_SIZE * COLL_COUNT keep more log data in error storms, and
+        # 'cpxLogReader' gives back the tracebacks and the messages.
+        INTERN_TRACEBACKS = False
+        COMPRESS_THRESHOLD = 0
+        # ROLLUP: count the log data every minute by levelname and name, and by 'pathname:lineno' too if ROLLUP_LINES,
+        # into the '<COLL_NAME>_rollups' collection, which is not rotated. The counts are coalesced in memory and
+        # saved at most once every ROLLUP_INTERVAL seconds, the ones older than ROLLUP_EXPIRE seconds are removed,
+        # 0 for never. 'cpxLogReader --rollups' reads them as the time series.
+        ROLLUP = False
+        ROLLUP_LINES = False
+        ROLLUP_INTERVAL = 10
+        ROLLUP_EXPIRE = 0
+
+    # class Redis(Basic):
+    #     """
+    #     Redis: Settings for save log information into a redis stream, it needs 'pip3 install pcpxlog[redis]'.
+    #     Every log is an entry of the STREAM, and the stream is trimmed to about MAXLEN entries by redis.
+    #     """
+    #     HOST = "127.0.0.1"
+    #     PORT = 6379
+    #     USER = None
+    #     PASSWORD = None
+    #     DB = 0
+    #     STREAM = "CPXLog"
+    #     MAXLEN = 1000000
+    #     # the entries are added by a background thread, one pipeline for every batch
+    #     BATCH = True
+    #     BATCH_SIZE = 500
+    #     LINGER_MS = 100
+
+    # class Sql(Basic):
+    #     """
+    #     Sql: Settings for save log information into a sql database by a DB-API driver.
+    #     The 'sqlite3' driver uses the DATABASE file, the mysql drivers like 'pymysql' use the CONNECT_PARAMS.
+    #     """
+    #     DRIVER = "sqlite3"
+    #     DATABASE = "./logs/CPXLog.db"
+    #     # CONNECT_PARAMS = dict(host="127.0.0.1", port=3306, user="root", password="", database="CPXLog")
+    #     CONNECT_PARAMS = None
+    #     # the log tables are '<TABLE>_<index>', a new one is created when the current one has TABLE_ROWS rows,
+    #     # and only the latest TABLE_COUNT of them are kept
+    #     TABLE = "logs"
+    #     TABLE_ROWS = 1000000
+    #     TABLE_COUNT = 10
+    #     # the rows are saved by a background thread, one 'executemany' transaction for every batch
+    #     BATCH = True
+    #     BATCH_SIZE = 500
+    #     LINGER_MS = 200
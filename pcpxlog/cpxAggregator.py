@@ -0,0 +1,387 @@
+"""
+The multi-process aggregation mode, for the prefork servers like gunicorn and the multiprocessing workers.
+
+If 'AGGREGATE' is True in the Basic config, the process calling 'CPXLogger.config_from_*' does not create the
+File, Mongodb and other handlers itself. It only has one 'AggregatorClientHandler', which sends the records
+to the collector process through the unix socket 'AGGREGATE_SOCKET', batch by batch. The collector process
+is the only one who creates the real handlers by the same config, so only one process writes the rotating
+files and the mongodb state document.
+
+The collector is started by the first client who can not connect to the socket, in a new session, so it
+keeps running when that process exits, and serves all the clients. It holds the lock file '<socket>.lock',
+the other collectors started at the same time exit at once. It exits when no client connects it for
+'AGGREGATE_IDLE_EXIT' seconds, and the process who started it reaps it without waiting. When
+the collector dies, the clients write the records to stderr, and start a new collector, every
+'retry_interval' seconds until it is connected again.
+
+The records are sent as the dicts of their attributes, the message is merged with the args and the
+traceback is formatted in the client, and the attributes which are not str, int, float, bool or bytes are
+sent as str. A batch is serialized by 'marshal' into one frame, which begins with its uint32 little-endian
+length.
+"""
+import atexit
+import fcntl
+import logging
+import marshal
+import os
+import pickle
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import weakref
+
+from pcpxlog.cpxBatch import BatchWriter
+from pcpxlog.cpxStats import HandlerStats
+from pcpxlog.cpxUtils import RECORD_CACHE_ATTR, RECORD_TEMPLATE_ATTR, record_message
+
+FRAME_LENGTH = struct.Struct("<I")
+# the record attributes not sent, the collector formats them again
+_SKIPPED_ATTRS = ("msg", "args", "exc_info", "message", "asctime", RECORD_CACHE_ATTR)
+_VALUE_TYPES = (str, int, float, bool, bytes)
+
+# all the client handlers, they are reset in the child process after forking
+_CLIENT_HANDLERS = weakref.WeakSet()
+# the collector processes started by this process, they are reaped after exiting, so no zombie is left
+_COLLECTORS = set()
+
+
+def serialize_record(record, formatter):
+    """
+    Get the dict of the record attributes which can be sent to the collector.
+    :param formatter: the formatter to format the traceback
+    :return: log_data: {attribute name: value}
+    """
+    if record.exc_info and not record.exc_text:
+        record.exc_text = formatter.formatException(record.exc_info)
+    log_data = dict(msg=record_message(record))
+    if record.args:
+        # the filters in the collector, like 'DedupeFilter', know the records by the msg before merging
+        log_data[RECORD_TEMPLATE_ATTR] = record.msg if type(record.msg) in _VALUE_TYPES else str(record.msg)
+    for key, value in record.__dict__.items():
+        if value is None or key in _SKIPPED_ATTRS:
+            continue
+        if type(value) not in _VALUE_TYPES:
+            value = str(value)
+        log_data[key] = value
+    return log_data
+
+
+def start_collector(socket_path, config):
+    """
+    Start the collector process in a new session, the config dict is passed by its stdin.
+    :return: process: the subprocess.Popen object
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    process = subprocess.Popen([sys.executable, "-m", "pcpxlog.cpxAggregator", socket_path],
+                               stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, env=env, start_new_session=True)
+    process.stdin.write(pickle.dumps(config))
+    process.stdin.close()
+    _COLLECTORS.add(process)
+    return process
+
+
+def reap_collectors():
+    """
+    Reap the exited collector processes without waiting, the running ones still serve the other clients.
+    """
+    for process in list(_COLLECTORS):
+        if process.poll() is not None:
+            _COLLECTORS.discard(process)
+
+
+atexit.register(reap_collectors)
+
+
+class AggregatorClientHandler(logging.Handler):
+    """
+    The handler sends the records to the collector process in batches, by a background thread.
+    """
+
+    def __init__(self, socket_path, collector_config=None, batch_size=500, linger_ms=100, queue_capacity=10000,
+                 queue_full_policy="Block", retry_interval=2, send_timeout=5):
+        """
+        :param socket_path: the unix socket path of the collector
+        :param collector_config: the config dict of the collector, start the collector by it when the socket
+            can not be connected, None for never starting it
+        :param batch_size: the max count of records in one frame
+        :param linger_ms: the max time a batch wait for more records, in milliseconds
+        :param queue_capacity: the max count of records waiting in the queue
+        :param queue_full_policy: 'Block' or 'Drop', what to do when the queue is full
+        :param retry_interval: the min seconds between two connecting tries
+        :param send_timeout: the max seconds of sending a frame, the records are written to stderr after it
+        """
+        logging.Handler.__init__(self)
+        self.socketPath = os.path.abspath(socket_path)
+        self.collectorConfig = collector_config
+        self.batchSize = batch_size
+        self.lingerTime = linger_ms
+        self.queueCapacity = queue_capacity
+        self.queueFullPolicy = queue_full_policy
+        self.retryInterval = retry_interval
+        self.sendTimeout = send_timeout
+        self.cpxStats = HandlerStats()
+        self.__fallback = logging.StreamHandler(sys.stderr)
+        self.__sock = None
+        self.__retryTime = 0
+        # the subprocess.Popen object of the collector started by this handler
+        self.__collector = None
+        self.__start_writer()
+        _CLIENT_HANDLERS.add(self)
+
+    def __start_writer(self):
+        self.__writer = BatchWriter(self.__send_batch, name="CPXLog-aggregator-client", batch_size=self.batchSize,
+                                    linger_ms=self.lingerTime, queue_capacity=self.queueCapacity,
+                                    queue_full_policy=self.queueFullPolicy, stats=self.cpxStats)
+
+    def __connect(self):
+        """
+        Get the connected socket, try to connect the collector once every self.retryInterval seconds, and
+        start the collector if there is none.
+        :return: sock: the socket object, or None if the collector can not be connected now
+        """
+        if self.__sock is not None:
+            return self.__sock
+        now = time.monotonic()
+        if now < self.__retryTime:
+            return None
+        self.__retryTime = now + self.retryInterval
+
+        try:
+            self.__sock = self.__try_connect()
+        except (FileNotFoundError, ConnectionRefusedError):
+            if self.collectorConfig is None:
+                return None
+            # the collector started before may be still starting
+            reap_collectors()
+            if self.__collector not in _COLLECTORS:
+                self.__collector = start_collector(self.socketPath, self.collectorConfig)
+            # wait the new collector listening, at most self.retryInterval seconds
+            while self.__sock is None and time.monotonic() < self.__retryTime:
+                time.sleep(0.05)
+                try:
+                    self.__sock = self.__try_connect()
+                except OSError:
+                    continue
+        except OSError:
+            return None
+        return self.__sock
+
+    def __try_connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.sendTimeout)
+        try:
+            sock.connect(self.socketPath)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def __disconnect(self):
+        if self.__sock is not None:
+            self.__sock.close()
+            self.__sock = None
+
+    def __send_batch(self, batch):
+        """
+        Send the batch in one frame, or write the records to stderr if the collector is not connected.
+        """
+        payload = marshal.dumps(batch)
+        sock = self.__connect()
+        if sock is not None:
+            try:
+                sock.sendall(FRAME_LENGTH.pack(len(payload)) + payload)
+                self.cpxStats.count_bytes(FRAME_LENGTH.size + len(payload))
+                return
+            except OSError:
+                self.__disconnect()
+
+        self.__fallback.setFormatter(self.formatter)
+        for log_data in batch:
+            self.__fallback.handle(logging.makeLogRecord(log_data))
+
+    def emit(self, record):
+        """
+        Serialize the record and put it into the queue of the background thread.
+        """
+        try:
+            self.__writer.put(serialize_record(record, self.formatter or logging.Formatter()))
+        except Exception:
+            self.handleError(record)
+
+    def after_fork(self):
+        """
+        The socket and the background thread belong to the parent process, the child process connects the
+        collector and starts the thread itself.
+        """
+        self.__disconnect()
+        self.__retryTime = 0
+        self.__collector = None
+        self.__start_writer()
+
+    def flush(self):
+        """
+        Wait for all the records in the queue sent.
+        """
+        self.__writer.flush()
+
+    def close(self):
+        """
+        Send the records in the queue, and close the socket. The collector is shared by the other clients, it
+        exits after idle for 'AGGREGATE_IDLE_EXIT' seconds.
+        """
+        self.__writer.close()
+        self.__disconnect()
+        reap_collectors()
+        self.__fallback.close()
+        _CLIENT_HANDLERS.discard(self)
+        logging.Handler.close(self)
+
+
+def _reset_client_handlers():
+    # only the parent process can reap the collectors
+    _COLLECTORS.clear()
+    for handler in list(_CLIENT_HANDLERS):
+        handler.after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_client_handlers)
+
+
+class LogCollector:
+    """
+    The collector process, it creates the real handlers by the config, and handles the records from the
+    clients, one thread for every client connection.
+    """
+
+    def __init__(self, socket_path, config, idle_exit=60):
+        """
+        :param socket_path: the unix socket path to listen
+        :param config: the config dict, like the one of 'CPXLogger.config_from_dict'
+        :param idle_exit: exit after no client connects for this seconds, 0 for never
+        """
+        self.socketPath = os.path.abspath(socket_path)
+        self.config = config
+        self.idleExit = idle_exit
+        self.handlers = list()
+        self.__lockFile = None
+        self.__connections = 0
+        self.__idleSince = time.monotonic()
+        self.__connectionsLock = threading.Lock()
+
+    def lock(self):
+        """
+        Hold the lock file of the socket, only one collector serves a socket.
+        :return: locked: False if an other collector holds it
+        """
+        os.makedirs(os.path.dirname(self.socketPath), exist_ok=True)
+        self.__lockFile = open(self.socketPath + ".lock", "a")
+        try:
+            fcntl.flock(self.__lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.__lockFile.close()
+            self.__lockFile = None
+            return False
+        return True
+
+    def handle(self, record):
+        """
+        Dispatch the record to the handlers by their levels, like 'Logger.callHandlers'.
+        """
+        for handler in self.handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def __iter_frames(self, conn):
+        reader = conn.makefile("rb")
+        while True:
+            header = reader.read(FRAME_LENGTH.size)
+            if len(header) < FRAME_LENGTH.size:
+                return
+            length, = FRAME_LENGTH.unpack(header)
+            payload = reader.read(length)
+            if len(payload) < length:
+                return
+            yield payload
+
+    def __serve_connection(self, conn):
+        """
+        Handle the records in the frames from one client, until the client closes the connection.
+        """
+        try:
+            for payload in self.__iter_frames(conn):
+                try:
+                    batch = marshal.loads(payload)
+                except (EOFError, ValueError, TypeError):
+                    return
+                for log_data in batch:
+                    if isinstance(log_data, dict):
+                        self.handle(logging.makeLogRecord(log_data))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+            with self.__connectionsLock:
+                self.__connections -= 1
+                self.__idleSince = time.monotonic()
+
+    def __is_idle(self):
+        with self.__connectionsLock:
+            return self.__connections == 0 and time.monotonic() - self.__idleSince > self.idleExit
+
+    def serve_forever(self):
+        """
+        Create the handlers, and serve the clients until it is idle for self.idleExit seconds.
+        """
+        from pcpxlog.cpxLogger import CPXLogger
+
+        CPXLogger.config_from_dict(self.config)
+        self.handlers = list(CPXLogger.handlers)
+
+        # the lock is held, so the socket file is left by a dead collector
+        if os.path.exists(self.socketPath):
+            os.unlink(self.socketPath)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socketPath)
+        server.listen(128)
+        server.settimeout(1)
+        try:
+            while not (self.idleExit and self.__is_idle()):
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                with self.__connectionsLock:
+                    self.__connections += 1
+                threading.Thread(target=self.__serve_connection, args=(conn,), name="CPXLog-collector",
+                                 daemon=True).start()
+        finally:
+            server.close()
+            os.unlink(self.socketPath)
+            # the records sent before the clients closing the connections are still handled
+            deadline = time.monotonic() + 5
+            while self.__connections and time.monotonic() < deadline:
+                time.sleep(0.05)
+            for handler in self.handlers:
+                handler.flush()
+                handler.close()
+
+
+def main():
+    # the entry of the collector process started by 'start_collector'
+    socket_path = sys.argv[1]
+    config = pickle.load(sys.stdin.buffer)
+    collector = LogCollector(socket_path, config, idle_exit=config.get("Basic", {}).get("AGGREGATE_IDLE_EXIT", 60))
+    if not collector.lock():
+        return
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    collector.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+"""
+The asyncio front-end for CPXLogger ASYNCIO mode, for the services running in an event loop like aiohttp and
+FastAPI. All the handlers created by CPXLogger are put behind one CPXAsyncioHandler, the log calling in the
+loop only puts the record into an asyncio queue, and a writer task hands the records to the real handlers in
+batches, by a bounded thread pool, so the file and database I/O never blocks the loop.
+
+The handler binds to the running loop of the first log calling in a loop. The records logged by the other
+threads are put into the queue by 'call_soon_threadsafe', and the records logged when there is no bound loop
+are handled in the calling thread like the normal handlers.
+
+    await CPXLogger.aflush()
+    await CPXLogger.aclose()
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from pcpxlog.cpxStats import HandlerStats
+from pcpxlog.cpxUtils import RECORD_TEMPLATE_ATTR, record_message
+
+
+class CPXAsyncioHandler(logging.Handler):
+    """
+    The handler puts records into the asyncio queue without blocking, the new records are dropped when the
+    queue is full. The writer task takes out all the records in the queue, up to 'batch_size', and handles
+    them in the thread pool, so the records logged when the pool is busy are handled in the next batch.
+    """
+
+    def __init__(self, *real_handlers, queue_size=10000, batch_size=500, max_workers=1):
+        """
+        :param real_handlers: the handlers the records are dispatched to, by their levels
+        :param queue_size: the max count of records waiting in the queue
+        :param batch_size: the max count of records handled in one calling of the thread pool
+        :param max_workers: the count of threads in the pool, 1 keeps the records in order
+        """
+        logging.Handler.__init__(self)
+        assert int(batch_size) > 0, ValueError("The value out of range for Param batch_size")
+        self.handlers = list(real_handlers)
+        self.queueSize = int(queue_size)
+        self.batchSize = int(batch_size)
+        self.cpxStats = HandlerStats()
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="CPXLog-asyncio")
+        self.__exc_formatter = logging.Formatter()
+        self.__loop = None
+        self.__queue = None
+        self.__writer = None
+        # the real handlers are closed once, by 'aclose' or 'close'
+        self.__handlersClosed = False
+
+    def prepare(self, record):
+        """
+        Merge the args into the message and cache the traceback text, like 'CPXQueueHandler.prepare'.
+        """
+        if record.args:
+            record.__dict__.setdefault(RECORD_TEMPLATE_ATTR, record.msg)
+        record.msg = record_message(record)
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.__exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def __handle_batch(self, batch):
+        # called in the thread pool, dispatch the records like 'Logger.callHandlers'
+        for record in batch:
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    def __bind_loop(self, loop):
+        """
+        Create the queue and start the writer task in the loop, the records left in the queue of the closed
+        loop are handled first.
+        """
+        self.__drain()
+        self.__loop = loop
+        self.__queue = asyncio.Queue(maxsize=self.queueSize)
+        self.__writer = loop.create_task(self.__writer_loop())
+
+    async def __writer_loop(self):
+        """
+        The writer task, handle the records in the queue batch by batch.
+        """
+        while True:
+            batch = [await self.__queue.get()]
+            while len(batch) < self.batchSize and not self.__queue.empty():
+                batch.append(self.__queue.get_nowait())
+            try:
+                await self.__loop.run_in_executor(self.__executor, self.__handle_batch, batch)
+            except Exception:
+                for _ in batch:
+                    self.cpxStats.count_failed()
+            finally:
+                for _ in batch:
+                    self.__queue.task_done()
+
+    def __put(self, record):
+        # called in the loop thread
+        try:
+            self.__queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.cpxStats.count_dropped()
+
+    def __running_loop(self):
+        """
+        Get the bound loop if it is still running, bind the running loop of this thread if there is none.
+        :return: (loop, in_loop): the loop or None, and whether this thread is running it
+        """
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.__loop is None or self.__loop.is_closed():
+            if running_loop is None:
+                return None, False
+            self.__bind_loop(running_loop)
+        if not self.__loop.is_running():
+            return None, False
+        return self.__loop, running_loop is self.__loop
+
+    def emit(self, record):
+        """
+        Put the record into the queue of the bound loop, or handle it at once if there is no running loop.
+        """
+        try:
+            # the writer task is cancelled by 'aclose', nothing would take the record out of the queue
+            if self.__handlersClosed:
+                self.cpxStats.count_dropped()
+                return
+            loop, in_loop = self.__running_loop()
+            record = self.prepare(record)
+            if loop is None:
+                self.__handle_batch([record])
+            elif in_loop:
+                self.__put(record)
+            else:
+                loop.call_soon_threadsafe(self.__put, record)
+        except Exception:
+            self.handleError(record)
+
+    async def aflush(self):
+        """
+        Wait for all the records in the queue handled, and flush the real handlers in the thread pool.
+        """
+        if self.__queue is not None and self.__loop is asyncio.get_running_loop():
+            await self.__queue.join()
+        await asyncio.get_running_loop().run_in_executor(self.__executor, self.__flush_handlers)
+
+    def __flush_handlers(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    async def aclose(self):
+        """
+        Handle all the records in the queue, stop the writer task, and close the real handlers in the
+        thread pool.
+        """
+        await self.aflush()
+        if self.__writer is not None:
+            self.__writer.cancel()
+            self.__writer = None
+        await asyncio.get_running_loop().run_in_executor(self.__executor, self.__close_handlers)
+        self.__executor.shutdown(wait=False)
+        logging.Handler.close(self)
+
+    def __close_handlers(self):
+        if self.__handlersClosed:
+            return
+        self.__handlersClosed = True
+        for handler in self.handlers:
+            handler.close()
+
+    def __drain(self):
+        """
+        Handle the records left in the queue in this thread, only when the bound loop is not running.
+        """
+        if self.__queue is None or self.__loop.is_running():
+            return
+        batch = list()
+        while not self.__queue.empty():
+            batch.append(self.__queue.get_nowait())
+            self.__queue.task_done()
+        self.__handle_batch(batch)
+
+    def flush(self):
+        """
+        The sync flush, it does not wait for the writer task, use 'aflush' in the loop.
+        """
+        self.__drain()
+        self.__flush_handlers()
+
+    def close(self):
+        """
+        The sync close for the exit, the records left in the queue are handled if the loop is not running.
+        """
+        if self.__handlersClosed:
+            logging.Handler.close(self)
+            return
+        self.flush()
+        self.__close_handlers()
+        self.__executor.shutdown(wait=True)
+        logging.Handler.close(self)
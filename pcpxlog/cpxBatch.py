@@ -0,0 +1,147 @@
+"""
+The background batching writer shared by the handlers which save log data into a database.
+
+The handler puts the log data into a bounded queue in 'emit', and a background thread takes them out and
+saves them batch by batch. A batch will be saved when it has 'batch_size' log data, or it reach 'batch_bytes'
+bytes, or it has waited 'linger_ms' milliseconds.
+"""
+import queue
+import threading
+import time
+
+# the choices of what the batching writer do when the queue is full,
+# 'Block' will wait for the writer thread, 'Drop' will discard the new log data.
+QUEUE_FULL_POLICIES = ("Block", "Drop")
+
+# the sentinel put into the queue to stop the batching writer thread
+_STOP_WRITER = object()
+
+
+class BatchWriter:
+    """
+    The queue and the background thread saving log data in batches.
+    """
+
+    def __init__(self, save_batch, name="CPXLog-writer", batch_size=500, batch_bytes=1024 * 1024, linger_ms=200,
+                 queue_capacity=10000, queue_full_policy="Block", prepare=None, stats=None):
+        """
+        :param save_batch: the function saves a list of log data, it is called in the writer thread
+        :param name: the writer thread name
+        :param batch_size: the max count of log data in one batch
+        :param batch_bytes: the max size of log data in one batch
+        :param linger_ms: the max time a batch wait for more log data, in milliseconds
+        :param queue_capacity: the max count of log data waiting in the queue
+        :param queue_full_policy: 'Block' or 'Drop', what to do when the queue is full
+        :param prepare: the function called in the writer thread, it returns (log_data, size) for a log data
+        :param stats: the HandlerStats object to count the dropped log data
+        """
+        assert int(batch_size) > 0, ValueError("The value out of range for Param batch_size")
+        assert queue_full_policy in QUEUE_FULL_POLICIES, \
+            ValueError("The value must be one of %s for Param queue_full_policy" % (QUEUE_FULL_POLICIES,))
+        self.saveBatch = save_batch
+        self.batchSize = int(batch_size)
+        self.batchBytes = int(batch_bytes)
+        self.lingerTime = linger_ms / 1000
+        self.queueFullPolicy = queue_full_policy
+        self.prepare = prepare or (lambda log_data: (log_data, 0))
+        self.stats = stats
+        self.__queue = queue.Queue(maxsize=int(queue_capacity))
+        self.__thread = threading.Thread(target=self.__writer_loop, name=name, daemon=True)
+        self.__thread.start()
+
+    def __prepare(self, log_data):
+        """
+        Prepare the log data by self.prepare. The one can not be prepared, like a value bson can not encode,
+        is counted as failed and dropped, so it does not stop the writer thread.
+        :return: (log_data, size), or None if it is dropped
+        """
+        try:
+            return self.prepare(log_data)
+        except Exception:
+            if self.stats:
+                self.stats.count_failed()
+            self.__queue.task_done()
+            return None
+
+    def __next_batch(self, first_log_data):
+        """
+        Collect log data from the queue until the batch is full or the linger time is over.
+        :return: (batch, stop): the log data list, and whether the writer should stop after saving it
+        """
+        batch, batch_bytes = list(), 0
+        prepared = self.__prepare(first_log_data)
+        if prepared is not None:
+            batch.append(prepared[0])
+            batch_bytes += prepared[1]
+        deadline = time.monotonic() + self.lingerTime
+
+        while len(batch) < self.batchSize and batch_bytes < self.batchBytes:
+            remainder_time = deadline - time.monotonic()
+            if remainder_time <= 0:
+                break
+            try:
+                log_data = self.__queue.get(timeout=remainder_time)
+            except queue.Empty:
+                break
+            if log_data is _STOP_WRITER:
+                self.__queue.task_done()
+                return batch, True
+            prepared = self.__prepare(log_data)
+            if prepared is not None:
+                batch.append(prepared[0])
+                batch_bytes += prepared[1]
+
+        return batch, False
+
+    def __writer_loop(self):
+        """
+        The target of the background writer thread, save the log data in the queue batch by batch.
+        """
+        stop = False
+        while not stop:
+            log_data = self.__queue.get()
+            if log_data is _STOP_WRITER:
+                self.__queue.task_done()
+                break
+
+            batch, stop = self.__next_batch(log_data)
+            if not batch:
+                continue
+            try:
+                self.saveBatch(batch)
+            except Exception:
+                # the save_batch should deal its errors, keep the writer alive anyway
+                if self.stats:
+                    for _ in batch:
+                        self.stats.count_failed()
+            finally:
+                for _ in batch:
+                    self.__queue.task_done()
+
+    def put(self, log_data):
+        """
+        Put the log data into the queue, deal the full queue by self.queueFullPolicy
+        """
+        if self.queueFullPolicy == "Block":
+            self.__queue.put(log_data)
+        else:
+            try:
+                self.__queue.put_nowait(log_data)
+            except queue.Full:
+                if self.stats:
+                    self.stats.count_dropped()
+
+    def flush(self):
+        """
+        Wait for all the log data in the queue saved.
+        """
+        if self.__thread.is_alive():
+            self.__queue.join()
+
+    def close(self):
+        """
+        Stop the background writer thread after the queue is empty.
+        """
+        if self.__thread.is_alive():
+            self.__queue.put(_STOP_WRITER)
+            self.__thread.join()
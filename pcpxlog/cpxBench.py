@@ -0,0 +1,185 @@
+"""
+The throughput and latency benchmark for CPXLogger, it is the 'cpxBench' console script.
+
+Every scenario is a CPXLogger config, and runs in a new interpreter to measure its own peak RSS.
+It runs single threaded and multi threaded, with plain messages and with exceptions, then reports the
+records/sec, the p50/p99/p999 latency of one log calling and the peak RSS. The results are saved as json,
+so the results of different versions can be compared.
+
+    cpxBench --records 20000 --threads 4 --output cpxBench.json
+
+The mongodb scenarios need a local mongod, they are skipped when the '--mongo-uri' is not reachable.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SCENARIOS = ("console", "file", "rotating_file", "buffered_file", "mongodb", "mongodb_batch")
+MESSAGE_KINDS = ("plain", "exception")
+
+
+def create_config(scenario, log_dir, mongo_uri):
+    """
+    Create the CPXLogger config dict of the scenario.
+    """
+    basic = {"LEVEL": "DEBUG", "FORMAT": "[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d "
+                                         ":%(message)s"}
+    config = {"Basic": dict(basic)}
+    if scenario == "file":
+        config["File"] = dict(basic, TYPE="Ordinary", FILE_PATH=os.path.join(log_dir, "log"))
+    elif scenario == "rotating_file":
+        config["File"] = dict(basic, TYPE="Rotating", FILE_PATH=os.path.join(log_dir, "log"),
+                              MAX_BYTES=1024, BACKUP_COUNT=3)
+    elif scenario == "buffered_file":
+        config["File"] = dict(basic, TYPE="Buffered", FILE_PATH=os.path.join(log_dir, "log"),
+                              MAX_BYTES=1024 * 1024, BACKUP_COUNT=3)
+    elif scenario in ("mongodb", "mongodb_batch"):
+        config["Mongodb"] = dict(basic, URI=mongo_uri, DB="CPXLogBench", BATCH=scenario == "mongodb_batch")
+    return config
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+def peak_rss_kb():
+    """
+    Get the peak RSS of this process in KB, None if the platform not support.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # it is bytes on macOS and KB on linux
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss
+
+
+def log_many(logger, count, message_kind, latencies):
+    """
+    Call the logger count times, and save the latency of every calling in nanoseconds.
+    """
+    perf_counter_ns = time.perf_counter_ns
+    for index in range(count):
+        if message_kind == "plain":
+            start = perf_counter_ns()
+            logger.info("the request %d has been processed", index)
+            latencies.append(perf_counter_ns() - start)
+        else:
+            try:
+                raise ValueError("the request %d is wrong" % index)
+            except ValueError:
+                start = perf_counter_ns()
+                logger.exception("the request %d has failed", index)
+                latencies.append(perf_counter_ns() - start)
+
+
+def run_worker(job):
+    """
+    Run one scenario in this process, and return the result dict.
+    """
+    from pcpxlog import CPXLogger
+
+    with tempfile.TemporaryDirectory() as log_dir:
+        config = create_config(job["scenario"], log_dir, job["mongo_uri"])
+        CPXLogger.config_from_dict(config)
+        logger = CPXLogger.create_logger("cpxBench")
+
+        threads_count = job["threads"]
+        count = job["records"] // threads_count
+        latencies_list = [list() for _ in range(threads_count)]
+        threads = [threading.Thread(target=log_many, args=(logger, count, job["message"], latencies))
+                   for latencies in latencies_list]
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the batch handlers save the log data in background, wait for them
+        for handler in CPXLogger.handlers:
+            handler.flush()
+        total_time = time.perf_counter() - start
+
+        for handler in CPXLogger.handlers:
+            if hasattr(handler, "db"):
+                handler.client.drop_database(handler.db.name)
+        logging.shutdown()
+
+    latencies = sorted(latency for latencies in latencies_list for latency in latencies)
+    return dict(job, records=len(latencies), records_per_sec=len(latencies) / total_time,
+                p50_us=percentile(latencies, 50) / 1000, p99_us=percentile(latencies, 99) / 1000,
+                p999_us=percentile(latencies, 99.9) / 1000, peak_rss_kb=peak_rss_kb())
+
+
+def mongodb_reachable(mongo_uri):
+    try:
+        from pymongo import MongoClient
+
+        client = MongoClient(mongo_uri, serverSelectionTimeoutMS=500)
+        client.admin.command("ping")
+        client.close()
+        return True
+    except Exception:
+        return False
+
+
+def run_job(job):
+    """
+    Run the job in a new interpreter, the console output of the logger is discarded.
+    """
+    ret = subprocess.run([sys.executable, "-m", "pcpxlog.cpxBench", "--worker", json.dumps(job)],
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True)
+    return json.loads(ret.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="cpxBench", description="The throughput and latency benchmark of CPXLogger")
+    parser.add_argument("--records", type=int, default=20000, help="the count of records in every run")
+    parser.add_argument("--threads", type=int, default=4, help="the count of threads in the multi threaded run")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--mongo-uri", default="mongodb://127.0.0.1:27017/")
+    parser.add_argument("--output", default="cpxBench.json", help="the json file to save the results")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(json.loads(args.worker))))
+        return
+
+    results = list()
+    print("%-14s %-10s %7s %12s %10s %10s %10s %10s" % (
+        "scenario", "message", "threads", "records/sec", "p50(us)", "p99(us)", "p999(us)", "rss(KB)"))
+    for scenario in args.scenarios:
+        if scenario.startswith("mongodb") and not mongodb_reachable(args.mongo_uri):
+            print("%-14s skipped, the mongodb '%s' is not reachable" % (scenario, args.mongo_uri))
+            continue
+        for threads_count in sorted({1, args.threads}):
+            for message_kind in MESSAGE_KINDS:
+                result = run_job(dict(scenario=scenario, message=message_kind, threads=threads_count,
+                                      records=args.records, mongo_uri=args.mongo_uri))
+                results.append(result)
+                print("%-14s %-10s %7d %12.0f %10.1f %10.1f %10.1f %10s" % (
+                    scenario, message_kind, threads_count, result["records_per_sec"], result["p50_us"],
+                    result["p99_us"], result["p999_us"], result["peak_rss_kb"]))
+
+    report = dict(created_time=datetime.datetime.now().isoformat(), python=sys.version,
+                  platform=platform.platform(), results=results)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("The results have been saved in %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
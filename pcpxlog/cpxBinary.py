@@ -0,0 +1,298 @@
+"""
+The compact binary log file, its sparse time index, the reader and the converter to text lines.
+
+Every record in the file is a bson document, which begins with its int32 little-endian length, so the file is
+a sequence of length-prefixed records. The first document of a file is the header, it keeps the format string
+of the handler, so the converter can give back the text lines, and the field names of the records:
+'created', the fields used by the format string and the 'extra_fields', 'exc_text' and 'stack_info'. To keep
+the records compact, their keys are the positions of the field names in the header, like {"0": created, ...},
+the None values are not saved, and 'asctime' is not saved, it is formatted again from 'created'.
+
+The index file '<filename>.idx' is a sequence of (created, offset) entries, 8 bytes double and 8 bytes unsigned
+int, little-endian. It has one entry every 'index_interval' records, and it is written after the records it
+points to, so a reader never finds an offset out of the data file.
+
+    cpxBinaryToText ./logs/log.bin --start 2019-06-12T10:00 --end 2019-06-12T11:00 --output log.txt
+"""
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+
+import bson
+
+from pcpxlog.cpxFile import BufferedRotatingFileHandler
+from pcpxlog.cpxUtils import compile_format_fields, record_message, to_timestamp
+
+INDEX_ENTRY = struct.Struct("<dQ")
+BSON_LENGTH = struct.Struct("<i")
+# the key of the header document, its value is the version of the format
+HEADER_KEY = "cpxlog_binary"
+FORMAT_VERSION = 1
+FORMAT_STYLES = {logging.PercentStyle: "%", logging.StrFormatStyle: "{", logging.StringTemplateStyle: "$"}
+# the fields formatted again from 'created' by the converter
+_TIME_FIELDS = ("asctime", "msecs")
+
+
+class BinaryLogFileHandler(BufferedRotatingFileHandler):
+    """
+    The handler writes the records into the binary log file, with the buffer of 'BufferedRotatingFileHandler'.
+    The file is rotated like 'RotatingFileHandler' by 'maxBytes' and 'backupCount', and the index files are
+    rotated with it, '<filename>.<index>.idx' for '<filename>.<index>'. The rotated files are not compressed,
+    so the reader can mmap them.
+    """
+
+    def __init__(self, filename, mode="a", maxBytes=0, backupCount=0, delay=False, buffer_bytes=64 * 1024,
+                 flush_interval=1.0, flush_level=logging.ERROR, index_interval=512, extra_fields=()):
+        """
+        :param index_interval: write an index entry every this count of records
+        :param extra_fields: the names of custom attributes from 'extra=', which should be saved too
+        """
+        assert int(index_interval) > 0, ValueError("The value out of range for Param index_interval")
+        self.indexInterval = int(index_interval)
+        self.indexPath = os.path.abspath(filename) + ".idx"
+        self.extraFields = tuple(extra_fields)
+        self.__indexEntries = list()
+        self.__recordsCount = 0
+        self.__lastCreated = 0
+        # [(key, field name)], compiled from the formatter for the header of the file
+        self.__fields = None
+        BufferedRotatingFileHandler.__init__(self, filename, mode=mode, maxBytes=maxBytes, backupCount=backupCount,
+                                             delay=delay, buffer_bytes=buffer_bytes, flush_interval=flush_interval,
+                                             flush_level=flush_level)
+
+    def __compile_fields(self):
+        """
+        Get the field names of the records from self.formatter, they are kept in the header of every new file.
+        """
+        fields = compile_format_fields(self.formatter or logging.Formatter(), self.extraFields)
+        fields = ("created",) + tuple(field for field in fields if field not in _TIME_FIELDS + ("created",)) + \
+            ("exc_text", "stack_info")
+        self.__fields = [(str(position), field) for position, field in enumerate(fields)]
+
+    def __header(self):
+        """
+        Get the bson header document, it keeps the format of self.formatter and the field names.
+        """
+        self.__compile_fields()
+        formatter = self.formatter or logging.Formatter()
+        return bson.encode({HEADER_KEY: FORMAT_VERSION, "format": formatter._style._fmt,
+                            "datefmt": formatter.datefmt, "style": FORMAT_STYLES.get(type(formatter._style), "%"),
+                            "fields": [field for _, field in self.__fields]})
+
+    def encode_record(self, record):
+        """
+        Get the bson document of the record, without formatting it.
+        """
+        if self.__fields is None:
+            self.__compile_fields()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = (self.formatter or logging.Formatter()).formatException(record.exc_info)
+
+        record2dict = record.__dict__
+        log_data = dict()
+        for key, field in self.__fields:
+            value = record_message(record) if field == "message" else record2dict.get(field)
+            if value is not None:
+                log_data[key] = value
+        self.__lastCreated = record.created
+        return bson.encode(log_data)
+
+    def write(self, data):
+        """
+        Put the header before the first record of the file, and add an index entry every self.indexInterval
+        records.
+        """
+        if self.tell() == 0:
+            BufferedRotatingFileHandler.write(self, self.__header())
+            self.__recordsCount = 0
+        if self.__recordsCount % self.indexInterval == 0:
+            self.__indexEntries.append(INDEX_ENTRY.pack(self.__lastCreated, self.tell()))
+        self.__recordsCount += 1
+        BufferedRotatingFileHandler.write(self, data)
+
+    def flush(self):
+        """
+        Write the buffer into the data file, and then the index entries of it into the index file.
+        """
+        self.acquire()
+        try:
+            BufferedRotatingFileHandler.flush(self)
+            if self.__indexEntries:
+                with open(self.indexPath, "ab") as f:
+                    f.write(b"".join(self.__indexEntries))
+                self.__indexEntries.clear()
+        finally:
+            self.release()
+
+    def doRollover(self):
+        """
+        Rotate the index files, and then the data files.
+        """
+        self.flush()
+        if self.backupCount > 0:
+            for index in range(self.backupCount - 1, 0, -1):
+                index_path = "%s.%d.idx" % (self.baseFilename, index)
+                if os.path.exists(index_path):
+                    os.replace(index_path, "%s.%d.idx" % (self.baseFilename, index + 1))
+            if os.path.exists(self.indexPath):
+                os.replace(self.indexPath, "%s.1.idx" % self.baseFilename)
+        BufferedRotatingFileHandler.doRollover(self)
+
+
+class BinaryLogReader:
+    """
+    Read the binary log file by mmap. The time range is found by the binary search in the index, so only the
+    records from the nearest index entry are decoded.
+
+    The records are nearly in time order, the records of different threads may be a little out of order, so
+    the records around the bounds of the time range may be missed by some microseconds.
+    """
+
+    def __init__(self, path, index_path=None):
+        """
+        :param path: the binary log file path
+        :param index_path: the index file path, '<path>.idx' by default
+        """
+        self.path = path
+        self.indexPath = index_path or path + ".idx"
+        self.__data = self.__map(self.path)
+        self.__index = self.__map(self.indexPath) if os.path.exists(self.indexPath) else b""
+        # the last index entry may be written partly
+        self.__indexCount = len(self.__index) // INDEX_ENTRY.size
+
+        self.header = dict()
+        self.__dataStart = 0
+        if len(self.__data) >= BSON_LENGTH.size:
+            length, = BSON_LENGTH.unpack_from(self.__data, 0)
+            first_document = bson.decode(self.__data[:length])
+            if HEADER_KEY in first_document:
+                self.header = first_document
+                self.__dataStart = length
+        # {key: field name}
+        self.__fields = {str(position): field for position, field in enumerate(self.header.get("fields", ()))}
+
+    @staticmethod
+    def __map(path):
+        with open(path, "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __index_entry(self, position):
+        return INDEX_ENTRY.unpack_from(self.__index, position * INDEX_ENTRY.size)
+
+    def __seek_time(self, start):
+        """
+        Binary search the last index entry before the start time.
+        :return: offset: the offset of the record to read from
+        """
+        low, high = 0, self.__indexCount
+        while low < high:
+            middle = (low + high) // 2
+            if self.__index_entry(middle)[0] < start:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return self.__dataStart
+        return max(self.__dataStart, self.__index_entry(low - 1)[1])
+
+    def __iter_documents(self, offset):
+        data, data_size = self.__data, len(self.__data)
+        while offset + BSON_LENGTH.size <= data_size:
+            length, = BSON_LENGTH.unpack_from(data, offset)
+            # the last record may be written partly
+            if length < BSON_LENGTH.size or offset + length > data_size:
+                return
+            document = bson.decode(data[offset:offset + length])
+            yield {self.__fields.get(key, key): value for key, value in document.items()}
+            offset += length
+
+    def iter_records(self, start=None, end=None):
+        """
+        Give back the log data dicts in the time range [start, end).
+        :param start: the start time, a timestamp, a datetime object or an ISO format string
+        :param end: the end time, not included
+        """
+        start, end = to_timestamp(start), to_timestamp(end)
+        offset = self.__seek_time(start) if start is not None else self.__dataStart
+        for log_data in self.__iter_documents(offset):
+            created = log_data.get("created", 0)
+            if start is not None and created < start:
+                continue
+            if end is not None and created >= end:
+                return
+            yield log_data
+
+    def close(self):
+        for mapped in (self.__data, self.__index):
+            if isinstance(mapped, mmap.mmap):
+                mapped.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def log_data_to_record(log_data):
+    """
+    Create a log record object from the log data dict, for formatting it again.
+    """
+    record = logging.makeLogRecord(log_data)
+    record.msg = log_data.get("message", "")
+    record.args = None
+    created = log_data.get("created", 0)
+    if "msecs" not in log_data:
+        record.msecs = (created - int(created)) * 1000
+    return record
+
+
+def convert_to_text(reader, output, format_str=None, datefmt=None, start=None, end=None):
+    """
+    Write the records of the binary log file as text lines, by the format of the header or format_str.
+    :return: count: the count of lines written
+    """
+    style = "%"
+    if not format_str:
+        format_str = reader.header.get("format") or "%(message)s"
+        datefmt = datefmt or reader.header.get("datefmt")
+        style = reader.header.get("style", "%")
+    formatter = logging.Formatter(format_str, datefmt, style=style)
+
+    count = 0
+    for log_data in reader.iter_records(start=start, end=end):
+        output.write(formatter.format(log_data_to_record(log_data)) + "\n")
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="cpxBinaryToText", description="Convert the binary log file to text")
+    parser.add_argument("path", help="the binary log file path")
+    parser.add_argument("--output", help="the text file path, print the lines if not set")
+    parser.add_argument("--format", help="the format string, the format of the handler by default")
+    parser.add_argument("--datefmt")
+    parser.add_argument("--start", help="the start time, an ISO format string or a timestamp")
+    parser.add_argument("--end", help="the end time, not included")
+    args = parser.parse_args()
+
+    with BinaryLogReader(args.path) as reader:
+        output = open(args.output, "w") if args.output else sys.stdout
+        try:
+            convert_to_text(reader, output, format_str=args.format, datefmt=args.datefmt,
+                            start=to_timestamp(args.start), end=to_timestamp(args.end))
+        except BrokenPipeError:
+            # the output is piped into a command like 'head'
+            sys.stderr.close()
+        finally:
+            if args.output:
+                output.close()
+
+
+if __name__ == "__main__":
+    main()
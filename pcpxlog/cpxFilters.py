@@ -0,0 +1,224 @@
+"""
+The filters dropping records before they are formatted and saved, for the records storm in incidents.
+
+All of them only read the attributes of the record which are ready when it is created, like 'levelno', 'msg'
+and 'created', so a dropped record costs almost nothing. They can be added to the handlers by the keys of a
+handler config section, and to the logger created by 'CPXLogger.create_logger' by the same keys with the
+prefix 'LOGGER_' in the Basic config section:
+
+    SAMPLE_RATES: {level name: the probability to keep the record}, like {"DEBUG": 0.01, "INFO": 0.1}
+    RATE_LIMIT: the records per second allowed by a token bucket, RATE_BURST is the bucket size
+    DEDUPE_WINDOW: the seconds the same records are collapsed into one
+"""
+import logging
+import random
+import threading
+import time
+
+from pcpxlog.cpxUtils import RECORD_CACHE_ATTR, record_template
+
+# the config keys of the filters, and the prefix of them in the Basic config section for the logger
+FILTER_KEYS = ("SAMPLE_RATES", "RATE_LIMIT", "RATE_BURST", "DEDUPE_WINDOW")
+LOGGER_FILTER_PREFIX = "LOGGER_"
+# the record attributes set by formatting it
+_FORMATTED_ATTRS = ("message", "asctime", RECORD_CACHE_ATTR)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keep the records of a level by its probability, the levels not in the rates are always kept.
+    """
+
+    def __init__(self, sample_rates):
+        """
+        :param sample_rates: {level name or level number: the probability in [0, 1]}
+        """
+        logging.Filter.__init__(self)
+        self.sampleRates = dict()
+        for level, rate in sample_rates.items():
+            level = getattr(logging, level) if isinstance(level, str) else level
+            assert 0 <= rate <= 1, ValueError("The sample rate out of range for level %s" % level)
+            self.sampleRates[level] = rate
+        self.__random = random.random
+
+    def filter(self, record):
+        rate = self.sampleRates.get(record.levelno)
+        return rate is None or rate >= 1 or self.__random() < rate
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    The token bucket filter, the bucket is filled with 'rate' tokens every second up to 'burst' tokens, and
+    every kept record takes one token.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: the records per second allowed
+        :param burst: the max count of records allowed at once, it is the same as rate by default
+        """
+        logging.Filter.__init__(self)
+        assert rate > 0, ValueError("The value out of range for Param rate")
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.__tokens = self.burst
+        self.__updateTime = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def filter(self, record):
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.burst, self.__tokens + (now - self.__updateTime) * self.rate)
+            self.__updateTime = now
+            if self.__tokens < 1:
+                return False
+            self.__tokens -= 1
+            return True
+
+
+class DedupeFilter(logging.Filter):
+    """
+    Collapse the same records, whose (pathname, lineno, msg) are the same, in every 'window' seconds into one.
+    The first one of a window is kept, the others in the window are dropped and counted. Every kept record has
+    the 'repeated' attribute, 0 if nothing dropped before it, so it can be formatted by '%(repeated)s' or saved
+    by 'EXTRA_FIELDS'.
+
+    The count of a window is reported when the window expires: a background thread creates the summary record,
+    the first record of the window with ' [repeated N times]' after its message and N as 'repeated', and passes
+    it to the 'report' function, like 'handler.handle', which CPXLogger sets for the filters it creates. If the
+    'report' is None, the count is carried by the first same record of the next window instead.
+
+    The 'msg' is the message before merging the args, so the records logged by the same calling with different
+    args are the same. In the ASYNC, ASYNCIO and AGGREGATE modes the args are merged before the records come
+    to the handlers, and the 'msg' before merging is kept in the 'cpxMsgTemplate' attribute for it. The 'msg'
+    which can not be hashed is compared by its str.
+    """
+    # the attribute of the summary records, they are not filtered again
+    SUMMARY_ATTR = "cpxDedupeSummary"
+
+    def __init__(self, window, max_keys=10000, report=None):
+        """
+        :param window: the seconds of a window
+        :param max_keys: the max count of different records remembered, the expired ones are removed when
+            there are too many of them
+        :param report: the function to handle the summary records, None for carrying the count by the next one
+        """
+        logging.Filter.__init__(self)
+        assert window > 0, ValueError("The value out of range for Param window")
+        self.window = window
+        self.maxKeys = int(max_keys)
+        self.report = report
+        # {(pathname, lineno, msg): [window end time, dropped count, the first record of the window]}
+        self.__windows = dict()
+        self.__lock = threading.Lock()
+        self.__reporter = None
+
+    def __summary(self, window):
+        """
+        Create the summary record of the expired window from its first record.
+        """
+        first_record, dropped = window[2], window[1]
+        # the message and the lines formatted for the first record are not copied
+        summary = logging.makeLogRecord({key: value for key, value in first_record.__dict__.items()
+                                         if key not in _FORMATTED_ATTRS})
+        try:
+            message = first_record.getMessage()
+        except Exception:
+            message = str(first_record.msg)
+        summary.msg = "%s [repeated %d times]" % (message, dropped)
+        summary.args = None
+        summary.repeated = dropped
+        summary.created = window[0]
+        summary.msecs = (window[0] - int(window[0])) * 1000
+        summary.__dict__[self.SUMMARY_ATTR] = True
+        return summary
+
+    def __pop_expired(self, now):
+        """
+        Remove the expired windows.
+        :return: summaries: the summary records of the removed windows which dropped some records
+        """
+        summaries = list()
+        for key in [key for key, window in self.__windows.items() if window[0] <= now]:
+            window = self.__windows.pop(key)
+            if window[1] and self.report is not None:
+                summaries.append(self.__summary(window))
+        return summaries
+
+    def __report(self, summaries):
+        for summary in summaries:
+            try:
+                self.report(summary)
+            except Exception:
+                pass
+
+    def __start_reporter(self):
+        # called with the lock held, only when a record is dropped
+        if self.__reporter is None and self.report is not None:
+            self.__reporter = threading.Thread(target=self.__reporter_loop, name="CPXLog-dedupe-reporter",
+                                               daemon=True)
+            self.__reporter.start()
+
+    def __reporter_loop(self):
+        """
+        Report the expired windows every self.window seconds, and exit when no window is dropping records.
+        """
+        while True:
+            time.sleep(self.window)
+            with self.__lock:
+                summaries = self.__pop_expired(time.time())
+                if not any(window[1] for window in self.__windows.values()):
+                    self.__reporter = None
+            self.__report(summaries)
+            if self.__reporter is None:
+                return
+
+    def filter(self, record):
+        if record.__dict__.get(self.SUMMARY_ATTR):
+            return True
+        msg = record_template(record)
+        key = (record.pathname, record.lineno, msg)
+        try:
+            hash(key)
+        except TypeError:
+            key = (record.pathname, record.lineno, str(msg))
+        now = record.created
+        summaries = ()
+        with self.__lock:
+            window = self.__windows.get(key)
+            if window is not None and now < window[0]:
+                window[1] += 1
+                self.__start_reporter()
+                return False
+
+            record.repeated = 0
+            if window is not None and window[1]:
+                # the expired window is not reported by the background thread yet
+                if self.report is None:
+                    record.repeated = window[1]
+                else:
+                    summaries = [self.__summary(window)]
+            if window is None and len(self.__windows) >= self.maxKeys:
+                summaries = self.__pop_expired(now)
+            # the first record is only kept for the summary record
+            self.__windows[key] = [now + self.window, 0, record if self.report is not None else None]
+        self.__report(summaries)
+        return True
+
+
+def create_filters(config, prefix=""):
+    """
+    Pop the filter keys from the config, and create the filters by them.
+    :param config: the config section dict
+    :param prefix: the prefix of the keys, 'LOGGER_' for the filters of the logger in the Basic config section
+    :return: filters: the list of filters, in the order of sampling, collapsing and rate limiting
+    """
+    options = {key: config.pop(prefix + key, None) for key in FILTER_KEYS}
+    filters = list()
+    if options["SAMPLE_RATES"]:
+        filters.append(SampleFilter(options["SAMPLE_RATES"]))
+    if options["DEDUPE_WINDOW"]:
+        filters.append(DedupeFilter(options["DEDUPE_WINDOW"]))
+    if options["RATE_LIMIT"]:
+        filters.append(RateLimitFilter(options["RATE_LIMIT"], options["RATE_BURST"]))
+    return filters
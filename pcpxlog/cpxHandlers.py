@@ -1,8 +1,20 @@
 import logging
 import datetime
+import hashlib
+import threading
+import time
+import zlib
 import bson
+from urllib.parse import quote_plus
 
-from pymongo import MongoClient
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, ReturnDocument, ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError, CollectionInvalid, BulkWriteError
+
+from pcpxlog.cpxBatch import BatchWriter
+from pcpxlog.cpxSpool import DiskSpool
+from pcpxlog.cpxStats import HandlerStats
+from pcpxlog.cpxUtils import RecordFieldsMixin, SharedClients, compile_format_fields
 
 # the max size of single collection is 16MB.
 # So we set the MONGODB_COLL_MAX_SIZE = 15MB to keep safe
@@ -11,8 +23,61 @@ MONGODB_COLL_MAX_SIZE = 1024 * 1024 * 15
 # So we set the MONGODB_COLL_MAX_COUNT = 11000 to keep safe
 MONGODB_COLL_MAX_COUNT = 11000
 
+# the choices of how to store log data:
+# 'Rotating' rotates 'logs_<createTime>' collections by size and records them in 'logSavingState',
+# 'Capped' uses one native capped collection sized coll_size * coll_count,
+# 'Timed' uses one collection every hour or day, and keeps the latest coll_count of them.
+STORAGE_TYPES = ("Rotating", "Capped", "Timed")
+# the name format and the length of a time bucket for 'Timed' storage
+TIME_BUCKETS = {
+    "Hour": ("%Y%m%d_%H", datetime.timedelta(hours=1)),
+    "Day": ("%Y%m%d", datetime.timedelta(days=1)),
+}
+
+# the fields saved once in the '<coll_name>_tracebacks' collection when the tracebacks are interned, the log data
+# keeps the hash of the text as '<field>_ref'
+INTERNED_FIELDS = ("exc_text", "stack_info")
+INTERNED_REF_SUFFIX = "_ref"
+TRACEBACK_COLL_SUFFIX = "_tracebacks"
+# the first key of the spooled traceback entries, {"cpxlog_traceback": hash, "text": text}, they are spooled
+# before the log data referring them, and saved before them when replaying
+SPOOLED_TRACEBACK_KEY = "cpxlog_traceback"
+# the bytes of a bson document from its 4th byte, when its first element is the spooled traceback hash
+_SPOOLED_TRACEBACK_PREFIX = b"\x05" + SPOOLED_TRACEBACK_KEY.encode() + b"\x00"
+# the key of the zlib compressed message in the log data
+COMPRESSED_MESSAGE_KEY = "message_z"
+# the max count of the traceback hashes remembered as saved
+_KNOWN_TRACEBACKS_MAX = 10000
+# the counts of log data every minute are saved into '<coll_name>_rollups', which is never rotated
+ROLLUP_COLL_SUFFIX = "_rollups"
+ROLLUP_SPAN = 60
+# the max count of rollup keys waiting in memory, when mongodb can not be reached
+_PENDING_ROLLUPS_MAX = 100000
+
+
+def traceback_hash(text):
+    """
+    Get the 16 bytes content hash of the traceback text, it is the '_id' in the tracebacks collection.
+    """
+    return hashlib.blake2b(text.encode("utf-8", "backslashreplace"), digest_size=16).digest()
+
+
+# the MongoClient objects shared by handlers with the same uri and options. The client is created
+# with 'connect=False', so it connects to mongodb server when the first operation happens.
+MONGO_CLIENTS = SharedClients(lambda uri, **options: MongoClient(uri, connect=False, **options),
+                              lambda client: client.close())
+
+
+def create_mongodb_uri(host, port, user=None, password=None):
+    """
+    Create the mongodb connection uri, the user and password are quoted.
+    """
+    if user or password:
+        return 'mongodb://%s:%s@%s:%s/' % (quote_plus(user or ""), quote_plus(password or ""), host, port)
+    return 'mongodb://%s:%s/' % (host, port)
 
-class RotatingMongodbHandler(logging.Handler):
+
+class RotatingMongodbHandler(RecordFieldsMixin, logging.Handler):
     """
     The handler class, helping save log information into mongodb.
     The default name of database will be 'CPXLog' and every collection will be named 'log_<createTime>'.
@@ -42,6 +107,53 @@ class RotatingMongodbHandler(logging.Handler):
 
          }
 
+    The handler only caches the name of the current log collection in memory. The 'current_size' is
+    counted by '$inc' in mongodb, and 'history_log_coll' is only changed by '$push' and '$pop' when
+    rotating, so many processes with the same tag can share one rotation chain safely.
+
+    The 'storage' can change the way above. 'Capped' saves all log data into one native capped collection
+    named <coll_name>, whose size is coll_size * coll_count, and mongodb removes the oldest log data itself.
+    'Timed' saves log data into '<coll_name>_<bucketTime>' collections, one every hour or day, and a
+    background thread drops the collections older than the latest coll_count buckets. Both of them never
+    touch the 'logSavingState' collection when saving log data.
+
+    The circuit breaker is open after 'breaker_threshold' saving failures one after another, then the log data
+    is appended into the local 'spool_path' file without connecting mongodb, or dropped if no spool file.
+    A background thread pings mongodb every 'breaker_cooldown' seconds, when it is reachable again, the spooled
+    log data is replayed by 'save_many' in batches, so the rotation is still counted, and the breaker is closed.
+
+    If 'batch' is True, the 'emit' method only put the parsed log data into a bounded queue, and a
+    background thread take them out and save them with 'insert_many'. A batch will be saved when it
+    has 'batch_size' log data, or it reach 'batch_bytes' bytes, or it has waited 'linger_ms' milliseconds.
+    The 'flush' and 'close' methods will wait for all the log data in the queue saved.
+
+    If 'intern_tracebacks' is True, every distinct 'exc_text' and 'stack_info' is saved once into the
+    '<coll_name>_tracebacks' collection, whose '_id' is the 16 bytes blake2b hash of the text, and the log data
+    keeps the hash as 'exc_text_ref' and 'stack_info_ref'. The new tracebacks are saved before the log data
+    referring them. The tracebacks collection is not rotated, it grows with the count of distinct tracebacks.
+    When the log data is spooled, the new tracebacks it refers are spooled before it, so they are saved by the
+    replaying too, even after a restart.
+    If 'compress_threshold' is set, the 'message' of this count of bytes or more is saved as 'message_z', the
+    zlib compressed bytes. 'CPXLogReader' gives back both of them.
+
+    If 'rollup' is True, the log data is counted by (minute, levelname, name) in memory, and by the
+    'pathname:lineno' too if 'rollup_lines' is True. The counts are added into the '<coll_name>_rollups'
+    collection by one bulk of '$inc' upserts, at most once every 'rollup_interval' seconds, with the saving of
+    the log data, and at 'flush' and 'close'. The rollup documents are like this:
+
+        {
+            _id: ObjectId(<id_auto_created>),
+            minute: ISODate(<the start of the minute>),
+            levelname: <levelname>,
+            name: <logger name>,
+            line: <pathname>:<lineno>, (only for 'rollup_lines')
+            count: N,
+        }
+
+    The rollup collection is not rotated, so the counts outlive the log collections, and the documents older
+    than 'rollup_expire' seconds are removed by a TTL index if it is set. 'CPXLogReader.rollups' reads them
+    as the time series.
+
     """
 
     def __create_coll_name(self):
@@ -55,49 +167,135 @@ class RotatingMongodbHandler(logging.Handler):
         """
         Set the value for self.__dbStateColl object, and try to init the state of log saving.
         Then set the value for self.__logDataColl object.
+
+        The state is inserted by an upsert on the unique 'tag', so several processes start with
+        the same rotation chain.
         """
         self.__dbStateColl = self.db[self.__stateCollName]
-
-        log_saving_state = self.__dbStateColl.find_one(dict(tag=self.__handlerTag))
-        if log_saving_state:
-            self.__logsStateID = log_saving_state["_id"]
-        else:
-            log_saving_state = dict(
-                tag=self.__handlerTag,
-                coll_size=self.collSize,
-                coll_remainder_count=self.collCount - 1,
-                history_log_coll=list(),
-                current_log_coll=dict(
-                    name=self.__create_coll_name(),
-                    current_size=0,
-                )
+        self.__dbStateColl.create_index("tag", unique=True)
+
+        init_log_saving_state = dict(
+            coll_size=self.collSize,
+            coll_remainder_count=self.collCount - 1,
+            history_log_coll=list(),
+            current_log_coll=dict(
+                name=self.__create_coll_name(),
+                current_size=0,
             )
-            ret = self.__dbStateColl.insert_one(log_saving_state)
-            self.__logsStateID = ret.inserted_id
+        )
+        try:
+            self.__dbStateColl.update_one(filter=dict(tag=self.__handlerTag),
+                                          update={"$setOnInsert": init_log_saving_state}, upsert=True)
+        except DuplicateKeyError:
+            # another process inserted the state at the same time
+            pass
+
+        log_saving_state = self.__dbStateColl.find_one(dict(tag=self.__handlerTag),
+                                                       projection={"current_log_coll.name": 1})
+        self.__logsStateID = log_saving_state["_id"]
 
         # create the current log collection cursor
-        self.__logDataColl = self.db[log_saving_state["current_log_coll"]["name"]]
+        self.__set_current_coll(log_saving_state["current_log_coll"]["name"])
+
+    def __set_current_coll(self, name):
+        """
+        Cache the name and the cursor of the current log collection in this process, and create the query
+        indexes when the log collection is opened first time in this process.
+        """
+        if name != self.__currentCollName:
+            self.__create_query_indexes(self.db[name])
+        self.__currentCollName = name
+        self.__logDataColl = self.db[name]
+
+    def __create_query_indexes(self, log_data_coll):
+        """
+        Create the '(<field>, _id)' indexes for the fields in self.indexFields which are saved, so the queries
+        of 'CPXLogReader' filtered by them and a time range are served by indexes. The '_id' is an ObjectId
+        created when the log is emitted, so it is the time of the log too.
+        """
+        if self.formatter:
+            saved_fields = compile_format_fields(self.formatter, self.extraFields)
+        else:
+            saved_fields = self.indexFields
+        try:
+            for field in self.indexFields:
+                if field in saved_fields:
+                    log_data_coll.create_index([(field, ASCENDING), ("_id", ASCENDING)])
+        except Exception as e:
+            # saving log data is more important than the indexes
+            self.send_email(e)
+
+    def __reload_current_coll(self):
+        """
+        Another process has rotated the current log collection, read the name of the new one.
+        """
+        log_saving_state = self.__dbStateColl.find_one({"_id": self.__logsStateID},
+                                                       projection={"current_log_coll.name": 1})
+        self.__set_current_coll(log_saving_state["current_log_coll"]["name"])
 
     def __init__(self, host="127.0.0.1", port=27017, user=None, password=None, db="CPXLog", coll_name="logs",
-                 coll_size=MONGODB_COLL_MAX_SIZE, coll_count=MONGODB_COLL_MAX_COUNT):
+                 coll_size=MONGODB_COLL_MAX_SIZE, coll_count=MONGODB_COLL_MAX_COUNT, batch=False,
+                 batch_size=500, batch_bytes=1024 * 1024, linger_ms=200, queue_capacity=10000,
+                 queue_full_policy="Block", extra_fields=(), storage="Rotating", bucket="Day",
+                 sweep_interval=60, uri=None, max_pool_size=100, connect_timeout_ms=20000,
+                 server_selection_timeout_ms=30000, socket_timeout_ms=None, breaker_threshold=3,
+                 breaker_cooldown=10, spool_path=None, spool_max_bytes=64 * 1024 * 1024, replay_batch_size=500,
+                 replay_interval_ms=100, index_fields=("levelname", "name"), intern_tracebacks=False,
+                 compress_threshold=0, rollup=False, rollup_lines=False, rollup_interval=10, rollup_expire=0):
         """
-        Connect to mongodb server, create the 'logSavingState' collection and initial the log_saving_state.
-        And then create the log collection cursor ready to save log data
+        Get the shared mongodb client without connecting. The 'logSavingState' collection and the log collection
+        cursor are initialized when the first log data is saving, so creating the handler costs no network I/O.
 
         :param db: the database name for save all log collections
         :param coll_name: the collection name for save logs information
         :param coll_size: the max size of single log collection
         :param coll_count: the count of the log collection in the database
+        :param batch: save log data by a background thread in batches or not
+        :param batch_size: the max count of log data in one batch
+        :param batch_bytes: the max bson size of log data in one batch
+        :param linger_ms: the max time a batch wait for more log data, in milliseconds
+        :param queue_capacity: the max count of log data waiting in the queue
+        :param queue_full_policy: 'Block' or 'Drop', what to do when the queue is full
+        :param extra_fields: the names of custom attributes from 'extra=', which should be saved too
+        :param storage: 'Rotating', 'Capped' or 'Timed', the way to store log data
+        :param bucket: 'Hour' or 'Day', the time span of one collection for 'Timed' storage
+        :param sweep_interval: the seconds between two checks for expired collections of 'Timed' storage
+        :param uri: the mongodb connection uri, it takes the place of host, port, user and password
+        :param max_pool_size: the max count of connections in the pool of the shared client
+        :param connect_timeout_ms: the timeout of connecting to mongodb server, in milliseconds
+        :param server_selection_timeout_ms: the timeout of finding an available server, in milliseconds
+        :param socket_timeout_ms: the timeout of sending or receiving on a connection, in milliseconds
+        :param breaker_threshold: the count of failures one after another to open the breaker, 0 to disable it
+        :param breaker_cooldown: the seconds between two checks of mongodb when the breaker is open
+        :param spool_path: the local file to keep log data when the breaker is open or saving failed,
+            every process should use its own file
+        :param spool_max_bytes: the max size of the spool file, the log data is dropped when it is full
+        :param replay_batch_size: the max count of log data replayed in one batch
+        :param replay_interval_ms: the milliseconds between two replayed batches, to limit the replay rate
+        :param index_fields: the fields indexed with '_id' in every log collection, for querying by 'CPXLogReader'
+        :param intern_tracebacks: save every distinct 'exc_text' and 'stack_info' once in the
+            '<coll_name>_tracebacks' collection, and the log data only keeps its hash
+        :param compress_threshold: compress the 'message' by zlib when it has this count of bytes or more,
+            0 for never
+        :param rollup: count the log data every minute by levelname and name into the '<coll_name>_rollups'
+            collection
+        :param rollup_lines: count by the 'pathname:lineno' of the log calling too
+        :param rollup_interval: the min seconds between two savings of the counts
+        :param rollup_expire: remove the counts older than this seconds by a TTL index, 0 for never
         """
         logging.Handler.__init__(self)
+        # 'close' may be called again by 'logging.shutdown' or a reloading, the client is released only once
+        self._closed = False
         assert 0 < coll_count <= MONGODB_COLL_MAX_COUNT, ValueError("The value out of range for Param coll_count")
         assert 0 < coll_size <= MONGODB_COLL_MAX_SIZE, ValueError("The value out of range for Param coll_size")
-        # create mongodb client cursor
-        if user or password:
-            uri = 'mongodb://' + user + ':' + password + '@' + host + ':' + str(port) + '/'
-        else:
-            uri = 'mongodb://' + host + ':' + str(port) + '/'
-        self.client = MongoClient(uri)
+        assert storage in STORAGE_TYPES, ValueError("The value must be one of %s for Param storage" % (STORAGE_TYPES,))
+        assert bucket in TIME_BUCKETS, ValueError("The value must be one of %s for Param bucket" % (tuple(TIME_BUCKETS),))
+        # get the shared mongodb client cursor
+        if not uri:
+            uri = create_mongodb_uri(host, port, user, password)
+        self.client, self.__clientKey = MONGO_CLIENTS.acquire(
+            uri, maxPoolSize=max_pool_size, connectTimeoutMS=connect_timeout_ms,
+            serverSelectionTimeoutMS=server_selection_timeout_ms, socketTimeoutMS=socket_timeout_ms)
 
         # create logs database cursor
         self.db = self.client[db]
@@ -112,25 +310,88 @@ class RotatingMongodbHandler(logging.Handler):
         self.__logsStateID = None
         self.__dbStateColl = None
         self.__logDataColl = None
-
-        self.__create_coll()
-
-    def __format_record(self, record):
+        self.__currentCollName = None
+
+        self.storage = storage
+        self.bucketFormat, self.bucketSpan = TIME_BUCKETS[bucket]
+        self.sweepInterval = sweep_interval
+        self.__bucketEndTime = 0
+        self.__sweeper = None
+        self.__sweeperStopped = threading.Event()
+        self.__storageReady = False
+        self.__storageLock = threading.Lock()
+
+        # the record attribute names to save are compiled from the format string of self.formatter
+        self.extraFields = tuple(extra_fields)
+        self.indexFields = tuple(index_fields)
+
+        # the tracebacks interning and the message compression, 'CPXLogReader' gives them back
+        self.internTracebacks = bool(intern_tracebacks)
+        self.compressThreshold = int(compress_threshold)
+        self.tracebackCollName = coll_name + TRACEBACK_COLL_SUFFIX
+        # {hash: text} waiting for saving, and {hash: True} saved or waiting
+        self.__pendingTracebacks = dict()
+        self.__knownTracebacks = dict()
+        # the hashes of the tracebacks waiting for saving, which are in the spool file
+        self.__spooledTracebacks = set()
+        self.__tracebacksLock = threading.Lock()
+
+        # the counts every minute, {(minute_timestamp, levelname, name[, line]): count} waiting for saving
+        self.rollup = bool(rollup)
+        self.rollupLines = bool(rollup_lines)
+        self.rollupInterval = rollup_interval
+        self.rollupExpire = int(rollup_expire)
+        self.rollupCollName = coll_name + ROLLUP_COLL_SUFFIX
+        self.__pendingRollups = dict()
+        self.__rollupsLock = threading.Lock()
+        self.__rollupSaveTime = 0
+        self.__rollupCollReady = False
+
+        # count the dropped and failed records, the bytes and the rotations, see CPXLogger.stats()
+        self.cpxStats = HandlerStats()
+
+        # create the queue and the background writer thread for batch mode
+        self.batch = bool(batch)
+        self.__writer = None
+        if self.batch:
+            self.__writer = BatchWriter(self.__save_or_spool, name="CPXLog-mongodb-writer", batch_size=batch_size,
+                                        batch_bytes=batch_bytes, linger_ms=linger_ms, queue_capacity=queue_capacity,
+                                        queue_full_policy=queue_full_policy, prepare=self.__prepare_log_data,
+                                        stats=self.cpxStats)
+
+        # the circuit breaker and the spool file
+        self.breakerThreshold = int(breaker_threshold)
+        self.breakerCooldown = breaker_cooldown
+        self.replayBatchSize = int(replay_batch_size)
+        self.replayInterval = replay_interval_ms / 1000
+        self.spool = DiskSpool(spool_path, spool_max_bytes) if spool_path else None
+        self.__failures = 0
+        self.__breakerOpen = False
+        self.__replayer = None
+        self.__replayerStopped = threading.Event()
+        self.__replayerLock = threading.Lock()
+        # replay the log data spooled before the last exit
+        if self.spool and self.spool.has_data():
+            self.__start_replayer()
+
+    def __init_storage(self):
         """
-        Add some attribute for the record object.
+        Initialize the storage by self.storage when the first log data is saving, it is the first time
+        connect to mongodb server.
         """
-        record.message = record.getMessage()
-
-        if self.formatter.usesTime():
-            record.asctime = self.formatter.formatTime(record, self.formatter.datefmt)
-
-        if record.exc_info:
-            # Cache the traceback text to avoid converting it multiple times
-            # (it's constant anyway)
-            if not record.exc_text:
-                record.exc_text = self.formatter.formatException(record.exc_info)
-
-        return record
+        with self.__storageLock:
+            if self.__storageReady:
+                return
+            if self.storage == "Rotating":
+                self.__create_coll()
+            elif self.storage == "Capped":
+                self.__create_capped_coll()
+            else:
+                self.__check_bucket()
+                self.__sweeper = threading.Thread(target=self.__sweeper_loop, name="CPXLog-mongodb-sweeper",
+                                                  daemon=True)
+                self.__sweeper.start()
+            self.__storageReady = True
 
     def parse_log(self, record):
         """
@@ -138,96 +399,459 @@ class RotatingMongodbHandler(logging.Handler):
         :param record: the log record object
         :return: log_information_dict: the log info dict
         """
-        record = self.__format_record(record)
-
-        # Get the raw format string and trans record to a dict
-        raw_fmt_str = self.formatter._fmt
-        record2dict = record.__dict__
-
         # Create a new dict to save the log information we need
         log_information_dict = dict(_id=bson.ObjectId())
-        for key in record2dict:
-            if key in raw_fmt_str:
-                log_information_dict[key] = record2dict.get(key)
-
-        # Try to save some very important additional information
-        exec_text = record2dict.get("exc_text")
-        if exec_text:
-            log_information_dict['exc_text'] = exec_text
-        stack_info = record2dict.get("stack_info")
-        if stack_info:
-            log_information_dict['stack_info'] = stack_info
-
+        log_information_dict.update(self.record_fields(record))
+
+        if self.internTracebacks:
+            self.__intern_tracebacks(log_information_dict)
+        if self.compressThreshold:
+            self.__compress_message(log_information_dict)
+        if self.rollup:
+            self.__count_rollup(record)
         return log_information_dict
 
-    def __check_coll_count(self, log_saving_state):
+    def __intern_tracebacks(self, log_data):
         """
-        When the remainder count of the log data collection is zero, The earliest created collection
-        will be deleted to store more log data.
+        Replace the traceback texts in the log data by their hashes, the new texts wait for saving into the
+        tracebacks collection before the log data.
         """
-        coll_remainder_count = log_saving_state["coll_remainder_count"]
-
-        if coll_remainder_count < 0:
-            earliest_log_data_coll_name = log_saving_state["history_log_coll"].pop(0).get('name')
-            earliest_log_data_coll = self.db[earliest_log_data_coll_name]
-            earliest_log_data_coll.drop()
-            log_saving_state["coll_remainder_count"] += 1
+        for field in INTERNED_FIELDS:
+            text = log_data.pop(field, None)
+            if not text:
+                continue
+            key = traceback_hash(text)
+            log_data[field + INTERNED_REF_SUFFIX] = key
+            if key in self.__knownTracebacks:
+                continue
+            with self.__tracebacksLock:
+                if len(self.__knownTracebacks) >= _KNOWN_TRACEBACKS_MAX:
+                    # saving a known one again does nothing, so just forget them
+                    self.__knownTracebacks.clear()
+                self.__knownTracebacks[key] = True
+                self.__pendingTracebacks[key] = text
+
+    def __compress_message(self, log_data):
+        """
+        Replace the message by its zlib compressed bytes, if it is big enough and the compressed is smaller.
+        """
+        message = log_data.get("message")
+        if not isinstance(message, str) or len(message) < self.compressThreshold:
+            return
+        data = message.encode("utf-8", "backslashreplace")
+        if len(data) < self.compressThreshold:
+            return
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            del log_data["message"]
+            log_data[COMPRESSED_MESSAGE_KEY] = compressed
+
+    def __save_tracebacks(self):
+        """
+        Save the new traceback texts into the tracebacks collection, before the log data referring them. They
+        are kept waiting if the saving failed, and saved with the next log data.
+        """
+        with self.__tracebacksLock:
+            pending = dict(self.__pendingTracebacks)
+        if not pending:
+            return
+        requests = [UpdateOne({"_id": key}, {"$setOnInsert": {"text": text, "created": time.time()}}, upsert=True)
+                    for key, text in pending.items()]
+        try:
+            self.db[self.tracebackCollName].bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            # the other processes may insert the same one at the same time
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", ())) or \
+                    e.details.get("writeConcernErrors"):
+                raise
+        with self.__tracebacksLock:
+            for key in pending:
+                self.__pendingTracebacks.pop(key, None)
+                self.__spooledTracebacks.discard(key)
+
+    def __spooled_tracebacks(self, log_data_list):
+        """
+        Get the bson entries of the tracebacks waiting for saving, which are referred by the log data and not
+        spooled yet.
+        :return: (hashes, payloads)
+        """
+        keys, payloads = list(), list()
+        with self.__tracebacksLock:
+            if not self.__pendingTracebacks:
+                return keys, payloads
+            for log_data in log_data_list:
+                for field in INTERNED_FIELDS:
+                    key = log_data.get(field + INTERNED_REF_SUFFIX)
+                    text = self.__pendingTracebacks.get(key)
+                    if text is None or key in self.__spooledTracebacks or key in keys:
+                        continue
+                    keys.append(key)
+                    payloads.append(bson.BSON.encode({SPOOLED_TRACEBACK_KEY: key, "text": text}))
+        return keys, payloads
+
+    def __count_rollup(self, record):
+        """
+        Count the record into the pending counts of its minute, only in memory.
+        """
+        key = (int(record.created // ROLLUP_SPAN) * ROLLUP_SPAN, record.levelname, record.name)
+        if self.rollupLines:
+            key += ("%s:%s" % (record.pathname, record.lineno),)
+        with self.__rollupsLock:
+            self.__pendingRollups[key] = self.__pendingRollups.get(key, 0) + 1
 
-        return log_saving_state
+    def __init_rollup_coll(self):
+        """
+        Create the unique index of the rollup keys, which the upserts find the documents by, and the TTL index.
+        """
+        if self.__rollupCollReady:
+            return
+        rollup_coll = self.db[self.rollupCollName]
+        rollup_coll.create_index([("minute", ASCENDING), ("levelname", ASCENDING), ("name", ASCENDING),
+                                  ("line", ASCENDING)], unique=True)
+        if self.rollupExpire:
+            rollup_coll.create_index("minute", expireAfterSeconds=self.rollupExpire)
+        self.__rollupCollReady = True
+
+    @staticmethod
+    def rollup_query(key):
+        """
+        Get the query of the rollup document by the key counted in memory.
+        """
+        query = dict(minute=datetime.datetime.fromtimestamp(key[0], datetime.timezone.utc), levelname=key[1],
+                     name=key[2])
+        if len(key) > 3:
+            query["line"] = key[3]
+        return query
 
-    def __check_coll_size(self, log_saving_state, log_data):
+    def __upsert_rollups(self, rollups):
+        """
+        Add the counts into the rollup collection by one unordered bulk of '$inc' upserts.
+        :return: failed: {key: count} not added
         """
-        When the remainder size of the current log data collection is not enough, It will move the
-        state information of the 'current_log_coll' into 'history_log_coll' creating a dictionary
-        to save the state information of new 'current_log_coll'
+        keys = list(rollups)
+        # the upsert fails with the duplicate key error when an other process inserts the same document at the
+        # same time, then the '$inc' is done again
+        for _ in range(2):
+            requests = [UpdateOne(self.rollup_query(key), {"$inc": {"count": rollups[key]}}, upsert=True)
+                        for key in keys]
+            try:
+                self.db[self.rollupCollName].bulk_write(requests, ordered=False)
+                return dict()
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", ())
+                keys = [keys[error["index"]] for error in errors]
+                if any(error.get("code") != 11000 for error in errors):
+                    break
+        return {key: rollups[key] for key in keys}
+
+    def __save_rollups(self, force=False):
+        """
+        Save the pending counts, at most once every self.rollupInterval seconds if not force. The counts not
+        saved are merged back, and saved with the next log data.
+        """
+        if not self.rollup or not (force or time.monotonic() >= self.__rollupSaveTime):
+            return
+        self.__rollupSaveTime = time.monotonic() + self.rollupInterval
+        with self.__rollupsLock:
+            rollups, self.__pendingRollups = self.__pendingRollups, dict()
+        if not rollups:
+            return
+        failed = rollups
+        try:
+            self.__init_rollup_coll()
+            failed = self.__upsert_rollups(rollups)
+        finally:
+            if failed:
+                with self.__rollupsLock:
+                    for key, count in failed.items():
+                        if len(self.__pendingRollups) >= _PENDING_ROLLUPS_MAX:
+                            break
+                        self.__pendingRollups[key] = self.__pendingRollups.get(key, 0) + count
+
+    def __drop_earliest_coll(self):
         """
-        coll_size = log_saving_state["current_log_coll"]["current_size"]
-        data_size = len(bson.BSON.encode(log_data))
-        new_coll_size = coll_size + data_size
+        When the remainder count of the log data collection is less than zero, The earliest created
+        collection will be deleted to store more log data. The '$pop' only matches while the count is
+        still negative, so every surplus collection is dropped by one process only.
+        """
+        log_saving_state = self.__dbStateColl.find_one_and_update(
+            filter={"_id": self.__logsStateID, "coll_remainder_count": {"$lt": 0}},
+            update={"$pop": {"history_log_coll": -1}, "$inc": {"coll_remainder_count": 1}},
+            projection={"history_log_coll": {"$slice": 1}},
+            return_document=ReturnDocument.BEFORE)
 
-        if new_coll_size > self.collSize:
-            log_saving_state["coll_remainder_count"] -= 1
-            current_log_state = log_saving_state["current_log_coll"]
-            log_saving_state["history_log_coll"].append(current_log_state)
+        if log_saving_state and log_saving_state["history_log_coll"]:
+            earliest_log_data_coll_name = log_saving_state["history_log_coll"][0].get('name')
+            self.db[earliest_log_data_coll_name].drop()
 
-            new_log_state = {"name": self.__create_coll_name(), "current_size": data_size}
-            log_saving_state["current_log_coll"] = new_log_state
+    def __rotate_coll(self, old_size, data_size):
+        """
+        Move the state information of the 'current_log_coll' into 'history_log_coll', and create a new
+        'current_log_coll' which has counted the data_size. Only the process which still see the old
+        collection as current can do it.
+        :return: rotated: False if another process has rotated it
+        """
+        new_log_state = {"name": self.__create_coll_name(), "current_size": data_size}
+        log_saving_state = self.__dbStateColl.find_one_and_update(
+            filter={"_id": self.__logsStateID, "current_log_coll.name": self.__currentCollName},
+            update={"$set": {"current_log_coll": new_log_state},
+                    "$push": {"history_log_coll": {"name": self.__currentCollName, "current_size": old_size}},
+                    "$inc": {"coll_remainder_count": -1}},
+            projection={"coll_remainder_count": 1},
+            return_document=ReturnDocument.AFTER)
+        if not log_saving_state:
+            return False
+
+        self.__set_current_coll(new_log_state["name"])
+        self.cpxStats.count_rotation()
+        if log_saving_state["coll_remainder_count"] < 0:
+            self.__drop_earliest_coll()
+        return True
+
+    def __count_coll_size(self, data_size):
+        """
+        Add the data_size into the current log collection size by '$inc' in mongodb. When the remainder
+        size of the current log data collection is not enough, rotate to a new one.
+        :return: log_data_coll: the log collection cursor where the data should be saved
+        """
+        while True:
+            log_saving_state = self.__dbStateColl.find_one_and_update(
+                filter={"_id": self.__logsStateID, "current_log_coll.name": self.__currentCollName},
+                update={"$inc": {"current_log_coll.current_size": data_size}},
+                projection={"current_log_coll.current_size": 1},
+                return_document=ReturnDocument.AFTER)
+            if not log_saving_state:
+                self.__reload_current_coll()
+                continue
+
+            new_coll_size = log_saving_state["current_log_coll"]["current_size"]
+            # an empty collection always take the data, even it is bigger than coll_size
+            if new_coll_size <= self.collSize or new_coll_size == data_size:
+                return self.__logDataColl
+
+            if self.__rotate_coll(new_coll_size - data_size, data_size):
+                return self.__logDataColl
+            self.__reload_current_coll()
+
+    def __create_capped_coll(self):
+        """
+        Create the capped collection for 'Capped' storage if it is not existed.
+        """
+        try:
+            self.db.create_collection(self.baseCollName, capped=True, size=self.collSize * self.collCount)
+        except CollectionInvalid:
+            # the collection has been created
+            pass
+        self.__set_current_coll(self.baseCollName)
 
-            self.__logDataColl = self.db[log_saving_state["current_log_coll"]["name"]]
+    def __check_bucket(self):
+        """
+        Switch the current log collection when the time bucket of 'Timed' storage is over.
+        :return: log_data_coll: the log collection cursor where the data should be saved
+        """
+        if time.time() >= self.__bucketEndTime:
+            bucket_start = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+            if self.bucketSpan.days:
+                bucket_start = bucket_start.replace(hour=0)
+            if self.__bucketEndTime:
+                self.cpxStats.count_rotation()
+            self.__bucketEndTime = (bucket_start + self.bucketSpan).timestamp()
+            self.__set_current_coll(self.baseCollName + "_" + bucket_start.strftime(self.bucketFormat))
+
+        return self.__logDataColl
+
+    def __drop_expired_buckets(self):
+        """
+        Drop the collections of 'Timed' storage which are older than the latest coll_count buckets.
+        The bucket names are sortable, so compare the names with the earliest one kept.
+        """
+        earliest_bucket = datetime.datetime.now() - self.bucketSpan * (self.collCount - 1)
+        earliest_name = self.baseCollName + "_" + earliest_bucket.strftime(self.bucketFormat)
+        prefix = self.baseCollName + "_"
 
-        else:
-            log_saving_state["current_log_coll"]["current_size"] = new_coll_size
+        for name in self.db.list_collection_names():
+            if name.startswith(prefix) and len(name) == len(earliest_name) and name < earliest_name:
+                self.db[name].drop()
 
-        return log_saving_state
+    def __sweeper_loop(self):
+        """
+        The target of the background sweeper thread of 'Timed' storage.
+        """
+        while not self.__sweeperStopped.is_set():
+            try:
+                self.__drop_expired_buckets()
+            except Exception as e:
+                self.send_email(e)
+            self.__sweeperStopped.wait(self.sweepInterval)
+
+    def __get_log_data_coll(self, data_size):
+        """
+        Get the log collection cursor where the data should be saved, by the way of self.storage.
+        """
+        if not self.__storageReady:
+            self.__init_storage()
+        if self.storage == "Rotating":
+            return self.__count_coll_size(data_size)
+        if self.storage == "Timed":
+            return self.__check_bucket()
+        return self.__logDataColl
+
+    @staticmethod
+    def encode_log_data(log_data):
+        """
+        Encode the log data dict to bson only once. The 'RawBSONDocument' keeps the bytes, so the size
+        counting and the inserting of pymongo both use them without encoding again.
+        """
+        if isinstance(log_data, RawBSONDocument):
+            return log_data
+        return RawBSONDocument(bson.BSON.encode(log_data))
 
-    def __check_saving_state(self, state_query_rule, log_data):
+    def save(self, log_data):
         """
-        Get log saving state from 'logSavingState' collection by self.__dbStateColl.
-        Then check remainder size of the current log data collection, and check the
-        remainder count of the log data collection. After all checked, get a new
-        'log_saving_state'
+        Count the size of the log data into the saving state, and then save it into the current
+        log collection.
         """
-        log_saving_state = self.__dbStateColl.find_one(filter=state_query_rule)
+        log_data = self.encode_log_data(log_data)
+        data_size = len(log_data.raw)
+        log_data_coll = self.__get_log_data_coll(data_size)
+        if self.internTracebacks:
+            self.__save_tracebacks()
 
-        log_saving_state = self.__check_coll_size(log_saving_state, log_data)
+        # Save log info into mongodb
+        log_data_coll.insert_one(log_data)
+        self.cpxStats.count_bytes(data_size)
+        self.__save_rollups()
 
-        log_saving_state = self.__check_coll_count(log_saving_state)
+    @staticmethod
+    def __insert_many(log_data_coll, log_data_list):
+        """
+        Insert the log data, the duplicate '_id' errors are ignored, they are replayed log data which
+        has been saved before.
+        """
+        try:
+            log_data_coll.insert_many(log_data_list, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", ())) or \
+                    e.details.get("writeConcernErrors"):
+                raise
 
-        return log_saving_state
+    def save_many(self, log_data_list):
+        """
+        Save a batch of log data with as few state updating and 'insert_many' as possible. The batch
+        will be split into chunks which are not bigger than the coll_size, and for 'Rotating' storage
+        every chunk counted by one '$inc'.
+        """
+        if self.internTracebacks:
+            self.__save_tracebacks()
+        chunk, chunk_size = list(), 0
+        for log_data in log_data_list:
+            log_data = self.encode_log_data(log_data)
+            data_size = len(log_data.raw)
+            if chunk and chunk_size + data_size > self.collSize:
+                self.__insert_many(self.__get_log_data_coll(chunk_size), chunk)
+                self.cpxStats.count_bytes(chunk_size)
+                chunk, chunk_size = list(), 0
+            chunk.append(log_data)
+            chunk_size += data_size
+
+        if chunk:
+            self.__insert_many(self.__get_log_data_coll(chunk_size), chunk)
+            self.cpxStats.count_bytes(chunk_size)
+        self.__save_rollups()
+
+    def __prepare_log_data(self, log_data):
+        """
+        Encode the log data in the writer thread, and give its size to the batch.
+        """
+        log_data = self.encode_log_data(log_data)
+        return log_data, len(log_data.raw)
 
-    def save(self, log_data):
+    def __spool_log_data(self, log_data_list):
         """
-        Check the state about the log information saving, and record the log collection have
-        saved how many data.
+        Append the log data into the spool file, count the others as dropped when the spool is full.
+        :return: spooled: False if there is no spool file
         """
-        state_query_rule = {"_id": self.__logsStateID}
-        log_saving_state = self.__check_saving_state(state_query_rule, log_data)
+        if not self.spool:
+            return False
+        traceback_keys, traceback_payloads = self.__spooled_tracebacks(log_data_list)
+        payloads = [self.encode_log_data(log_data).raw for log_data in log_data_list]
+        spooled_count = self.spool.append(traceback_payloads + payloads)
+        with self.__tracebacksLock:
+            self.__spooledTracebacks.update(traceback_keys[:spooled_count])
+        for _ in range(len(payloads) - max(spooled_count - len(traceback_payloads), 0)):
+            self.cpxStats.count_dropped()
+        self.__start_replayer()
+        return True
+
+    def __save_or_spool(self, log_data_list):
+        """
+        Save the log data when the circuit breaker is closed. If the breaker is open, or the saving failed,
+        spool the log data.
+        """
+        if self.__breakerOpen:
+            if not self.__spool_log_data(log_data_list):
+                for _ in log_data_list:
+                    self.cpxStats.count_dropped()
+            return
 
-        # Save log info into mongodb
-        self.__logDataColl.insert_one(log_data)
-        # Update the saving state info
-        self.__dbStateColl.update_one(filter=state_query_rule,
-                                      update={'$set': log_saving_state})
+        try:
+            self.save_many(log_data_list)
+            self.__failures = 0
+        except Exception as e:
+            self.__failures += 1
+            if self.breakerThreshold and self.__failures >= self.breakerThreshold:
+                self.__breakerOpen = True
+                # the replayer closes the breaker when mongodb is reachable again
+                self.__start_replayer()
+            if not self.__spool_log_data(log_data_list):
+                for _ in log_data_list:
+                    self.cpxStats.count_failed()
+            self.send_email(e)
+
+    def __start_replayer(self):
+        with self.__replayerLock:
+            if self.__replayer is None:
+                self.__replayer = threading.Thread(target=self.__replayer_loop, name="CPXLog-mongodb-replayer",
+                                                   daemon=True)
+                self.__replayer.start()
+
+    def __replay_spool(self):
+        """
+        Save the spooled log data batch by batch, wait self.replayInterval between two batches.
+        """
+        for payloads in self.spool.iter_batches(self.replayBatchSize):
+            log_data_list = list()
+            for payload in payloads:
+                if payload[4:4 + len(_SPOOLED_TRACEBACK_PREFIX)] == _SPOOLED_TRACEBACK_PREFIX:
+                    entry = bson.BSON(payload).decode()
+                    with self.__tracebacksLock:
+                        self.__pendingTracebacks[entry[SPOOLED_TRACEBACK_KEY]] = entry["text"]
+                else:
+                    log_data_list.append(RawBSONDocument(payload))
+            # the tracebacks are saved before the log data, even if 'intern_tracebacks' is False now
+            self.__save_tracebacks()
+            if log_data_list:
+                self.save_many(log_data_list)
+            if self.__replayerStopped.wait(self.replayInterval):
+                return
+
+    def __replayer_loop(self):
+        """
+        The target of the background replayer thread. Check mongodb every self.breakerCooldown seconds,
+        when it is reachable, replay the spooled log data, and close the breaker after the spool is empty.
+        """
+        while not self.__replayerStopped.wait(self.breakerCooldown):
+            if not self.__breakerOpen and not (self.spool and self.spool.has_data()):
+                continue
+            try:
+                self.client.admin.command("ping")
+                if self.spool:
+                    while self.spool.has_data() and not self.__replayerStopped.is_set():
+                        self.__replay_spool()
+                self.__failures = 0
+                self.__breakerOpen = False
+            except Exception as e:
+                self.send_email(e)
 
     def send_email(self, error):
         """
@@ -242,17 +866,50 @@ class RotatingMongodbHandler(logging.Handler):
         """
         try:
             log_data = self.parse_log(record)
-            self.save(log_data)
+            if self.batch:
+                self.__writer.put(log_data)
+            else:
+                self.__save_or_spool([log_data])
 
         except Exception as e:
             # TODO
+            self.cpxStats.count_failed()
             self.send_email(e)
 
+    def __flush_rollups(self):
+        # the pending counts wait in memory when the breaker is open, they are saved with the replayed log data
+        if self.rollup and not self.__breakerOpen:
+            try:
+                self.__save_rollups(force=True)
+            except Exception as e:
+                self.send_email(e)
+
+    def flush(self):
+        """
+        Wait for all the log data in the queue saved, only work in batch mode, and save the pending counts.
+        """
+        if self.__writer:
+            self.__writer.flush()
+        self.__flush_rollups()
+
     def close(self):
         """
-        Close the connect with mongodb
+        Stop the background writer thread after the queue is empty, and release the shared mongodb client
         """
-        self.client.close()
+        if self._closed:
+            return
+        self._closed = True
+        if self.__writer:
+            self.__writer.close()
+        self.__flush_rollups()
+        if self.__replayer and self.__replayer.is_alive():
+            self.__replayerStopped.set()
+            self.__replayer.join()
+        if self.__sweeper and self.__sweeper.is_alive():
+            self.__sweeperStopped.set()
+            self.__sweeper.join()
+        MONGO_CLIENTS.release(self.__clientKey)
+        logging.Handler.close(self)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,75 @@
+import importlib
 import logging
 from logging import handlers
-from pcpxlog import CPXLogger, cpxHandlers
+from pcpxlog.cpxFilters import create_filters
+from pcpxlog.cpxLogger import CPXLogger
 
 
 class ConfigLoader:
     """
     Be in charge of processing the config for log handlers with out console.
+
+    Every config section is loaded by a registered loading method, and the backend handler classes are
+    resolved by name, so the module of a backend (and its driver like pymongo) is only imported when its
+    config section exists.
     """
     __cpx_logger = CPXLogger
 
+    # {config section name: loading method name}, the sections are loaded in this order. The Recorder is the
+    # first one, so the context records are written before the error record which dumps them
+    section_loaders = dict(
+        Recorder="load_recorder_config",
+        File="load_file_config",
+        Mongodb="load_mongodb_config",
+        Redis="load_redis_config",
+        Sql="load_sql_config",
+    )
+
+    # {handler type name: "<module>:<class>"}, the module is imported when the type is resolved
+    handler_types = dict(
+        RotatingMongodbHandler="pcpxlog.cpxHandlers:RotatingMongodbHandler",
+        RedisStreamHandler="pcpxlog.cpxRedis:RedisStreamHandler",
+        SqlHandler="pcpxlog.cpxSql:SqlHandler",
+        FlightRecorderHandler="pcpxlog.cpxRecorder:FlightRecorderHandler",
+    )
+
+    @classmethod
+    def register_section(cls, section, loader_name):
+        """
+        Register the loading method for a new config section.
+        :param section: the config section name, like 'File'
+        :param loader_name: the name of the classmethod which gets the params for creating the handler
+        """
+        cls.section_loaders[section] = loader_name
+
+    @classmethod
+    def register_handler_type(cls, type_name, import_path):
+        """
+        Register a backend handler class by name.
+        :param type_name: the handler type name
+        :param import_path: the path like '<module>:<class>'
+        """
+        cls.handler_types[type_name] = import_path
+
+    @classmethod
+    def resolve_handler_type(cls, type_name):
+        """
+        Import the backend module and get the handler class by the handler type name.
+        """
+        module_name, class_name = cls.handler_types[type_name].split(":")
+        return getattr(importlib.import_module(module_name), class_name)
+
+    @classmethod
+    def load_section(cls, section, config):
+        """
+        Get the params for creating the handler of the config section by its loading method, and the filters
+        of the handler by the filter keys of the section.
+        """
+        filters = create_filters(config)
+        params = getattr(cls, cls.section_loaders[section])(config=config)
+        params["filters"] = filters
+        return params
+
     @classmethod
     def __get_level_and_format(cls, config):
         """
@@ -20,14 +81,55 @@ class ConfigLoader:
 
         del config["LEVEL"]
         del config['FORMAT']
+        # the handler config class may inherit them from the Basic config class
+        for key in cls.__cpx_logger.basic_only_keys:
+            config.pop(key, None)
 
         return log_level, format_str
 
+    @classmethod
+    def __load_handler_params(cls, config, handler_type, **choices):
+        """
+        Get the params for create a backend handler, every key of the config is lowercased into an init param
+        of the handler class.
+        :param config: the backend log configs
+        :param handler_type: the handler type name in cls.handler_types
+        :param choices: {config key: (default value, the values allowed)}, the config values checked
+        :return: params: the params for create the log handler
+        """
+        handler_class = cls.resolve_handler_type(handler_type)
+        log_level, format_str = cls.__get_level_and_format(config)
+
+        handler_init_params = dict()
+        for key, value in config.items():
+            handler_init_params[key.lower()] = value
+
+        for key, (default, allowed_values) in choices.items():
+            assert handler_init_params.get(key.lower(), default) in allowed_values, \
+                ValueError("The '%s' must be one of %s" % (key, tuple(allowed_values)))
+
+        params = dict(handler_class=handler_class,
+                      log_level=log_level,
+                      format_str=format_str,
+                      init_params=handler_init_params
+                      )
+
+        return params
+
     @classmethod
     def load_file_config(cls, config: dict):
         """
         if the TYPE is 'Ordinary',the Handler Class will be logging.FileHandler,
-        if is 'Rotating', the Handler Class will be 'logging.handlers.RotatingFileHandler'.
+        if is 'Rotating', the Handler Class will be 'logging.handlers.RotatingFileHandler',
+        if is 'Buffered', the Handler Class will be 'pcpxlog.cpxFile.BufferedRotatingFileHandler', it writes the
+        lines by 'BUFFER_BYTES', 'FLUSH_INTERVAL' and 'FLUSH_LEVEL', and rotates the file if 'MAX_BYTES' and
+        'BACKUP_COUNT' are set,
+        if is 'Timed', the Handler Class will be 'pcpxlog.cpxFile.CompressedTimedRotatingFileHandler', it rotates
+        the file by 'WHEN' ('H', 'D', 'MIDNIGHT' and the others of 'TimedRotatingFileHandler') and 'INTERVAL'.
+        if is 'Binary', the Handler Class will be 'pcpxlog.cpxBinary.BinaryLogFileHandler', it writes bson records
+        and a time index every 'INDEX_INTERVAL' records, with the buffer and the rotation like 'Buffered'.
+        The 'COMPRESSION' ('gzip' or 'zstd') compresses the rotated files of 'Rotating', 'Buffered' and 'Timed',
+        the 'Rotating' Handler Class will be 'pcpxlog.cpxFile.CompressedRotatingFileHandler' for it.
         :param config: file log configs
         :return: params: the params for create a file log handler
         """
@@ -41,10 +143,47 @@ class ConfigLoader:
             encoding=config.get("ENCODING", None),
             delay=config.get("DELAY", False)
         )
+        compression = config.get("COMPRESSION", None)
         if file_log_type == "Rotating":
             handler_class = handlers.RotatingFileHandler
             handler_init_params["maxBytes"] = config["MAX_BYTES"]
             handler_init_params["backupCount"] = int(config["BACKUP_COUNT"])
+            if compression:
+                from pcpxlog.cpxFile import CompressedRotatingFileHandler
+
+                handler_class = CompressedRotatingFileHandler
+                handler_init_params["compression"] = compression
+        elif file_log_type == "Buffered":
+            from pcpxlog.cpxFile import BufferedRotatingFileHandler
+
+            handler_class = BufferedRotatingFileHandler
+            handler_init_params["maxBytes"] = config.get("MAX_BYTES", 0)
+            handler_init_params["backupCount"] = int(config.get("BACKUP_COUNT", 0))
+            handler_init_params["buffer_bytes"] = config.get("BUFFER_BYTES", 64 * 1024)
+            handler_init_params["flush_interval"] = config.get("FLUSH_INTERVAL", 1.0)
+            handler_init_params["flush_level"] = getattr(logging, config.get("FLUSH_LEVEL", "ERROR"))
+            handler_init_params["compression"] = compression
+        elif file_log_type == "Binary":
+            from pcpxlog.cpxBinary import BinaryLogFileHandler
+
+            handler_class = BinaryLogFileHandler
+            del handler_init_params["encoding"]
+            handler_init_params["maxBytes"] = config.get("MAX_BYTES", 0)
+            handler_init_params["backupCount"] = int(config.get("BACKUP_COUNT", 0))
+            handler_init_params["buffer_bytes"] = config.get("BUFFER_BYTES", 64 * 1024)
+            handler_init_params["flush_interval"] = config.get("FLUSH_INTERVAL", 1.0)
+            handler_init_params["flush_level"] = getattr(logging, config.get("FLUSH_LEVEL", "ERROR"))
+            handler_init_params["index_interval"] = int(config.get("INDEX_INTERVAL", 512))
+            handler_init_params["extra_fields"] = config.get("EXTRA_FIELDS", ())
+        elif file_log_type == "Timed":
+            from pcpxlog.cpxFile import CompressedTimedRotatingFileHandler
+
+            handler_class = CompressedTimedRotatingFileHandler
+            handler_init_params["when"] = config.get("WHEN", "MIDNIGHT")
+            handler_init_params["interval"] = int(config.get("INTERVAL", 1))
+            handler_init_params["backupCount"] = int(config.get("BACKUP_COUNT", 0))
+            handler_init_params["utc"] = config.get("UTC", False)
+            handler_init_params["compression"] = compression
 
         params = dict(handler_class=handler_class,
                       log_level=log_level,
@@ -55,21 +194,74 @@ class ConfigLoader:
     @classmethod
     def load_mongodb_config(cls, config):
         """
-        The handler class will be 'PCPXLog.handlers.RotatingMongodbHandler'.
+        The handler class will be 'pcpxlog.cpxHandlers.RotatingMongodbHandler'.
+        The batch mode is set by 'BATCH', 'BATCH_SIZE', 'BATCH_BYTES', 'LINGER_MS', 'QUEUE_CAPACITY' and
+        'QUEUE_FULL_POLICY', the 'QUEUE_FULL_POLICY' has two choice, 'Block' or 'Drop'.
+        The 'STORAGE' has three choice, 'Rotating', 'Capped' or 'Timed'. 'Timed' storage use 'BUCKET' ('Hour'
+        or 'Day') and 'SWEEP_INTERVAL' too.
+        The 'URI', 'MAX_POOL_SIZE' and the '*_TIMEOUT_MS' set the client shared by the handlers with same uri.
+        The 'BREAKER_*', 'SPOOL_*' and 'REPLAY_*' set the circuit breaker and the local spool file.
+        The 'EXTRA_FIELDS' is the allow-list of custom attributes from 'extra=' which should be saved.
+        The 'INDEX_FIELDS' are indexed with '_id' in every log collection, for 'pcpxlog.cpxReader.CPXLogReader'.
+        The 'INTERN_TRACEBACKS' and 'COMPRESS_THRESHOLD' make the log data smaller, see 'RotatingMongodbHandler'.
+        The 'ROLLUP', 'ROLLUP_LINES', 'ROLLUP_INTERVAL' and 'ROLLUP_EXPIRE' set the log counts every minute.
         :param config: mongodb log configs
         :return: params: the params for create a mongodb log handler
         """
-        handler_class = cpxHandlers.RotatingMongodbHandler
-        log_level, format_str = cls.__get_level_and_format(config)
+        # the section exists, it is time to import the mongodb backend
+        from pcpxlog import cpxHandlers
+        from pcpxlog.cpxBatch import QUEUE_FULL_POLICIES
 
-        handler_init_params = dict()
-        for key, value in config.items():
-            handler_init_params[key.lower()] = value
+        return cls.__load_handler_params(config, "RotatingMongodbHandler",
+                                         QUEUE_FULL_POLICY=("Block", QUEUE_FULL_POLICIES),
+                                         STORAGE=("Rotating", cpxHandlers.STORAGE_TYPES))
 
-        params = dict(handler_class=handler_class,
-                      log_level=log_level,
-                      format_str=format_str,
-                      init_params=handler_init_params
-                      )
+    @classmethod
+    def load_redis_config(cls, config):
+        """
+        The handler class will be 'pcpxlog.cpxRedis.RedisStreamHandler'.
+        The 'STREAM' is the stream key, and it is trimmed to about 'MAXLEN' entries. The batch mode is set
+        like mongodb, but 'BATCH' is True by default.
+        :param config: redis log configs
+        :return: params: the params for create a redis log handler
+        """
+        from pcpxlog.cpxBatch import QUEUE_FULL_POLICIES
+
+        return cls.__load_handler_params(config, "RedisStreamHandler",
+                                         QUEUE_FULL_POLICY=("Block", QUEUE_FULL_POLICIES))
+
+    @classmethod
+    def load_sql_config(cls, config):
+        """
+        The handler class will be 'pcpxlog.cpxSql.SqlHandler'.
+        The 'DRIVER' is the module name of a DB-API driver, 'sqlite3' uses the 'DATABASE' file path, the others
+        like 'pymysql' use the 'CONNECT_PARAMS' dict. The log tables are rotated by 'TABLE_ROWS' and
+        'TABLE_COUNT', and the batch mode is set like mongodb, but 'BATCH' is True by default.
+        :param config: sql log configs
+        :return: params: the params for create a sql log handler
+        """
+        from pcpxlog.cpxBatch import QUEUE_FULL_POLICIES
+
+        return cls.__load_handler_params(config, "SqlHandler",
+                                         QUEUE_FULL_POLICY=("Block", QUEUE_FULL_POLICIES))
+
+    @classmethod
+    def load_recorder_config(cls, config):
+        """
+        The handler class will be 'pcpxlog.cpxRecorder.FlightRecorderHandler'.
+        It keeps the last 'CAPACITY' records of every logger in memory, from the 'LEVEL', and writes them into
+        the handlers of the 'TARGETS' config sections, like ['File', 'Mongodb'], when a record of 'TRIGGER_LEVEL'
+        or higher comes, at most once every 'COOLDOWN' seconds for a logger.
+        :param config: flight recorder configs
+        :return: params: the params for create a flight recorder handler
+        """
+        params = cls.__load_handler_params(config, "FlightRecorderHandler")
 
+        targets = params["init_params"].get("targets", ("File", "Mongodb"))
+        target_sections = tuple(section for section in cls.section_loaders if section != "Recorder")
+        assert all(section in target_sections for section in targets), \
+            ValueError("The 'TARGETS' must be some of %s" % (target_sections,))
+        trigger_level = params["init_params"].get("trigger_level", "ERROR")
+        assert isinstance(getattr(logging, trigger_level, None), int), \
+            ValueError("The 'TRIGGER_LEVEL' must be a level name")
         return params
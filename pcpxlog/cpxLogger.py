@@ -7,39 +7,132 @@ Present:                         |
     file                         |
     rotating_file                |
     mongodb                      |
+    redis                        |
+    sql (sqlite3, mysql)         |
+    flight recorder              |
 ----------------------------------
 Future:                          |
-    mysql                        |
-    redis                        |
     ....                         |
 ----------------------------------
 """
+import atexit
+import copy
 import logging
 import json
 
-from pcpxlog.cpxUtils import CheckAnnotation
+from pcpxlog.cpxFilters import create_filters, DedupeFilter, FILTER_KEYS, LOGGER_FILTER_PREFIX
+from pcpxlog.cpxStats import instrument_handler, StatsDumper
+from pcpxlog.cpxUtils import CheckAnnotation, shared_formatter
 
 
 class CPXLogger:
     default_level = logging.DEBUG
     default_format = '[%(levelname)s] %(asctime)s <%(name)s> %(pathname)s line:%(lineno)d :%(message)s'
 
+    # the keys only work in the Basic config, they are not passed to the handlers
+    basic_only_keys = ("ASYNC", "ASYNC_QUEUE_SIZE", "ASYNC_OVERFLOW", "ASYNCIO", "ASYNCIO_QUEUE_SIZE",
+                       "ASYNCIO_BATCH_SIZE", "ASYNCIO_WORKERS",
+                       "STATS_SAMPLE_RATE", "STATS_INTERVAL", "STATS_FILE", "STATS_LOGGER",
+                       "AGGREGATE", "AGGREGATE_SOCKET", "AGGREGATE_BATCH_SIZE", "AGGREGATE_LINGER_MS",
+                       "AGGREGATE_IDLE_EXIT") + \
+        tuple(LOGGER_FILTER_PREFIX + key for key in FILTER_KEYS)
+
     __logger = None
+    # the name of the logger created, it is created again with the new handlers when the config is reloaded
+    __logger_name = None
+    # the console handlers created by basicConfig
+    __console_handlers = list()
     handlers = list()
     __loaded_config = False
+    __queue_listener = None
+    __asyncio_handler = None
+    # all the instrumented handlers, include the handlers behind the queue listener
+    __stats_handlers = list()
+    __stats_sample_rate = 16
+    __stats_dumper = None
+    # the filters of the logger, from the 'LOGGER_' filter keys in the Basic config
+    __logger_filters = list()
 
     @classmethod
-    def __create_handler(cls, handler_class, init_params, log_level, format_str):
+    def __create_handler(cls, handler_class, init_params, log_level, format_str, filters=()):
         # Create a log handler and add it into cls.handlers
 
         new_handler = handler_class(**init_params)
 
         new_handler.setLevel(log_level)
-        new_formatter = logging.Formatter(format_str)
-        new_handler.setFormatter(new_formatter)
-
+        for log_filter in filters:
+            new_handler.addFilter(log_filter)
+        # the handlers with the same format share one formatter, so a record is formatted once for them
+        new_handler.setFormatter(shared_formatter(format_str))
+
+        instrument_handler(new_handler, cls.__stats_sample_rate)
+        # the summary records of the collapsed ones are handled by the handler itself
+        for log_filter in filters:
+            if isinstance(log_filter, DedupeFilter):
+                log_filter.report = new_handler.handle
+        cls.__stats_handlers.append(new_handler)
         cls.handlers.append(new_handler)
 
+    @classmethod
+    def __create_queue_handler(cls, queue_size, overflow):
+        """
+        Put all the handlers behind one queue listener, and let cls.handlers only contain the queue handler.
+        The listener is stopped at exit, after all the records in the queue are handled.
+        """
+        from pcpxlog.cpxQueue import CPXQueueHandler, CPXQueueListener
+
+        queue_handler = CPXQueueHandler(queue_size=queue_size, overflow=overflow)
+        # the records no handler wants are not queued
+        queue_handler.setLevel(min(handler.level for handler in cls.handlers))
+        instrument_handler(queue_handler, cls.__stats_sample_rate)
+        cls.__stats_handlers.append(queue_handler)
+        cls.__queue_listener = CPXQueueListener(queue_handler, *cls.handlers)
+        cls.__queue_listener.start()
+        atexit.register(cls.__queue_listener.stop)
+
+        cls.handlers[:] = [queue_handler]
+
+    @classmethod
+    def __create_asyncio_handler(cls, queue_size, batch_size, max_workers):
+        """
+        Put all the handlers behind one asyncio handler, and let cls.handlers only contain it.
+        """
+        from pcpxlog.cpxAsyncio import CPXAsyncioHandler
+
+        asyncio_handler = CPXAsyncioHandler(*cls.handlers, queue_size=queue_size, batch_size=batch_size,
+                                            max_workers=max_workers)
+        asyncio_handler.setLevel(min(handler.level for handler in cls.handlers))
+        instrument_handler(asyncio_handler, cls.__stats_sample_rate)
+        cls.__stats_handlers.append(asyncio_handler)
+        cls.__asyncio_handler = asyncio_handler
+
+        cls.handlers[:] = [asyncio_handler]
+
+    @classmethod
+    def __create_aggregator_handler(cls, config, aggregate_cnf):
+        """
+        Create the client handler of the collector process in place of the handlers of the config sections.
+        Its level is the lowest level of them, so the records no handler wants are not sent.
+        """
+        from pcpxlog.cpxAggregator import AggregatorClientHandler
+        from pcpxlog.cpxLoader import ConfigLoader
+
+        levels = [getattr(logging, config[section]["LEVEL"]) if config[section].get("LEVEL") else cls.default_level
+                  for section in ConfigLoader.section_loaders if config.get(section)]
+        if not levels:
+            return
+        for section in ConfigLoader.section_loaders:
+            config.pop(section, None)
+        cls.__create_handler(AggregatorClientHandler, aggregate_cnf, min(levels), cls.default_format)
+
+    @classmethod
+    def __min_level(cls):
+        """
+        Get the lowest level of the console and the handlers, the logger drops the records lower than it
+        before creating them.
+        """
+        return min([cls.default_level] + [handler.level for handler in cls.handlers])
+
     @classmethod
     @CheckAnnotation.check_params
     def __create_logger(cls, name: str):
@@ -47,11 +140,25 @@ class CPXLogger:
 
         assert cls.__loaded_config, Exception("You cant not create logger before load config")
 
-        logging.basicConfig(level=cls.default_level, format=cls.default_format)
+        if not logging.root.handlers:
+            logging.basicConfig(level=cls.default_level, format=cls.default_format)
+            cls.__console_handlers = list(logging.root.handlers)
+        # the console handler created by basicConfig shares the formatter with the other handlers, and keeps
+        # the console level when the logger level is lower for the other handlers
+        for handler in cls.__console_handlers:
+            handler.setFormatter(shared_formatter(cls.default_format))
+            handler.setLevel(cls.default_level)
         cls.__logger = logging.getLogger(name)
+        cls.__logger_name = name
+        # the levels are not only filtered by the handlers, 'logger.debug' returns at once if no one wants it
+        cls.__logger.setLevel(cls.__min_level())
 
         for handler in cls.handlers:
             cls.__logger.addHandler(handler)
+        for log_filter in cls.__logger_filters:
+            cls.__logger.addFilter(log_filter)
+            if isinstance(log_filter, DedupeFilter):
+                log_filter.report = cls.__logger.callHandlers
 
     @classmethod
     @CheckAnnotation.check_params
@@ -65,14 +172,62 @@ class CPXLogger:
 
         The config for other handlers will be processed by ConfigLoader
 
+        If 'ASYNC' is True in the Basic config, all the handlers will be put behind one queue, and the
+        'ASYNC_QUEUE_SIZE' and 'ASYNC_OVERFLOW' ('Block', 'DropNewest' or 'DropLowest') set the queue.
+        If 'ASYNCIO' is True in the Basic config, all the handlers will be put behind one asyncio queue instead,
+        for the services running in an event loop, see pcpxlog.cpxAsyncio.
+
+        Every handler is instrumented for CPXLogger.stats(), one of 'STATS_SAMPLE_RATE' records is timed.
+        If 'STATS_INTERVAL' is set, the stats is dumped into 'STATS_FILE' or the 'STATS_LOGGER' logger
+        every 'STATS_INTERVAL' seconds.
+
+        The records can be dropped before they are formatted, by 'SAMPLE_RATES', 'RATE_LIMIT', 'RATE_BURST' and
+        'DEDUPE_WINDOW' of a handler config, see pcpxlog.cpxFilters. The same keys with the prefix 'LOGGER_' in
+        the Basic config work for the logger, so the records are dropped before the queue in the ASYNC mode.
+
+        If 'AGGREGATE' is True in the Basic config, the handlers are created by one collector process, and this
+        process sends the records to it through the unix socket 'AGGREGATE_SOCKET', see pcpxlog.cpxAggregator.
+
+        The 'Recorder' config keeps the DEBUG records in memory, and writes them into the handlers of its
+        'TARGETS' sections only when an error comes, see pcpxlog.cpxRecorder.
+
         :param config: config information dict
         """
         from pcpxlog.cpxLoader import ConfigLoader
 
         basic_cnf = config.get("Basic", None)
+        async_cnf = None
+        asyncio_cnf = None
+        aggregate_cnf = None
         if basic_cnf:
             cls.default_level = getattr(logging, basic_cnf.get("LEVEL", "DEBUG"))
             cls.default_format = basic_cnf.get("FORMAT", cls.default_format)
+            if basic_cnf.get("ASYNC", False):
+                async_cnf = dict(queue_size=basic_cnf.get("ASYNC_QUEUE_SIZE", 10000),
+                                 overflow=basic_cnf.get("ASYNC_OVERFLOW", "Block"))
+            if basic_cnf.get("ASYNCIO", False):
+                asyncio_cnf = dict(queue_size=basic_cnf.get("ASYNCIO_QUEUE_SIZE", 10000),
+                                   batch_size=basic_cnf.get("ASYNCIO_BATCH_SIZE", 500),
+                                   max_workers=basic_cnf.get("ASYNCIO_WORKERS", 1))
+                async_cnf = None
+            cls.__stats_sample_rate = basic_cnf.get("STATS_SAMPLE_RATE", 16)
+            if basic_cnf.get("STATS_INTERVAL", 0):
+                cls.__stats_dumper = StatsDumper(cls.stats, basic_cnf["STATS_INTERVAL"],
+                                                 file_path=basic_cnf.get("STATS_FILE", None),
+                                                 logger_name=basic_cnf.get("STATS_LOGGER", None))
+                cls.__stats_dumper.start()
+            cls.__logger_filters = create_filters(dict(basic_cnf), prefix=LOGGER_FILTER_PREFIX)
+            if basic_cnf.get("AGGREGATE", False):
+                # the collector process creates the handlers by the same config, without aggregating again
+                collector_config = copy.deepcopy(config)
+                collector_config["Basic"]["AGGREGATE"] = False
+                aggregate_cnf = dict(socket_path=basic_cnf.get("AGGREGATE_SOCKET", "./logs/cpxlog.sock"),
+                                     collector_config=collector_config,
+                                     batch_size=basic_cnf.get("AGGREGATE_BATCH_SIZE", 500),
+                                     linger_ms=basic_cnf.get("AGGREGATE_LINGER_MS", 100))
+                # the records are sent by the client handler in background, no need to queue them again
+                async_cnf = None
+                asyncio_cnf = None
             del config["Basic"]
 
         console_cnf = config.get("Console", None)
@@ -81,22 +236,29 @@ class CPXLogger:
             cls.default_format = console_cnf.get("FORMAT", cls.default_format)
             del config["Console"]
 
-        # process the config for file log output
-        file_log_cnf = config.get("File", None)
-        if file_log_cnf:
-            # Get file log handler creating params
-            params = ConfigLoader.load_file_config(config=file_log_cnf)
-            # Create handler
-            cls.__create_handler(**params)
-            del config["File"]
+        if aggregate_cnf:
+            cls.__create_aggregator_handler(config, aggregate_cnf)
+
+        # process the config for file, mongodb and other log output, in the registered order
+        section_handlers = dict()
+        for section in ConfigLoader.section_loaders:
+            section_cnf = config.get(section, None)
+            if section_cnf:
+                # Get log handler creating params and create handler
+                params = ConfigLoader.load_section(section, section_cnf)
+                cls.__create_handler(**params)
+                section_handlers[section] = cls.handlers[-1]
+                del config[section]
+        # the flight recorder writes the records kept into the handlers of the other sections
+        for handler in cls.handlers:
+            if hasattr(handler, "bind_targets"):
+                handler.bind_targets(section_handlers)
 
-        # TODO deal the config for mongodb log output
-        mongodb_log_cnf = config.get("Mongodb", None)
-        if mongodb_log_cnf:
-            # Get mongodb handler creating params
-            params = ConfigLoader.load_mongodb_config(config=mongodb_log_cnf)
-            cls.__create_handler(**params)
-            del config["Mongodb"]
+        # put all the handlers behind one queue
+        if async_cnf and cls.handlers:
+            cls.__create_queue_handler(**async_cnf)
+        if asyncio_cnf and cls.handlers:
+            cls.__create_asyncio_handler(**asyncio_cnf)
 
     @classmethod
     @CheckAnnotation.check_params
@@ -108,6 +270,7 @@ class CPXLogger:
         cls.__load_config(config_dict)
 
         cls.__loaded_config = True
+        cls.__reload_logger()
 
     @classmethod
     @CheckAnnotation.check_params
@@ -128,6 +291,7 @@ class CPXLogger:
         cls.__load_config(config_dict)
 
         cls.__loaded_config = True
+        cls.__reload_logger()
 
     @classmethod
     @CheckAnnotation.check_params
@@ -137,19 +301,111 @@ class CPXLogger:
         cls.__clean_config()
 
         with open(config_file_path, "r", encoding=encoding) as f:
-            config_dict = json.loads(f.read(), encoding=encoding)
+            config_dict = json.loads(f.read())
 
         cls.__load_config(config_dict)
 
         cls.__loaded_config = True
+        cls.__reload_logger()
+
+    @classmethod
+    def __reload_logger(cls):
+        # the logger created by the last config gets the new handlers, filters and level
+        if cls.__logger_name:
+            cls.__create_logger(cls.__logger_name)
 
     @classmethod
     def __clean_config(cls):
         # clean all about of the log config
+        if cls.__stats_dumper:
+            cls.__stats_dumper.stop()
+            cls.__stats_dumper = None
+        cls.__stats_handlers.clear()
+        if cls.__logger:
+            for handler in cls.handlers:
+                cls.__logger.removeHandler(handler)
+        if cls.__queue_listener:
+            atexit.unregister(cls.__queue_listener.stop)
+            cls.__queue_listener.stop()
+            # close the real handlers behind the queue, like the ones behind the asyncio handler
+            for handler in cls.__queue_listener.handlers:
+                handler.close()
+            cls.__queue_listener = None
+        if cls.__asyncio_handler:
+            cls.__asyncio_handler.close()
+            cls.__asyncio_handler = None
+        # release the files, the shared clients and the threads of the handlers, include the flight recorder
+        for handler in cls.handlers:
+            handler.close()
         cls.handlers.clear()
+        if cls.__logger:
+            for log_filter in cls.__logger_filters:
+                cls.__logger.removeFilter(log_filter)
+        cls.__logger_filters = list()
         cls.__loaded_config = False
         cls.__logger = None
 
+    @classmethod
+    async def aflush(cls):
+        """
+        Wait for all the records logged handled and flush the handlers, without blocking the running loop.
+        """
+        # asyncio is only imported by the services running in an event loop
+        import asyncio
+
+        if cls.__asyncio_handler:
+            await cls.__asyncio_handler.aflush()
+        elif cls.handlers:
+            await asyncio.get_running_loop().run_in_executor(None, cls.__flush_handlers)
+
+    @classmethod
+    async def aclose(cls):
+        """
+        Flush and close the handlers for the graceful shutdown of the services running in an event loop.
+        """
+        import asyncio
+
+        if cls.__asyncio_handler:
+            await cls.__asyncio_handler.aclose()
+        elif cls.handlers:
+            await asyncio.get_running_loop().run_in_executor(None, cls.__close_handlers)
+        # detach the closed handlers like '__clean_config', the records logged after are not put into them
+        if cls.__logger:
+            for handler in cls.handlers:
+                cls.__logger.removeHandler(handler)
+        cls.__asyncio_handler = None
+        cls.handlers.clear()
+
+    @classmethod
+    def __flush_handlers(cls):
+        if cls.__queue_listener:
+            # wait for the records in the queue handled
+            cls.__queue_listener.queue.join()
+        # include the handlers behind the queue listener
+        for handler in cls.__stats_handlers:
+            handler.flush()
+
+    @classmethod
+    def __close_handlers(cls):
+        if cls.__queue_listener:
+            atexit.unregister(cls.__queue_listener.stop)
+            cls.__queue_listener.stop()
+            cls.__queue_listener = None
+        for handler in cls.__stats_handlers:
+            handler.close()
+
+    @classmethod
+    def stats(cls):
+        """
+        Get the snapshot of the runtime metrics of every handler, include the handlers behind the queue.
+        :return: stats: {<handler name>: {emitted, dropped, failed, bytes_written, rotations, latency_*}}
+        """
+        stats = dict()
+        for index, handler in enumerate(cls.__stats_handlers):
+            name = handler.get_name() or "%s-%d" % (type(handler).__name__, index)
+            stats[name] = handler.cpxStats.snapshot()
+        return stats
+
     @staticmethod
     def create_logger(name="CPXLogger"):
         """
@@ -0,0 +1,113 @@
+"""
+The queue front-end for CPXLogger ASYNC mode. All the handlers created by CPXLogger are put behind one
+CPXQueueListener, and the logger only has the CPXQueueHandler, so the log calling never wait for the
+disk or network I/O.
+"""
+import logging
+import queue
+from logging import handlers
+
+from pcpxlog.cpxStats import HandlerStats
+from pcpxlog.cpxUtils import RECORD_TEMPLATE_ATTR, record_message
+
+# the choices of what the queue handler do when the queue is full,
+# 'Block' will wait for the listener thread, 'DropNewest' will discard the new record,
+# 'DropLowest' will discard the record with the lowest level, the queued one or the new one.
+OVERFLOW_POLICIES = ("Block", "DropNewest", "DropLowest")
+
+
+class LevelDropQueue(queue.Queue):
+    """
+    The bounded queue which can evict the queued record with the lowest level when it is full.
+    """
+
+    def put_or_evict(self, record):
+        """
+        Put the record without blocking. If the queue is full, find the queued record with the lowest
+        level, and replace it when it is lower than the new one, otherwise discard the new one.
+        :return: dropped: True if a record has been discarded
+        """
+        with self.not_full:
+            if self._qsize() < self.maxsize:
+                self._put(record)
+                self.unfinished_tasks += 1
+                self.not_empty.notify()
+                return False
+
+            lowest_index, lowest_level = None, record.levelno
+            for index, queued_record in enumerate(self.queue):
+                # the sentinel of the listener is None, never evict it
+                if queued_record is not None and queued_record.levelno < lowest_level:
+                    lowest_index, lowest_level = index, queued_record.levelno
+            if lowest_index is None:
+                return True
+
+            del self.queue[lowest_index]
+            self._put(record)
+            self.not_empty.notify()
+            return True
+
+
+class CPXQueueHandler(handlers.QueueHandler):
+    """
+    The handler put records into the queue by the overflow policy.
+    """
+
+    def __init__(self, queue_size=10000, overflow="Block"):
+        """
+        :param queue_size: the max count of records waiting in the queue
+        :param overflow: 'Block', 'DropNewest' or 'DropLowest', what to do when the queue is full
+        """
+        assert overflow in OVERFLOW_POLICIES, \
+            ValueError("The value must be one of %s for Param overflow" % (OVERFLOW_POLICIES,))
+        handlers.QueueHandler.__init__(self, LevelDropQueue(maxsize=int(queue_size)))
+        self.overflow = overflow
+        self.cpxStats = HandlerStats()
+        self.__exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        """
+        Merge the args into the message and cache the traceback text, because the args may be changed
+        after the logging calling. Different from 'QueueHandler.prepare', the record is not formatted,
+        every handler behind the listener formats it with its own formatter. The msg before merging is kept
+        for the filters of the handlers, like 'DedupeFilter'.
+        """
+        if record.args:
+            record.__dict__.setdefault(RECORD_TEMPLATE_ATTR, record.msg)
+        record.msg = record_message(record)
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.__exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        """
+        Put the record into the queue by self.overflow
+        """
+        if self.overflow == "Block":
+            self.queue.put(record)
+        elif self.overflow == "DropLowest":
+            if self.queue.put_or_evict(record):
+                self.cpxStats.count_dropped()
+        else:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.cpxStats.count_dropped()
+
+
+class CPXQueueListener(handlers.QueueListener):
+    """
+    The listener take records out of the queue, and dispatch them to the real handlers in a thread.
+    """
+
+    def __init__(self, queue_handler, *real_handlers):
+        handlers.QueueListener.__init__(self, queue_handler.queue, *real_handlers, respect_handler_level=True)
+
+    def enqueue_sentinel(self):
+        """
+        Wait for a free slot to put the sentinel, the queue may be full when stopping.
+        """
+        self.queue.put(self._sentinel)
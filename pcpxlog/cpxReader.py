@@ -0,0 +1,316 @@
+"""
+Read the log data saved by 'RotatingMongodbHandler' back out of mongodb, by a time range.
+
+The time span of every log collection is derived from its name: a 'Rotating' collection
+'<coll_name>_<YYYYmmdd_HH_MM_SS_ffffff>' is created when the previous one is full, so it holds the log data
+from its create time to the create time of the next one, and a 'Timed' collection '<coll_name>_<YYYYmmdd_HH>'
+or '<coll_name>_<YYYYmmdd>' is one bucket. Only the collections overlapping the time range are queried.
+
+The '_id' of the log data is an ObjectId created when the log is emitted, it contains the time in seconds,
+so the time range is queried by '_id' without any extra time field.
+
+The interned tracebacks and the compressed messages are given back, so the log data read is the same as
+the one saved without 'INTERN_TRACEBACKS' and 'COMPRESS_THRESHOLD'.
+
+The log counts saved by 'ROLLUP' are read as the time series from the '<coll_name>_rollups' collection, it
+only reads one document every minute and key, however many log data there are.
+
+eg:
+    cpxLogReader --start 2019-06-12T10:00 --end 2019-06-12T11:00 --level ERROR CRITICAL --fields asctime message
+    cpxLogReader --rollups --start 2019-06-12 --end 2019-06-13 --group-by levelname name --step 3600
+"""
+import argparse
+import datetime
+import json
+import math
+import sys
+import zlib
+
+from bson import ObjectId
+from pymongo import ASCENDING
+
+from pcpxlog.cpxHandlers import MONGO_CLIENTS, create_mongodb_uri, COMPRESSED_MESSAGE_KEY, INTERNED_FIELDS, \
+    INTERNED_REF_SUFFIX, TRACEBACK_COLL_SUFFIX, ROLLUP_COLL_SUFFIX, ROLLUP_SPAN
+from pcpxlog.cpxUtils import to_timestamp
+
+# the time formats of the log collection names, 'Rotating', 'Timed' by hour and 'Timed' by day
+COLL_TIME_FORMATS = ("%Y%m%d_%H_%M_%S_%f", "%Y%m%d_%H", "%Y%m%d")
+# the fields the log counts can be grouped by
+ROLLUP_GROUP_FIELDS = ("levelname", "name", "line")
+
+
+def parse_coll_time(base_coll_name, coll_name):
+    """
+    Get the create time of the log collection from its name.
+    :return: timestamp: the POSIX timestamp, or None if the name is not a log collection name
+    """
+    prefix = base_coll_name + "_"
+    if not coll_name.startswith(prefix):
+        return None
+    for time_format in COLL_TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(coll_name[len(prefix):], time_format).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def timestamp_object_id(timestamp):
+    """
+    Get the smallest ObjectId of the second of the timestamp.
+    """
+    return ObjectId.from_datetime(datetime.datetime.fromtimestamp(int(timestamp), datetime.timezone.utc))
+
+
+class CPXLogReader:
+    """
+    Query the log data in the log collections of one 'RotatingMongodbHandler' config.
+
+    The log data may be saved a little later than it is emitted, by the batch mode or the other processes,
+    so it may be in a collection created after its time. The 'late_seconds' widens the time span of every
+    collection for this. The log data replayed from the spool file may be much later than it, set a bigger
+    'late_seconds' to find them.
+    """
+
+    def __init__(self, host="127.0.0.1", port=27017, user=None, password=None, db="CPXLog", coll_name="logs",
+                 uri=None, late_seconds=60, server_selection_timeout_ms=30000):
+        """
+        :param db: the database name of the log collections
+        :param coll_name: the basic name of the log collections, the 'COLL_NAME' of the handler config
+        :param uri: the mongodb connection uri, it takes the place of host, port, user and password
+        :param late_seconds: the max seconds of the log data saved after it is emitted
+        :param server_selection_timeout_ms: the timeout of finding an available server, in milliseconds
+        """
+        if not uri:
+            uri = create_mongodb_uri(host, port, user, password)
+        self.client, self.__clientKey = MONGO_CLIENTS.acquire(
+            uri, serverSelectionTimeoutMS=server_selection_timeout_ms)
+        self.db = self.client[db]
+        self.baseCollName = coll_name
+        self.lateSeconds = late_seconds
+        self.__stateCollName = "logSavingState"
+        self.__handlerTag = "CPXLog-mongodb"
+        self.tracebackColl = self.db[coll_name + TRACEBACK_COLL_SUFFIX]
+        self.rollupColl = self.db[coll_name + ROLLUP_COLL_SUFFIX]
+        # {hash: text} of the interned tracebacks read
+        self.__tracebacks = dict()
+
+    def coll_spans(self):
+        """
+        Get the log collections and their time spans, from the earliest to the latest. The 'Rotating' collections
+        are read from the 'logSavingState', the others are found by their names.
+        :return: spans: [(coll_name, start_time, end_time)], the times are timestamps, the end_time of the latest
+            collection is None, and both of them are None for the 'Capped' collection
+        """
+        log_saving_state = self.db[self.__stateCollName].find_one(
+            {"tag": self.__handlerTag}, projection={"history_log_coll.name": 1, "current_log_coll.name": 1})
+        if log_saving_state:
+            coll_names = [coll["name"] for coll in log_saving_state["history_log_coll"]]
+            coll_names.append(log_saving_state["current_log_coll"]["name"])
+        else:
+            all_names = self.db.list_collection_names()
+            if self.baseCollName in all_names:
+                return [(self.baseCollName, None, None)]
+            coll_names = sorted(name for name in all_names if parse_coll_time(self.baseCollName, name) is not None)
+
+        start_times = [parse_coll_time(self.baseCollName, name) for name in coll_names]
+        end_times = start_times[1:] + [None]
+        return list(zip(coll_names, start_times, end_times))
+
+    def __overlaps(self, coll_start, coll_end, start, end):
+        """
+        Check the time span of the log collection, widened by self.lateSeconds, overlaps [start, end) or not.
+        """
+        if end is not None and coll_start is not None and coll_start - self.lateSeconds >= end:
+            return False
+        if start is not None and coll_end is not None and coll_end <= start:
+            return False
+        return True
+
+    def __traceback_text(self, key):
+        """
+        Get the interned traceback text by its hash, every distinct one is queried once.
+        """
+        text = self.__tracebacks.get(key)
+        if text is None:
+            if len(self.__tracebacks) >= 10000:
+                self.__tracebacks.clear()
+            traceback_data = self.tracebackColl.find_one({"_id": key}, projection={"text": 1})
+            text = traceback_data["text"] if traceback_data else ""
+            self.__tracebacks[key] = text
+        return text
+
+    def restore(self, log_data):
+        """
+        Give back the compressed message and the interned tracebacks of the log data.
+        """
+        compressed = log_data.pop(COMPRESSED_MESSAGE_KEY, None)
+        if compressed is not None:
+            log_data["message"] = zlib.decompress(compressed).decode("utf-8")
+        for field in INTERNED_FIELDS:
+            key = log_data.pop(field + INTERNED_REF_SUFFIX, None)
+            if key is not None:
+                log_data[field] = self.__traceback_text(bytes(key))
+        return log_data
+
+    def find(self, start=None, end=None, levels=None, names=None, fields=None, filter=None, batch_size=1000,
+             limit=0):
+        """
+        Query the log data in the time range [start, end) from the overlapping log collections, the time
+        precision is one second. The log data is given back by a generator in time order, and every collection
+        is read by a cursor in batches, so it never loads all of them into memory.
+
+        The 'levels' and 'names' need the 'levelname' and 'name' fields saved by the format string, and the
+        handler creates the '(levelname, _id)' and '(name, _id)' indexes for them.
+
+        :param start: the start time, a timestamp, a datetime object or an ISO format string
+        :param end: the end time, not included
+        :param levels: the level names, like ['ERROR', 'CRITICAL']
+        :param names: the logger names
+        :param fields: the field names to return, all the fields by default
+        :param filter: the other mongodb query conditions
+        :param batch_size: the count of log data in one batch of the cursor
+        :param limit: the max count of log data, 0 for no limit
+        """
+        start, end = to_timestamp(start), to_timestamp(end)
+        query = dict(filter or dict())
+        id_range = dict()
+        if start is not None:
+            id_range["$gte"] = timestamp_object_id(start)
+        if end is not None:
+            id_range["$lt"] = timestamp_object_id(math.ceil(end))
+        if id_range:
+            query["_id"] = id_range
+        if levels:
+            query["levelname"] = {"$in": list(levels)}
+        if names:
+            query["name"] = {"$in": list(names)}
+        projection = None
+        if fields:
+            projection = dict.fromkeys(fields, 1)
+            # the compressed message and the interned tracebacks are saved by other keys
+            if "message" in fields:
+                projection[COMPRESSED_MESSAGE_KEY] = 1
+            for field in INTERNED_FIELDS:
+                if field in fields:
+                    projection[field + INTERNED_REF_SUFFIX] = 1
+
+        count = 0
+        for coll_name, coll_start, coll_end in self.coll_spans():
+            if not self.__overlaps(coll_start, coll_end, start, end):
+                continue
+            cursor = self.db[coll_name].find(query, projection=projection, batch_size=batch_size)
+            cursor.sort("_id", ASCENDING)
+            if limit:
+                cursor.limit(limit - count)
+            for log_data in cursor:
+                count += 1
+                yield self.restore(log_data)
+            if limit and count >= limit:
+                return
+
+    def rollups(self, start=None, end=None, levels=None, names=None, group_by=("levelname",), step=ROLLUP_SPAN):
+        """
+        Get the log counts time series in the time range [start, end) from the rollup collection, the time
+        precision is one minute. The counts are summed by mongodb, every 'step' seconds of every group.
+
+        :param start: the start time, a timestamp, a datetime object or an ISO format string
+        :param end: the end time, not included
+        :param levels: the level names, like ['ERROR', 'CRITICAL']
+        :param names: the logger names
+        :param group_by: the fields of one series, some of 'levelname', 'name' and 'line', empty for the total
+        :param step: the seconds of one point, a multiple of 60
+        :return: series: {(<group_by values>): [(timestamp, count)]}, the points are in time order, and the
+            ones without log data are not given
+        """
+        assert all(field in ROLLUP_GROUP_FIELDS for field in group_by), \
+            ValueError("The value must be some of %s for Param group_by" % (ROLLUP_GROUP_FIELDS,))
+        assert step > 0 and step % ROLLUP_SPAN == 0, \
+            ValueError("The value must be a multiple of %s for Param step" % ROLLUP_SPAN)
+        start, end = to_timestamp(start), to_timestamp(end)
+        query = dict()
+        minute_range = dict()
+        if start is not None:
+            minute_range["$gte"] = datetime.datetime.fromtimestamp(start // ROLLUP_SPAN * ROLLUP_SPAN,
+                                                                   datetime.timezone.utc)
+        if end is not None:
+            minute_range["$lt"] = datetime.datetime.fromtimestamp(end, datetime.timezone.utc)
+        if minute_range:
+            query["minute"] = minute_range
+        if levels:
+            query["levelname"] = {"$in": list(levels)}
+        if names:
+            query["name"] = {"$in": list(names)}
+
+        # the date minus its milliseconds in the step is the start date of the step, the date minus the epoch
+        # date is its milliseconds
+        point_time = "$minute"
+        if step != ROLLUP_SPAN:
+            epoch = datetime.datetime(1970, 1, 1)
+            point_time = {"$subtract": ["$minute", {"$mod": [{"$subtract": ["$minute", epoch]}, step * 1000]}]}
+        group_id = dict(time=point_time)
+        for field in group_by:
+            group_id[field] = "$" + field
+        pipeline = [{"$match": query},
+                    {"$group": {"_id": group_id, "count": {"$sum": "$count"}}},
+                    {"$sort": {"_id.time": ASCENDING}}]
+
+        series = dict()
+        for point in self.rollupColl.aggregate(pipeline):
+            group = tuple(point["_id"].get(field) for field in group_by)
+            timestamp = point["_id"]["time"].replace(tzinfo=datetime.timezone.utc).timestamp()
+            series.setdefault(group, list()).append((timestamp, point["count"]))
+        return series
+
+    def close(self):
+        """
+        Release the shared mongodb client.
+        """
+        MONGO_CLIENTS.release(self.__clientKey)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="cpxLogReader", description="Read the log data saved in mongodb")
+    parser.add_argument("--uri", default="mongodb://127.0.0.1:27017/")
+    parser.add_argument("--db", default="CPXLog")
+    parser.add_argument("--coll-name", default="logs", help="the basic name of the log collections")
+    parser.add_argument("--start", help="the start time, an ISO format string or a timestamp")
+    parser.add_argument("--end", help="the end time, not included")
+    parser.add_argument("--level", nargs="+", help="the level names")
+    parser.add_argument("--name", nargs="+", help="the logger names")
+    parser.add_argument("--fields", nargs="+", help="the field names to print")
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--late-seconds", type=float, default=60)
+    parser.add_argument("--list", action="store_true", help="only print the log collections and their time spans")
+    parser.add_argument("--rollups", action="store_true", help="print the log counts time series instead")
+    parser.add_argument("--group-by", nargs="*", default=["levelname"], choices=ROLLUP_GROUP_FIELDS,
+                        help="the fields of one series of the log counts")
+    parser.add_argument("--step", type=int, default=ROLLUP_SPAN, help="the seconds of one point of the log counts")
+    args = parser.parse_args()
+
+    reader = CPXLogReader(uri=args.uri, db=args.db, coll_name=args.coll_name, late_seconds=args.late_seconds)
+    try:
+        if args.list:
+            for coll_name, start_time, end_time in reader.coll_spans():
+                print(json.dumps(dict(coll_name=coll_name, start_time=start_time, end_time=end_time)))
+            return
+        if args.rollups:
+            series = reader.rollups(start=to_timestamp(args.start), end=to_timestamp(args.end), levels=args.level,
+                                    names=args.name, group_by=args.group_by, step=args.step)
+            for group, points in series.items():
+                print(json.dumps(dict(zip(args.group_by, group), points=points), ensure_ascii=False))
+            return
+        for log_data in reader.find(start=to_timestamp(args.start), end=to_timestamp(args.end), levels=args.level,
+                                    names=args.name, fields=args.fields, batch_size=args.batch_size,
+                                    limit=args.limit):
+            print(json.dumps(log_data, default=str, ensure_ascii=False))
+    except BrokenPipeError:
+        # the output is piped into a command like 'head'
+        sys.stderr.close()
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+The flight recorder handler, it keeps the DEBUG context in memory, and only writes it when an error comes.
+
+The last 'capacity' records of every logger are kept in a ring preallocated for the logger. A slot of the ring
+is the tuple of the record fields compiled from the format string, with the message merged, so the
+LogRecord objects and their args are not kept. When a record of 'trigger_level' or higher comes, the records
+in the ring of its logger are rebuilt and handled by the target handlers, like the 'File' and 'Mongodb' ones
+created by CPXLogger, from the oldest to the latest, and the ring is cleared. The targets only get the records
+lower than their own levels, the others have been handled by them through the logger.
+
+A logger dumps its ring at most once every 'cooldown' seconds, the records of an error storm are still kept,
+and written by the first error after the cooldown.
+"""
+import logging
+import operator
+import time
+
+from pcpxlog.cpxUtils import compile_format_fields, record_message
+
+# the fields always kept, the 'asctime' is formatted again by the targets from 'created'
+RECORDED_FIELDS = ("name", "levelno", "levelname", "created", "msecs", "message", "exc_text")
+
+
+class RecordRing:
+    """
+    The preallocated ring of the record fields tuples of one logger.
+    """
+    __slots__ = ("slots", "index", "dumpTime")
+
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.index = 0
+        # the time of monotonic clock the ring can be dumped again
+        self.dumpTime = 0
+
+    def append(self, values):
+        slots = self.slots
+        slots[self.index] = values
+        self.index = (self.index + 1) % len(slots)
+
+    def drain(self):
+        """
+        Take out all the tuples from the oldest to the latest, and clear the ring.
+        """
+        slots = self.slots
+        values_list = [values for values in slots[self.index:] + slots[:self.index] if values is not None]
+        slots[:] = [None] * len(slots)
+        self.index = 0
+        return values_list
+
+
+class FlightRecorderHandler(logging.Handler):
+    """
+    The handler keeps the records in the rings of their loggers, and dumps the ring into the target handlers
+    when a record of the trigger level comes.
+    """
+
+    def __init__(self, capacity=1000, trigger_level="ERROR", cooldown=60, targets=("File", "Mongodb")):
+        """
+        :param capacity: the count of records kept for every logger
+        :param trigger_level: the level name or number of the records which dump the ring
+        :param cooldown: the min seconds between two dumps of a logger
+        :param targets: the config section names of the target handlers, see 'bind_targets'
+        """
+        logging.Handler.__init__(self)
+        assert int(capacity) > 0, ValueError("The value out of range for Param capacity")
+        self.capacity = int(capacity)
+        self.triggerLevel = getattr(logging, trigger_level) if isinstance(trigger_level, str) else trigger_level
+        self.cooldown = cooldown
+        self.targetSections = tuple(targets)
+        self.targets = list()
+        self.__rings = dict()
+        self.__fields = RECORDED_FIELDS
+        self.__fieldsGetter = operator.attrgetter(*RECORDED_FIELDS)
+        self.__fieldsFormatter = None
+        self.__exc_formatter = logging.Formatter()
+
+    def bind_targets(self, section_handlers):
+        """
+        Get the target handlers from the handlers created by CPXLogger.
+        :param section_handlers: {config section name: handler}
+        """
+        self.targets = [section_handlers[section] for section in self.targetSections
+                        if section in section_handlers]
+        assert self.targets, ValueError("No handler of the targets %s is configured" % (self.targetSections,))
+
+    def __compile_fields(self):
+        """
+        Get the fields kept from self.formatter, the rings of the old fields are cleared.
+        """
+        fields = RECORDED_FIELDS
+        if self.formatter is not None:
+            fields += compile_format_fields(self.formatter)
+        self.__fields = tuple(field for field in dict.fromkeys(fields) if field != "asctime")
+        self.__fieldsGetter = operator.attrgetter(*self.__fields)
+        self.__fieldsFormatter = self.formatter
+        self.__rings.clear()
+
+    def __record_values(self, record):
+        """
+        Get the tuple of the fields kept, the message is merged and the traceback is formatted.
+        """
+        record.message = record_message(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = (self.formatter or self.__exc_formatter).formatException(record.exc_info)
+        try:
+            return self.__fieldsGetter(record)
+        except AttributeError:
+            # the custom attributes from 'extra=' may not be in every record
+            return tuple(getattr(record, field, None) for field in self.__fields)
+
+    def __dump(self, ring):
+        """
+        Handle the records in the ring by the target handlers, if the cooldown is over.
+        """
+        now = time.monotonic()
+        if now < ring.dumpTime:
+            return
+        ring.dumpTime = now + self.cooldown
+        fields = self.__fields
+        for values in ring.drain():
+            log_data = dict(zip(fields, values))
+            log_data["msg"] = log_data["message"]
+            record = logging.makeLogRecord(log_data)
+            for handler in self.targets:
+                if record.levelno < handler.level:
+                    handler.handle(record)
+
+    def emit(self, record):
+        """
+        Put the record into the ring of its logger, or dump the ring if it is of the trigger level.
+        """
+        try:
+            # the formatter may be replaced after the handler is created
+            if self.formatter is not self.__fieldsFormatter:
+                self.__compile_fields()
+            ring = self.__rings.get(record.name)
+            if ring is None:
+                ring = self.__rings[record.name] = RecordRing(self.capacity)
+            if record.levelno >= self.triggerLevel:
+                self.__dump(ring)
+            else:
+                ring.append(self.__record_values(record))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        """
+        Drop the records kept, the target handlers are closed by themselves.
+        """
+        self.__rings.clear()
+        logging.Handler.close(self)
@@ -0,0 +1,161 @@
+"""
+The handler saves log information into a redis stream, it needs the 'redis' package.
+"""
+import logging
+from urllib.parse import quote
+
+import redis
+
+from pcpxlog.cpxBatch import BatchWriter
+from pcpxlog.cpxStats import HandlerStats
+from pcpxlog.cpxUtils import RecordFieldsMixin, SharedClients
+
+# the connection pools shared by handlers with the same uri and options, redis connects when it is used
+REDIS_POOLS = SharedClients(lambda uri, **options: redis.ConnectionPool.from_url(uri, **options),
+                            lambda pool: pool.disconnect())
+
+# the value types can be saved into a stream entry directly, the others are saved as str
+_STREAM_VALUE_TYPES = (str, bytes, int, float)
+
+
+def create_redis_uri(host, port, db=0, user=None, password=None):
+    """
+    Create the redis connection uri, the user and password are quoted. Redis unquotes them by 'unquote', so
+    the spaces are quoted as '%20' but not '+'.
+    """
+    if user or password:
+        return "redis://%s:%s@%s:%s/%s" % (quote(user or "", safe=""), quote(password or "", safe=""),
+                                          host, port, db)
+    return "redis://%s:%s/%s" % (host, port, db)
+
+
+class RedisStreamHandler(RecordFieldsMixin, logging.Handler):
+    """
+    The handler class, helping save log information into a redis stream. Every record is an entry of the
+    stream named 'stream', its fields are the fields used by the format string and the 'extra_fields'.
+
+    The stream is trimmed by 'XADD ... MAXLEN ~ <maxlen>' when adding entries, so redis keeps the latest
+    'maxlen' log information itself, there is no rotation state to record like 'RotatingMongodbHandler'.
+
+    If 'batch' is True, the entries are added by a background thread, one pipeline for every batch.
+    """
+
+    def __init__(self, host="127.0.0.1", port=6379, password=None, db=0, uri=None, user=None, stream="CPXLog",
+                 maxlen=1000000, approximate=True, batch=True, batch_size=500, batch_bytes=1024 * 1024,
+                 linger_ms=100, queue_capacity=10000, queue_full_policy="Block", extra_fields=(),
+                 max_connections=50, socket_timeout=5):
+        """
+        Get the shared connection pool, redis connects when the first log data is saving.
+
+        :param db: the redis database number
+        :param uri: the redis connection uri, it takes the place of host, port, user, password and db
+        :param user: the redis ACL user name, the 'default' user if not set
+        :param stream: the stream key for save logs information
+        :param maxlen: the max length of the stream
+        :param approximate: trim the stream by 'MAXLEN ~', it is much faster than trimming exactly
+        :param batch: add entries by a background thread in batches or not
+        :param batch_size: the max count of entries in one pipeline
+        :param batch_bytes: the max size of entries in one pipeline
+        :param linger_ms: the max time a batch wait for more log data, in milliseconds
+        :param queue_capacity: the max count of log data waiting in the queue
+        :param queue_full_policy: 'Block' or 'Drop', what to do when the queue is full
+        :param extra_fields: the names of custom attributes from 'extra=', which should be saved too
+        :param max_connections: the max count of connections in the shared pool
+        :param socket_timeout: the timeout of the connections, in seconds
+        """
+        logging.Handler.__init__(self)
+        # 'close' may be called again by 'logging.shutdown' or a reloading, the pool is released only once
+        self._closed = False
+        assert int(maxlen) > 0, ValueError("The value out of range for Param maxlen")
+        if not uri:
+            uri = create_redis_uri(host, port, db=db, user=user, password=password)
+        pool, self.__poolKey = REDIS_POOLS.acquire(uri, max_connections=max_connections,
+                                                   socket_timeout=socket_timeout)
+        self.client = redis.Redis(connection_pool=pool)
+
+        self.stream = stream
+        self.maxlen = int(maxlen)
+        self.approximate = bool(approximate)
+        self.extraFields = tuple(extra_fields)
+        self.cpxStats = HandlerStats()
+
+        self.batch = bool(batch)
+        self.__writer = None
+        if self.batch:
+            self.__writer = BatchWriter(self.__save_batch, name="CPXLog-redis-writer", batch_size=batch_size,
+                                        batch_bytes=batch_bytes, linger_ms=linger_ms, queue_capacity=queue_capacity,
+                                        queue_full_policy=queue_full_policy, prepare=self.__prepare_entry,
+                                        stats=self.cpxStats)
+
+    def parse_log(self, record):
+        """
+        Translate the record object into the fields of a stream entry
+        :param record: the log record object
+        :return: entry: {field name: value}
+        """
+        entry = dict()
+        for key, value in self.record_fields(record).items():
+            if type(value) not in _STREAM_VALUE_TYPES:
+                value = "" if value is None else str(value)
+            entry[key] = value
+        return entry
+
+    @staticmethod
+    def __prepare_entry(entry):
+        """
+        Get the approximate size of the entry for the batch.
+        """
+        size = 0
+        for key, value in entry.items():
+            size += len(key) + (len(value) if isinstance(value, (str, bytes)) else 8)
+        return entry, size
+
+    def save_many(self, entries):
+        """
+        Add the entries into the stream in one pipeline, every 'XADD' trims the stream.
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        for entry in entries:
+            pipeline.xadd(self.stream, entry, maxlen=self.maxlen, approximate=self.approximate)
+        pipeline.execute()
+
+    def __save_batch(self, entries):
+        try:
+            self.save_many(entries)
+            self.cpxStats.count_bytes(sum(self.__prepare_entry(entry)[1] for entry in entries))
+        except Exception:
+            for _ in entries:
+                self.cpxStats.count_failed()
+
+    def emit(self, record):
+        """
+        Get the stream entry from record, then add it into redis.
+        """
+        try:
+            entry = self.parse_log(record)
+            if self.batch:
+                self.__writer.put(entry)
+            else:
+                self.client.xadd(self.stream, entry, maxlen=self.maxlen, approximate=self.approximate)
+                self.cpxStats.count_bytes(self.__prepare_entry(entry)[1])
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Wait for all the log data in the queue saved, only work in batch mode.
+        """
+        if self.__writer:
+            self.__writer.flush()
+
+    def close(self):
+        """
+        Stop the background writer thread after the queue is empty, and release the shared connection pool
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self.__writer:
+            self.__writer.close()
+        REDIS_POOLS.release(self.__poolKey)
+        logging.Handler.close(self)
@@ -0,0 +1,91 @@
+"""
+The local append-only spool file, it keeps the log data which can not be saved into the backend for now,
+and gives them back in batches to replay when the backend is reachable again.
+
+Every record in the file is a 4 bytes little-endian length and the payload bytes.
+"""
+import os
+import struct
+import threading
+
+_LENGTH = struct.Struct("<I")
+
+
+class DiskSpool:
+    """
+    When replaying, the spool file is renamed to '<path>.replay' first, so the new records are appended into
+    a new spool file at the same time. The '.replay' file is removed after all of it replayed, if the replay
+    is broken, it will be replayed again from the beginning.
+    """
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        """
+        :param path: the spool file path
+        :param max_bytes: the max size of the spool file, the new records are dropped when it is full
+        """
+        self.path = path
+        self.replayPath = path + ".replay"
+        self.maxBytes = int(max_bytes)
+        self.__lock = threading.Lock()
+
+        spool_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(spool_dir, exist_ok=True)
+        self.__size = os.path.getsize(path) if os.path.exists(path) else 0
+
+    def append(self, payloads):
+        """
+        Append the payloads into the spool file.
+        :param payloads: a list of bytes
+        :return: count: the count of payloads appended, the others are dropped because the spool is full
+        """
+        count = 0
+        with self.__lock:
+            with open(self.path, "ab") as f:
+                for payload in payloads:
+                    record_size = _LENGTH.size + len(payload)
+                    if self.__size + record_size > self.maxBytes:
+                        break
+                    f.write(_LENGTH.pack(len(payload)))
+                    f.write(payload)
+                    self.__size += record_size
+                    count += 1
+        return count
+
+    def has_data(self):
+        return self.__size > 0 or os.path.exists(self.replayPath)
+
+    def __read_payloads(self, f):
+        while True:
+            length_bytes = f.read(_LENGTH.size)
+            if len(length_bytes) < _LENGTH.size:
+                return
+            length, = _LENGTH.unpack(length_bytes)
+            payload = f.read(length)
+            # the last record may be broken when the process crashed
+            if len(payload) < length:
+                return
+            yield payload
+
+    def iter_batches(self, batch_size):
+        """
+        Give back the spooled payloads in batches, the replayed file is removed after the caller
+        consumes all the batches without error.
+        """
+        with self.__lock:
+            if not os.path.exists(self.replayPath):
+                if not self.__size:
+                    return
+                os.replace(self.path, self.replayPath)
+                self.__size = 0
+
+        with open(self.replayPath, "rb") as f:
+            batch = list()
+            for payload in self.__read_payloads(f):
+                batch.append(payload)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = list()
+            if batch:
+                yield batch
+
+        os.remove(self.replayPath)
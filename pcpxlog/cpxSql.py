@@ -0,0 +1,309 @@
+"""
+The handler saves log information into a sql database by a DB-API driver, like the stdlib 'sqlite3' or
+the mysql drivers 'pymysql' and 'MySQLdb'.
+"""
+import importlib
+import logging
+import re
+
+from pcpxlog.cpxBatch import BatchWriter
+from pcpxlog.cpxStats import HandlerStats
+from pcpxlog.cpxUtils import RecordFieldsMixin, compile_format_fields
+
+# the columns every log table has, so the time, level and name indexes always work
+BASE_COLUMNS = ("created", "levelno", "levelname", "name")
+# the indexed columns of every log table
+INDEX_COLUMNS = ("created", "levelno", "name")
+# the column types of the record attributes, the others are 'TEXT'.
+# Both sqlite and mysql know these types, and mysql can not index a 'TEXT' column without a length.
+COLUMN_TYPES = dict(
+    created="DOUBLE", msecs="DOUBLE", relativeCreated="DOUBLE",
+    levelno="BIGINT", lineno="BIGINT", process="BIGINT", thread="BIGINT",
+    name="VARCHAR(255)", levelname="VARCHAR(16)", module="VARCHAR(255)", funcName="VARCHAR(255)",
+    filename="VARCHAR(255)", threadName="VARCHAR(255)", processName="VARCHAR(255)", asctime="VARCHAR(64)",
+)
+# the placeholder of every DB-API paramstyle supported, 'numeric' needs the position
+PLACEHOLDERS = dict(qmark="?", format="%s", pyformat="%s", numeric=":%d")
+
+# the value types can be saved into a column directly, the others are saved as str
+_COLUMN_VALUE_TYPES = (str, bytes, int, float, type(None))
+_NAME_PATTERN = re.compile(r"^\w+$")
+
+
+class SqlHandler(RecordFieldsMixin, logging.Handler):
+    """
+    The handler class, helping save log information into a sql database.
+    Every record is a row of the '<table>_<index>' table, whose columns are the 'created', 'levelno',
+    'levelname' and 'name', the fields used by the format string, the 'extra_fields', and 'exc_text' and
+    'stack_info'. The schema is created from the formatter when the first log data is saving, with the
+    indexes on 'created', 'levelno' and 'name'.
+
+    Like 'RotatingMongodbHandler', the log tables are rotated. The '<table>_state' table records the index
+    and the row count of the current log table for the handler 'tag':
+
+        tag | current_index | current_rows
+
+    When 'current_rows' is more than 'table_rows', a new log table is created, and the tables older than the
+    latest 'table_count' ones are dropped. The count is added by 'UPDATE' in the same transaction of the
+    'executemany', so many processes with the same tag can share the tables safely. The 'CREATE' and 'DROP'
+    run out of that transaction, in their own steps, because mysql commits the transaction at any DDL.
+
+    If 'batch' is True, the rows are saved by a background thread, one transaction for every batch,
+    otherwise every record is committed one by one.
+    """
+
+    def __init__(self, driver="sqlite3", database="CPXLog.db", connect_params=None, table="logs", tag="CPXLog-sql",
+                 table_rows=1000000, table_count=10, wal=True, batch=True, batch_size=500, batch_bytes=1024 * 1024,
+                 linger_ms=200, queue_capacity=10000, queue_full_policy="Block", extra_fields=()):
+        """
+        The connection is created when the first log data is saving.
+
+        :param driver: the module name of the DB-API driver, like 'sqlite3', 'pymysql' or 'MySQLdb'
+        :param database: the database file path for 'sqlite3', it is not used if connect_params is set
+        :param connect_params: the keyword params of 'driver.connect', like host, port, user, password, database
+        :param table: the basic name of the log tables
+        :param tag: the name of the rotation state, the handlers with the same tag share the log tables
+        :param table_rows: the max count of rows in one log table
+        :param table_count: the max count of log tables kept
+        :param wal: use the 'WAL' journal mode of sqlite, the readers and the writer do not block each other
+        :param batch: save rows by a background thread in batches or not
+        :param batch_size: the max count of rows in one transaction
+        :param batch_bytes: the max size of rows in one transaction
+        :param linger_ms: the max time a batch wait for more log data, in milliseconds
+        :param queue_capacity: the max count of log data waiting in the queue
+        :param queue_full_policy: 'Block' or 'Drop', what to do when the queue is full
+        :param extra_fields: the names of custom attributes from 'extra=', which should be saved too
+        """
+        logging.Handler.__init__(self)
+        assert _NAME_PATTERN.match(table), ValueError("The value must be a word for Param table")
+        assert int(table_rows) > 0, ValueError("The value out of range for Param table_rows")
+        assert int(table_count) > 0, ValueError("The value out of range for Param table_count")
+
+        self.driver = importlib.import_module(driver)
+        assert self.driver.paramstyle in PLACEHOLDERS, \
+            ValueError("The paramstyle '%s' of Param driver is not supported" % self.driver.paramstyle)
+        self.database = database
+        self.connectParams = dict(connect_params or dict())
+        self.baseTableName = table
+        self.stateTableName = table + "_state"
+        self.tag = tag
+        self.tableRows = int(table_rows)
+        self.tableCount = int(table_count)
+        self.wal = bool(wal)
+        self.extraFields = tuple(extra_fields)
+        self.cpxStats = HandlerStats()
+
+        self.__connection = None
+        self.__columns = None
+        # the indexes of the log tables created by this handler
+        self.__createdTables = set()
+
+        self.batch = bool(batch)
+        self.__writer = None
+        if self.batch:
+            self.__writer = BatchWriter(self.__save_batch, name="CPXLog-sql-writer", batch_size=batch_size,
+                                        batch_bytes=batch_bytes, linger_ms=linger_ms, queue_capacity=queue_capacity,
+                                        queue_full_policy=queue_full_policy, prepare=self.__prepare_row,
+                                        stats=self.cpxStats)
+
+    def __placeholder(self, position):
+        """
+        Get the placeholder of the driver paramstyle for the param at the position, counting from 1.
+        """
+        placeholder = PLACEHOLDERS[self.driver.paramstyle]
+        return placeholder % position if "%d" in placeholder else placeholder
+
+    def __placeholders(self, count):
+        return ", ".join(self.__placeholder(position) for position in range(1, count + 1))
+
+    def __compile_columns(self):
+        """
+        Get the column names from the formatter only once, the schema of the log tables is fixed after it.
+        """
+        fields = compile_format_fields(self.formatter or logging.Formatter(), self.extraFields)
+        columns = tuple(dict.fromkeys(BASE_COLUMNS + fields + ("exc_text", "stack_info")))
+        for column in columns:
+            assert _NAME_PATTERN.match(column), ValueError("The field '%s' can not be a column name" % column)
+        self.__columns = columns
+
+    def __connect(self):
+        """
+        Connect the database, and create the state table and the state row of self.tag if they are not existed.
+        """
+        if self.connectParams:
+            connection = self.driver.connect(**self.connectParams)
+        elif self.driver.__name__ == "sqlite3":
+            # the sync mode may save log data from any thread, they are serialized by the handler lock
+            connection = self.driver.connect(self.database, check_same_thread=False)
+        else:
+            connection = self.driver.connect(self.database)
+
+        cursor = connection.cursor()
+        if self.wal and self.driver.__name__ == "sqlite3":
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s (tag VARCHAR(64) PRIMARY KEY, current_index BIGINT, "
+                       "current_rows BIGINT)" % self.stateTableName)
+        try:
+            cursor.execute("INSERT INTO %s (tag, current_index, current_rows) VALUES (%s)"
+                           % (self.stateTableName, self.__placeholders(3)), (self.tag, 0, 0))
+            connection.commit()
+        except self.driver.IntegrityError:
+            # another process inserted the state at the same time
+            connection.rollback()
+        cursor.close()
+        self.__connection = connection
+
+    def __create_table(self, cursor, index):
+        """
+        Create the log table of the index and its indexes if the table is not existed.
+        """
+        if index in self.__createdTables:
+            return
+        table_name = "%s_%d" % (self.baseTableName, index)
+        column_defines = ", ".join("%s %s" % (column, COLUMN_TYPES.get(column, "TEXT")) for column in self.__columns)
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s (%s)" % (table_name, column_defines))
+        for column in INDEX_COLUMNS:
+            try:
+                cursor.execute("CREATE INDEX %s_%s ON %s (%s)" % (table_name, column, table_name, column))
+            except self.driver.DatabaseError:
+                # the index has been created, mysql does not know 'CREATE INDEX IF NOT EXISTS'
+                pass
+        self.__createdTables.add(index)
+
+    def __count_table_rows(self, cursor, rows_count):
+        """
+        Add the rows_count into the current log table by 'UPDATE', it locks the state row until the transaction
+        is over. When the current log table is full, rotate to a new one.
+        :return: (index, rotated): the index of the log table where the rows should be saved, and whether it is
+            a new one
+        """
+        cursor.execute("UPDATE %s SET current_rows = current_rows + %s WHERE tag = %s"
+                       % (self.stateTableName, self.__placeholder(1), self.__placeholder(2)), (rows_count, self.tag))
+        cursor.execute("SELECT current_index, current_rows FROM %s WHERE tag = %s"
+                       % (self.stateTableName, self.__placeholder(1)), (self.tag,))
+        current_index, current_rows = cursor.fetchone()
+
+        # an empty table always take the rows, even they are more than table_rows
+        if current_rows > self.tableRows and current_rows != rows_count:
+            current_index += 1
+            cursor.execute("UPDATE %s SET current_index = %s, current_rows = %s WHERE tag = %s"
+                           % (self.stateTableName, self.__placeholder(1), self.__placeholder(2),
+                              self.__placeholder(3)), (current_index, rows_count, self.tag))
+            return current_index, True
+        return current_index, False
+
+    def __drop_earliest_table(self, cursor, current_index):
+        """
+        Drop the log table older than the latest self.tableCount ones, after the rotation is committed.
+        """
+        if current_index < self.tableCount:
+            return
+        try:
+            cursor.execute("DROP TABLE IF EXISTS %s_%d" % (self.baseTableName, current_index - self.tableCount))
+            self.__connection.commit()
+        except self.driver.DatabaseError:
+            # the rows have been saved, another process with the same tag may drop it at the same time
+            self.__connection.rollback()
+
+    def parse_log(self, record):
+        """
+        Translate the record object into a row of the log table
+        :param record: the log record object
+        :return: row: the tuple of column values
+        """
+        if self.__columns is None:
+            self.__compile_columns()
+        fields = self.record_fields(record)
+        row = list()
+        for column in self.__columns:
+            value = fields[column] if column in fields else getattr(record, column, None)
+            if type(value) not in _COLUMN_VALUE_TYPES:
+                value = str(value)
+            row.append(value)
+        return tuple(row)
+
+    @staticmethod
+    def __prepare_row(row):
+        """
+        Get the approximate size of the row for the batch.
+        """
+        return row, sum(len(value) if isinstance(value, (str, bytes)) else 8 for value in row)
+
+    def save_many(self, rows):
+        """
+        Save the rows with 'executemany' in one transaction, the row count of the log table is counted in it too.
+        """
+        if self.__connection is None:
+            self.__connect()
+        cursor = self.__connection.cursor()
+        try:
+            while True:
+                table_index, rotated = self.__count_table_rows(cursor, len(rows))
+                if table_index in self.__createdTables:
+                    break
+                # the DDL commits the transaction on mysql, so the table is created in its own step, and the
+                # counting runs again in a new transaction
+                self.__connection.rollback()
+                self.__create_table(cursor, table_index)
+                self.__connection.commit()
+            cursor.executemany("INSERT INTO %s_%d (%s) VALUES (%s)" % (
+                self.baseTableName, table_index, ", ".join(self.__columns), self.__placeholders(len(self.__columns))),
+                rows)
+            self.__connection.commit()
+        except Exception:
+            self.__connection.rollback()
+            cursor.close()
+            # the table may be dropped by another process, create it again next time
+            self.__createdTables.clear()
+            raise
+        try:
+            if rotated:
+                self.cpxStats.count_rotation()
+                self.__drop_earliest_table(cursor, table_index)
+        finally:
+            cursor.close()
+
+    def __save_batch(self, rows):
+        try:
+            self.save_many(rows)
+            self.cpxStats.count_bytes(sum(self.__prepare_row(row)[1] for row in rows))
+        except Exception:
+            for _ in rows:
+                self.cpxStats.count_failed()
+
+    def emit(self, record):
+        """
+        Get the row from record, then save it into the database.
+        """
+        try:
+            row = self.parse_log(record)
+            if self.batch:
+                self.__writer.put(row)
+            else:
+                self.save_many([row])
+                self.cpxStats.count_bytes(self.__prepare_row(row)[1])
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """
+        Wait for all the log data in the queue saved, only work in batch mode.
+        """
+        if self.__writer:
+            self.__writer.flush()
+
+    def close(self):
+        """
+        Stop the background writer thread after the queue is empty, and close the connection.
+        """
+        if self.__writer:
+            self.__writer.close()
+        if self.__connection is not None:
+            try:
+                self.__connection.close()
+            except Exception:
+                pass
+            self.__connection = None
+        logging.Handler.close(self)
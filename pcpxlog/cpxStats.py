@@ -0,0 +1,189 @@
+"""
+The runtime metrics of the handlers created by CPXLogger.
+
+The counters are plain ints added without a lock, the handlers count in their own threads with the GIL, so a
+lost add by two threads at the same time only makes a counter a little smaller.
+The latency of 'handle' is only timed for one of every 'sample_rate' records, and saved in a histogram
+with power-of-two buckets of nanoseconds.
+"""
+import json
+import logging
+import threading
+import time
+
+# the histogram bucket i counts the latencies in [2 ** (i - 1), 2 ** i) nanoseconds
+HISTOGRAM_BUCKETS = 64
+
+
+class HandlerStats:
+    """
+    The counters and the latency histogram of one handler.
+    """
+
+    def __init__(self, sample_rate=16):
+        """
+        :param sample_rate: time one of every sample_rate records
+        """
+        self.sampleRate = max(1, int(sample_rate))
+        self.emitted = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rotations = 0
+        self.__calls = 0
+        self.bytesWritten = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def count_emitted(self):
+        self.emitted += 1
+
+    def count_dropped(self):
+        self.dropped += 1
+
+    def count_failed(self):
+        self.failed += 1
+
+    def count_rotation(self):
+        self.rotations += 1
+
+    def count_bytes(self, size):
+        self.bytesWritten += size
+
+    def should_sample(self):
+        calls = self.__calls
+        self.__calls = calls + 1
+        return calls % self.sampleRate == 0
+
+    def record_latency(self, latency_ns):
+        self.histogram[min(HISTOGRAM_BUCKETS - 1, int(latency_ns).bit_length())] += 1
+
+    def latency_percentile(self, percent):
+        """
+        Get the upper bound of the histogram bucket which contains the percentile, in microseconds.
+        """
+        histogram = list(self.histogram)
+        total = sum(histogram)
+        if not total:
+            return 0
+        threshold = total * percent / 100
+        accumulated = 0
+        for index, count in enumerate(histogram):
+            accumulated += count
+            if accumulated >= threshold:
+                return (1 << index) / 1000
+        return (1 << (HISTOGRAM_BUCKETS - 1)) / 1000
+
+    def snapshot(self):
+        return dict(
+            emitted=self.emitted,
+            dropped=self.dropped,
+            failed=self.failed,
+            bytes_written=self.bytesWritten,
+            rotations=self.rotations,
+            latency_samples=sum(self.histogram),
+            latency_p50_us=self.latency_percentile(50),
+            latency_p99_us=self.latency_percentile(99),
+            latency_histogram={(1 << index): count for index, count in enumerate(self.histogram) if count},
+        )
+
+
+def instrument_handler(handler, sample_rate=16):
+    """
+    Wrap the methods of the handler object to count its records, failures, bytes and rotations, and time its
+    'handle' calling by sample. The handlers of this package may have created 'cpxStats' themselves and count
+    what can not be seen from outside, like the dropped records.
+    :return: stats: the HandlerStats object, it is 'handler.cpxStats' too
+    """
+    stats = getattr(handler, "cpxStats", None)
+    if stats is None:
+        stats = HandlerStats(sample_rate)
+        handler.cpxStats = stats
+    else:
+        stats.sampleRate = max(1, int(sample_rate))
+    perf_counter_ns = time.perf_counter_ns
+
+    handle = handler.handle
+
+    def instrumented_handle(record):
+        if stats.should_sample():
+            start = perf_counter_ns()
+            rv = handle(record)
+            stats.record_latency(perf_counter_ns() - start)
+        else:
+            rv = handle(record)
+        if rv:
+            stats.count_emitted()
+        return rv
+
+    handler.handle = instrumented_handle
+
+    handle_error = handler.handleError
+
+    def instrumented_handle_error(record):
+        stats.count_failed()
+        handle_error(record)
+
+    handler.handleError = instrumented_handle_error
+
+    if isinstance(handler, logging.StreamHandler):
+        handler_format = handler.format
+
+        def instrumented_format(record):
+            msg = handler_format(record)
+            # the message and the terminator
+            stats.count_bytes(len(msg) + 1)
+            return msg
+
+        handler.format = instrumented_format
+
+    if hasattr(handler, "doRollover"):
+        do_rollover = handler.doRollover
+
+        def instrumented_do_rollover():
+            stats.count_rotation()
+            do_rollover()
+
+        handler.doRollover = instrumented_do_rollover
+
+    return stats
+
+
+class StatsDumper:
+    """
+    Dump the stats snapshot into a logger or a file every 'interval' seconds in a background thread.
+    """
+
+    def __init__(self, get_stats, interval, file_path=None, logger_name=None):
+        """
+        :param get_stats: the function returns the stats snapshot
+        :param interval: the seconds between two dumps
+        :param file_path: append the snapshot as a json line into this file
+        :param logger_name: log the snapshot as a json message with this logger, if file_path is not set
+        """
+        self.getStats = get_stats
+        self.interval = interval
+        self.filePath = file_path
+        self.loggerName = logger_name or "CPXLogger.stats"
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__dump_loop, name="CPXLog-stats-dumper", daemon=True)
+
+    def __dump(self):
+        line = json.dumps(dict(time=time.time(), handlers=self.getStats()))
+        if self.filePath:
+            with open(self.filePath, "a") as f:
+                f.write(line + "\n")
+        else:
+            logging.getLogger(self.loggerName).info(line)
+
+    def __dump_loop(self):
+        while not self.__stopped.wait(self.interval):
+            try:
+                self.__dump()
+            except Exception:
+                pass
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
@@ -1,7 +1,12 @@
 """
 Save self-defined tools in this file
 """
+import datetime
 import os
+import re
+import logging
+import threading
+import time
 
 
 def create_conf_py_file():
@@ -18,6 +23,316 @@ def create_conf_py_file():
         f.write(data)
 
 
+# ------ Create format fields compiler begin 2019-6-2 ------ #
+# the patterns to find the field names in the format string of every formatter style
+FORMAT_FIELD_PATTERNS = {
+    logging.PercentStyle: re.compile(r"%\((\w+)\)"),
+    logging.StrFormatStyle: re.compile(r"{(\w+)"),
+    logging.StringTemplateStyle: re.compile(r"\${?(\w+)"),
+}
+
+
+def compile_format_fields(formatter, extra_fields=()):
+    """
+    Parse the format string of the formatter once, get the record attribute names it used.
+    :param formatter: the logging.Formatter object
+    :param extra_fields: the names of custom attributes from 'extra=', they are saved too
+    :return: fields: the tuple of attribute names, without duplicate and keep the order
+    """
+    style = formatter._style
+    pattern = FORMAT_FIELD_PATTERNS.get(type(style), FORMAT_FIELD_PATTERNS[logging.PercentStyle])
+    fields = pattern.findall(style._fmt) + list(extra_fields)
+    return tuple(dict.fromkeys(fields))
+
+
+# the attribute of the record caching the message, asctime and lines formatted for it, so the handlers with
+# the same format share them
+RECORD_CACHE_ATTR = "cpxFormatCache"
+
+
+def record_cache(record):
+    """
+    Get the cache dict of the record, create it for the first time.
+    """
+    cache = record.__dict__.get(RECORD_CACHE_ATTR)
+    if cache is None:
+        cache = record.__dict__[RECORD_CACHE_ATTR] = dict()
+    return cache
+
+
+def record_message(record):
+    """
+    Get the message of the record, the args are merged into the message only once for all the handlers.
+    """
+    cache = record_cache(record)
+    message = cache.get("message")
+    if message is None:
+        message = cache["message"] = record.getMessage()
+    return message
+
+
+# the attribute of the record keeping the msg before the args are merged into it, by the front-ends like
+# 'CPXQueueHandler', so the filters behind them still know the records logged by the same calling
+RECORD_TEMPLATE_ATTR = "cpxMsgTemplate"
+
+
+def record_template(record):
+    """
+    Get the msg of the record before the args are merged into it.
+    """
+    return record.__dict__.get(RECORD_TEMPLATE_ATTR, record.msg)
+
+
+class CPXFormatter(logging.Formatter):
+    """
+    The formatter shared by the handlers with the same format, see 'shared_formatter'. The message, asctime
+    and formatted line are cached in the record, so a record logged into many handlers is formatted once for
+    every format, and the message and asctime are computed once for all of them. The 'strftime' part of the
+    asctime is cached for the current second.
+    """
+
+    def __init__(self, fmt=None, datefmt=None, style="%"):
+        logging.Formatter.__init__(self, fmt, datefmt, style)
+        # the key of the formatted line in the record cache
+        self.cacheKey = (self._style._fmt, datefmt, style)
+        # (second, datefmt, the strftime text)
+        self.__timeCache = (None, None, None)
+
+    def formatTime(self, record, datefmt=None):
+        """
+        Like 'Formatter.formatTime', but only call 'strftime' once every second.
+        """
+        second = int(record.created)
+        cached_second, cached_datefmt, text = self.__timeCache
+        if cached_second != second or cached_datefmt != datefmt:
+            text = time.strftime(datefmt or self.default_time_format, self.converter(record.created))
+            self.__timeCache = (second, datefmt, text)
+        if not datefmt and self.default_msec_format:
+            text = self.default_msec_format % (text, record.msecs)
+        return text
+
+    def prepare_record(self, record):
+        """
+        Add the 'message', 'asctime' and 'exc_text' attributes for the record object from the record cache,
+        the formatters with the same datefmt share the asctime.
+        """
+        cache = record_cache(record)
+        record.message = record_message(record)
+        if self.usesTime():
+            asctime_key = ("asctime", self.datefmt)
+            asctime = cache.get(asctime_key)
+            if asctime is None:
+                asctime = cache[asctime_key] = self.formatTime(record, self.datefmt)
+            record.asctime = asctime
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        return record
+
+    def format(self, record):
+        """
+        Format the record like 'Formatter.format', the line is formatted once for all the handlers sharing
+        this formatter.
+        """
+        cache = record_cache(record)
+        line = cache.get(self.cacheKey)
+        if line is not None:
+            return line
+
+        self.prepare_record(record)
+        line = self.formatMessage(record)
+        if record.exc_text:
+            if line[-1:] != "\n":
+                line = line + "\n"
+            line = line + record.exc_text
+        if record.stack_info:
+            if line[-1:] != "\n":
+                line = line + "\n"
+            line = line + self.formatStack(record.stack_info)
+        cache[self.cacheKey] = line
+        return line
+
+
+# {(fmt, datefmt, style): CPXFormatter object}
+SHARED_FORMATTERS = dict()
+
+
+def shared_formatter(fmt=None, datefmt=None, style="%"):
+    """
+    Get the CPXFormatter object of the format, the same format gets the same formatter object.
+    """
+    key = (fmt, datefmt, style)
+    formatter = SHARED_FORMATTERS.get(key)
+    if formatter is None:
+        formatter = SHARED_FORMATTERS.setdefault(key, CPXFormatter(fmt, datefmt, style))
+    return formatter
+
+
+class RecordFieldsMixin:
+    """
+    The mixin for the handlers which save the record fields used by the format string, instead of the
+    formatted line. The field names are compiled once when 'setFormatter' is called, and compiled again
+    if the formatter is replaced without calling it.
+    """
+    extraFields = tuple()
+    __fields = tuple()
+    __fieldsFormatter = None
+
+    def setFormatter(self, fmt):
+        """
+        Set the formatter and compile the record attribute names used by its format string.
+        """
+        logging.Handler.setFormatter(self, fmt)
+        self.__compile_fields()
+
+    def __compile_fields(self):
+        """
+        Get the attribute names to save from self.formatter and self.extraFields.
+        """
+        self.__fields = compile_format_fields(self.formatter, self.extraFields)
+        self.__fieldsFormatter = self.formatter
+
+    def format_record(self, record):
+        """
+        Add the 'message', 'asctime' and 'exc_text' attributes for the record object, like 'Formatter.format'
+        but without creating the formatted line.
+        """
+        if isinstance(self.formatter, CPXFormatter):
+            return self.formatter.prepare_record(record)
+
+        record.message = record_message(record)
+
+        if self.formatter.usesTime():
+            record.asctime = self.formatter.formatTime(record, self.formatter.datefmt)
+
+        if record.exc_info:
+            # Cache the traceback text to avoid converting it multiple times
+            # (it's constant anyway)
+            if not record.exc_text:
+                record.exc_text = self.formatter.formatException(record.exc_info)
+
+        return record
+
+    def record_fields(self, record):
+        """
+        Get the compiled fields of the record, and the 'exc_text' and 'stack_info' if they have value.
+        :return: fields_dict: {field name: value}
+        """
+        record = self.format_record(record)
+
+        # the formatter may be replaced without calling setFormatter
+        if self.formatter is not self.__fieldsFormatter:
+            self.__compile_fields()
+        record2dict = record.__dict__
+
+        fields_dict = dict()
+        for key in self.__fields:
+            if key in record2dict:
+                fields_dict[key] = record2dict[key]
+
+        # Try to save some very important additional information
+        if record.exc_text:
+            fields_dict['exc_text'] = record.exc_text
+        if record.stack_info:
+            fields_dict['stack_info'] = record.stack_info
+
+        return fields_dict
+
+
+# ------ Create format fields compiler end 2019-6-2 ------ #
+
+
+# ------ Create lazy message begin 2019-6-14 ------ #
+class LazyMessage:
+    """
+    The message built only when a handler wants the record, for the expensive messages of the low levels.
+    It can be the message or one of the args, the function is called by 'str()' when the message is merged:
+
+        logger.debug(LazyMessage(json.dumps, state, indent=2))
+        logger.debug("the state: %s", LazyMessage(dump_state))
+
+    If the level is disabled, 'logger.debug' returns before creating the record, so the function is never
+    called. The handlers created by CPXLogger merge the message once, so it is called once for all of them.
+    """
+    __slots__ = ("func", "args", "kwargs")
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+# ------ Create lazy message end 2019-6-14 ------ #
+
+
+# ------ Create shared clients begin 2019-6-10 ------ #
+class SharedClients:
+    """
+    The clients of a backend shared by all the handlers with the same uri and options, every client is
+    closed when no handler uses it.
+    """
+
+    def __init__(self, create_client, close_client):
+        """
+        :param create_client: the function create a client by (uri, **options)
+        :param close_client: the function close a client
+        """
+        self.createClient = create_client
+        self.closeClient = close_client
+        # {(uri, options): [client, reference_count]}
+        self.__clients = dict()
+        self.__lock = threading.Lock()
+
+    def acquire(self, uri, **options):
+        """
+        :return: (client, client_key): the shared client and the key to release it
+        """
+        client_key = (uri, tuple(sorted(options.items())))
+        with self.__lock:
+            if client_key not in self.__clients:
+                self.__clients[client_key] = [self.createClient(uri, **options), 0]
+            self.__clients[client_key][1] += 1
+            return self.__clients[client_key][0], client_key
+
+    def release(self, client_key):
+        with self.__lock:
+            client_info = self.__clients.get(client_key)
+            if not client_info:
+                return
+            client_info[1] -= 1
+            if client_info[1] <= 0:
+                del self.__clients[client_key]
+                self.closeClient(client_info[0])
+
+    def __len__(self):
+        return len(self.__clients)
+
+
+# ------ Create shared clients end 2019-6-10 ------ #
+
+
+# ------ Create time value parser begin 2019-6-14 ------ #
+def to_timestamp(value):
+    """
+    Translate the time value into a POSIX timestamp.
+    :param value: None, a timestamp, a datetime object (local time if it is naive), or a string of
+        an ISO format time or a timestamp
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            value = datetime.datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+# ------ Create time value parser end 2019-6-14 ------ #
+
+
 # ------ Create annotation check_params begin 2019-5-14 ------ #
 class CheckAnnotation(object):
     """
@@ -50,7 +365,10 @@ class CheckAnnotation(object):
                 if not isinstance(value, rules[name]):
                     raise RuntimeError('%s want %s, but %s' % (name, rules[name], type(value)))
             back = func(*args, **kwargs)
-            if 'return' in rules and not isinstance(back, rules['return']):  # 检查返回值类型
+            return_rule = rules.get('return', object)
+            if return_rule is None:  # '-> None' 的注解
+                return_rule = type(None)
+            if not isinstance(back, return_rule):  # 检查返回值类型
                 raise RuntimeError('return want %s, but %s' % (rules['return'], type(back)))
 
             return back
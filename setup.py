@@ -20,11 +20,18 @@ setup(
     license='Mozilla Public License Version 2.0',
     python_requires='>=3',
     install_requires=['pymongo'],
+    extras_require={
+        'redis': ['redis>=3.5'],
+        'zstd': ['zstandard'],
+    },
     packages=find_packages(),
 
     entry_points={
         'console_scripts': [
-            'cpxConfigDemo=pcpxlog.cpxUtils:create_conf_py_file'
+            'cpxConfigDemo=pcpxlog.cpxUtils:create_conf_py_file',
+            'cpxBench=pcpxlog.cpxBench:main',
+            'cpxLogReader=pcpxlog.cpxReader:main',
+            'cpxBinaryToText=pcpxlog.cpxBinary:main'
         ]
     }
 
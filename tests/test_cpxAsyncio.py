@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+
+from pcpxlog import CPXLogger
+from pcpxlog.cpxAsyncio import CPXAsyncioHandler
+
+
+class SlowHandler(logging.Handler):
+    """
+    Sleep 5ms for every record, like a database round trip.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = list()
+
+    def emit(self, record):
+        time.sleep(0.005)
+        self.messages.append(record.getMessage())
+
+
+async def max_loop_lag(logger, number):
+    """
+    Log the records while a ticker task sleeps 1ms again and again.
+    :return: (max_lag, burst_time): the max seconds the ticker woke up late, and the seconds of logging
+    """
+    lags, stop = list(), asyncio.Event()
+
+    async def ticker():
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - start - 0.001)
+
+    ticker_task = asyncio.ensure_future(ticker())
+    start = time.perf_counter()
+    for index in range(number):
+        logger.info("record %d", index)
+        await asyncio.sleep(0)
+    burst_time = time.perf_counter() - start
+    # keep ticking while the slow handler works
+    await asyncio.sleep(0.2)
+    stop.set()
+    await ticker_task
+    return max(lags), burst_time
+
+
+def test_loop_lag_stays_flat_with_slow_handler():
+    slow_handler = SlowHandler()
+    asyncio_handler = CPXAsyncioHandler(slow_handler)
+    logger = logging.getLogger("test-asyncio-lag")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(asyncio_handler)
+
+    async def main():
+        result = await max_loop_lag(logger, 100)
+        await asyncio_handler.aclose()
+        return result
+
+    try:
+        lag, burst_time = asyncio.run(main())
+    finally:
+        logger.removeHandler(asyncio_handler)
+
+    # the handler takes 0.5s, called in the loop every record would delay the ticker by 5ms
+    assert burst_time < 0.1
+    assert lag < 0.005
+    assert slow_handler.messages == ["record %d" % index for index in range(100)]
+
+
+def test_records_after_aclose_are_not_queued(tmp_path):
+    CPXLogger.config_from_dict({
+        "Basic": {"LEVEL": "INFO", "FORMAT": "%(message)s", "ASYNCIO": True},
+        "File": {"TYPE": "Ordinary", "FILE_PATH": str(tmp_path / "log"), "LEVEL": "INFO", "FORMAT": "%(message)s"},
+    })
+    logger = CPXLogger.create_logger("test-aclose")
+    logger.propagate = False
+    asyncio_handler = CPXLogger.handlers[0]
+
+    async def main():
+        logger.info("before aclose")
+        await CPXLogger.aclose()
+        logger.info("after aclose")
+
+    asyncio.run(main())
+    for handler in list(logging.getLogger().handlers):
+        logging.getLogger().removeHandler(handler)
+
+    assert asyncio_handler not in logger.handlers
+    assert CPXLogger.handlers == []
+    assert (tmp_path / "log").read_text() == "before aclose\n"
@@ -0,0 +1,44 @@
+import logging
+import threading
+
+from pcpxlog.cpxBatch import BatchWriter
+from pcpxlog.cpxHandlers import RotatingMongodbHandler
+from pcpxlog.cpxStats import HandlerStats
+
+
+def test_writer_drops_the_log_data_failed_preparing():
+    saved, stats = list(), HandlerStats()
+
+    def prepare(log_data):
+        if log_data == "bad":
+            raise ValueError(log_data)
+        return log_data, 1
+
+    writer = BatchWriter(saved.extend, linger_ms=10, prepare=prepare, stats=stats)
+    for log_data in ("bad", "a", "bad", "b"):
+        writer.put(log_data)
+    writer.flush()
+    writer.close()
+
+    assert saved == ["a", "b"]
+    assert stats.failed == 2
+
+
+def test_mongodb_writer_survives_the_log_data_bson_can_not_encode():
+    handler = RotatingMongodbHandler(extra_fields=("context",), batch=True, linger_ms=10, queue_capacity=4,
+                                     storage="Timed")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    saved = list()
+    # no mongodb server here, take the log data at the saving
+    handler.save_many = saved.extend
+
+    handler.handle(logging.makeLogRecord({"msg": "bad", "context": {1: "int keys"}}))
+    # more than the queue capacity, the 'Block' policy would hang if the writer thread died
+    for index in range(10):
+        handler.handle(logging.makeLogRecord({"msg": "good %d" % index, "context": "ok"}))
+    handler.flush()
+
+    assert [log_data["message"] for log_data in saved] == ["good %d" % index for index in range(10)]
+    assert handler.cpxStats.failed == 1
+    assert any(thread.name == "CPXLog-mongodb-writer" for thread in threading.enumerate())
+    handler.close()
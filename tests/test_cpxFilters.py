@@ -0,0 +1,32 @@
+import logging
+
+import pytest
+
+from pcpxlog import CPXLogger
+
+FORMAT = "%(message)s"
+
+
+@pytest.fixture(autouse=True)
+def remove_console_handlers():
+    yield
+    for handler in list(logging.getLogger().handlers):
+        logging.getLogger().removeHandler(handler)
+
+
+@pytest.mark.parametrize("mode", ["sync", "ASYNC", "ASYNCIO"])
+def test_dedupe_by_the_msg_before_merging_args(tmp_path, mode):
+    basic = {mode: True} if mode != "sync" else {}
+    CPXLogger.config_from_dict({
+        "Basic": dict({"LEVEL": "INFO", "FORMAT": FORMAT}, **basic),
+        "File": {"TYPE": "Ordinary", "FILE_PATH": str(tmp_path / "log"), "LEVEL": "INFO", "FORMAT": FORMAT,
+                 "DEDUPE_WINDOW": 60},
+    })
+    logger = CPXLogger.create_logger("dedupe-%s" % mode)
+    logger.propagate = False
+    for index in range(50):
+        logger.info("the request %d", index)
+    # the records in ASYNC and ASYNCIO modes come to the file handler with the args merged
+    CPXLogger._CPXLogger__flush_handlers()
+
+    assert (tmp_path / "log").read_text().splitlines() == ["the request 0"]
@@ -0,0 +1,38 @@
+import logging
+
+import pytest
+
+from pcpxlog import CPXLogger
+
+FORMAT = "%(message)s"
+
+
+def create_config(log_dir, **basic):
+    return {
+        "Basic": dict({"LEVEL": "INFO", "FORMAT": FORMAT}, **basic),
+        "File": {"TYPE": "Buffered", "FILE_PATH": str(log_dir / "log"), "LEVEL": "INFO", "FORMAT": FORMAT},
+        "Recorder": {"LEVEL": "DEBUG", "FORMAT": FORMAT, "TARGETS": ["File"]},
+    }
+
+
+@pytest.fixture(autouse=True)
+def remove_console_handlers():
+    yield
+    for handler in list(logging.getLogger().handlers):
+        logging.getLogger().removeHandler(handler)
+
+
+@pytest.mark.parametrize("mode", ["sync", "ASYNC"])
+def test_reload_closes_the_old_handlers(tmp_path, mode):
+    basic = {"ASYNC": True} if mode == "ASYNC" else {}
+    CPXLogger.config_from_dict(create_config(tmp_path, **basic))
+    CPXLogger.create_logger("reload")
+    # the instrumented handlers, include the ones behind the queue
+    old_handlers = list(CPXLogger._CPXLogger__stats_handlers)
+
+    CPXLogger.config_from_dict(create_config(tmp_path, **basic))
+    CPXLogger.create_logger("reload").info("after reload")
+
+    assert old_handlers
+    for handler in old_handlers:
+        assert handler._closed, handler
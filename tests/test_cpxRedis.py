@@ -0,0 +1,111 @@
+import logging
+import threading
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from pcpxlog.cpxRedis import RedisStreamHandler
+
+
+def create_handler(server, **params):
+    handler = RedisStreamHandler(**params)
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s <%(name)s> :%(message)s"))
+    # the shared pool connects nothing until it is used, take the fake redis in place of it
+    handler.client = fakeredis.FakeRedis(server=server)
+    return handler
+
+
+def create_record(index):
+    return logging.LogRecord("app", logging.INFO, __file__, 1, "the request %d", (index,), None)
+
+
+def test_entries_added_by_pipelines():
+    server = fakeredis.FakeServer()
+    handler = create_handler(server, batch=True, batch_size=50, linger_ms=50)
+    pipelines = list()
+    pipeline = handler.client.pipeline
+
+    def recorded_pipeline(*args, **kwargs):
+        pipelines.append(pipeline(*args, **kwargs))
+        return pipelines[-1]
+
+    handler.client.pipeline = recorded_pipeline
+    for index in range(120):
+        handler.handle(create_record(index))
+    handler.flush()
+
+    client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    entries = client.xrange("CPXLog")
+    assert len(entries) == 120
+    assert entries[-1][1]["message"] == "the request 119"
+    assert entries[-1][1]["levelname"] == "INFO"
+    # at least 3 pipelines of at most 50 entries, not one round trip every entry
+    assert 3 <= len(pipelines) < 120
+    assert handler.cpxStats.failed == 0
+    handler.close()
+
+
+def test_stream_trimmed_by_maxlen():
+    server = fakeredis.FakeServer()
+    handler = create_handler(server, batch=True, maxlen=100, approximate=False, linger_ms=10)
+    for index in range(300):
+        handler.handle(create_record(index))
+    handler.flush()
+    handler.close()
+
+    client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    assert client.xlen("CPXLog") == 100
+    assert client.xrange("CPXLog", count=1)[0][1]["message"] == "the request 200"
+
+
+def test_approximate_trimming_sends_maxlen_tilde():
+    server = fakeredis.FakeServer()
+    handler = create_handler(server, batch=False, maxlen=100)
+    commands = list()
+    execute_command = handler.client.execute_command
+
+    def recorded_execute_command(*args, **kwargs):
+        commands.append(args)
+        return execute_command(*args, **kwargs)
+
+    handler.client.execute_command = recorded_execute_command
+    handler.handle(create_record(0))
+    handler.close()
+
+    assert commands[0][:4] == ("XADD", "CPXLog", b"MAXLEN", b"~")
+
+
+def test_failed_and_dropped_entries_counted():
+    server = fakeredis.FakeServer()
+    server.connected = False
+    handler = create_handler(server, batch=True, linger_ms=10)
+    for index in range(10):
+        handler.handle(create_record(index))
+    handler.flush()
+    assert handler.cpxStats.failed == 10
+    handler.close()
+
+    server.connected = True
+    handler = create_handler(server, batch=True, batch_size=1, linger_ms=0, queue_capacity=2,
+                             queue_full_policy="Drop")
+    saving, release = threading.Event(), threading.Event()
+    save_many = handler.save_many
+
+    def blocked_save_many(entries):
+        saving.set()
+        release.wait()
+        save_many(entries)
+
+    handler.save_many = blocked_save_many
+    handler.handle(create_record(0))
+    saving.wait(5)
+    # the writer thread is saving the first one, the queue keeps 2 of them and the others are dropped
+    for index in range(1, 6):
+        handler.handle(create_record(index))
+    release.set()
+    handler.flush()
+    handler.close()
+
+    assert handler.cpxStats.dropped == 3
+    assert fakeredis.FakeRedis(server=server).xlen("CPXLog") == 3
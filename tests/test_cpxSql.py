@@ -0,0 +1,83 @@
+import logging
+import sqlite3
+
+import pytest
+
+from pcpxlog.cpxSql import SqlHandler
+
+
+def create_handler(tmp_path, **params):
+    handler = SqlHandler(database=str(tmp_path / "log.db"), **params)
+    handler.setFormatter(logging.Formatter("[%(levelname)s] %(asctime)s <%(name)s> :%(message)s"))
+    return handler
+
+
+def create_record(index):
+    return logging.LogRecord("app", logging.INFO, __file__, 1, "the request %d", (index,), None)
+
+
+def query(tmp_path, sql):
+    with sqlite3.connect(str(tmp_path / "log.db")) as connection:
+        return connection.execute(sql).fetchall()
+
+
+def log_tables(tmp_path):
+    return sorted(name for name, in query(tmp_path, "SELECT name FROM sqlite_master WHERE type = 'table'")
+                  if name != "logs_state")
+
+
+def trace_statements(handler, statements):
+    # connect at once and trace the statements of the handler connection
+    handler.handle(create_record(-1))
+    handler.flush()
+    handler._SqlHandler__connection.set_trace_callback(statements.append)
+
+
+def test_batch_saved_in_one_transaction_without_ddl(tmp_path):
+    handler = create_handler(tmp_path, batch=True, batch_size=100, linger_ms=50, table_rows=150)
+    statements = list()
+    trace_statements(handler, statements)
+    for index in range(200):
+        handler.handle(create_record(index))
+    handler.flush()
+    handler.close()
+
+    assert query(tmp_path, "PRAGMA journal_mode") == [("wal",)]
+    assert log_tables(tmp_path) == ["logs_0", "logs_1"]
+    assert sum(query(tmp_path, "SELECT COUNT(*) FROM %s" % table)[0][0] for table in log_tables(tmp_path)) == 201
+    # every transaction only has the state updating and the inserting, the tables are created out of them
+    transaction = None
+    for statement in statements:
+        if statement.startswith("BEGIN"):
+            transaction = list()
+        elif statement.startswith(("COMMIT", "ROLLBACK")):
+            transaction = None
+        elif transaction is not None:
+            assert not statement.startswith(("CREATE", "DROP")), statement
+    assert handler.cpxStats.failed == 0
+
+
+def test_failed_batch_rolled_back(tmp_path):
+    handler = create_handler(tmp_path, batch=False)
+    handler.handle(create_record(0))
+    row = handler.parse_log(create_record(1))
+    bad_row = tuple([[]] + list(row[1:]))
+
+    with pytest.raises(sqlite3.Error):
+        handler.save_many([row, bad_row])
+    handler.close()
+
+    assert query(tmp_path, "SELECT COUNT(*) FROM logs_0") == [(1,)]
+    assert query(tmp_path, "SELECT current_index, current_rows FROM logs_state") == [(0, 1)]
+
+
+def test_tables_rotated(tmp_path):
+    handler = create_handler(tmp_path, batch=False, table_rows=10, table_count=2)
+    for index in range(45):
+        handler.handle(create_record(index))
+    handler.close()
+
+    assert log_tables(tmp_path) == ["logs_3", "logs_4"]
+    assert query(tmp_path, "SELECT current_index, current_rows FROM logs_state") == [(4, 5)]
+    assert query(tmp_path, "SELECT COUNT(*) FROM logs_3") == [(10,)]
+    assert handler.cpxStats.rotations == 4